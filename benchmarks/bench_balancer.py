@@ -0,0 +1,68 @@
+"""
+Стоимость выбора ноды в зависимости от числа нод.
+
+Для каждой стратегии LoadBalancer замеряется среднее время select() при
+кэшированной нагрузке. Для сравнения - прежняя схема: запрос нагрузки и
+линейный поиск минимума на каждое новое устройство.
+
+    python -m benchmarks.bench_balancer --nodes 2,10,100,1000,10000 --selections 20000
+"""
+import argparse
+import random
+import time
+from typing import Dict, List
+
+from services.load_balancer import LoadBalancer, STRATEGIES
+
+
+def make_nodes(count: int) -> List[Dict]:
+    return [
+        {'name': f"node{i}", 'host': f"http://10.0.{i // 256}.{i % 256}:62051",
+         'address': f"10.0.{i // 256}.{i % 256}", 'weight': random.choice([1, 2, 4]),
+         'max_users': 0}
+        for i in range(count)
+    ]
+
+
+def make_loads(nodes: List[Dict]) -> Dict[str, float]:
+    return {node['address']: random.randint(0, 500) for node in nodes}
+
+
+def bench_strategy(strategy: str, nodes: List[Dict], selections: int) -> float:
+    loads = make_loads(nodes)
+    balancer = LoadBalancer(nodes, lambda: loads, strategy=strategy, cache_ttl=3600)
+    balancer.select()  # построение снимка не входит в замер
+    started = time.perf_counter()
+    for _ in range(selections):
+        balancer.select()
+    return (time.perf_counter() - started) / selections
+
+
+def bench_uncached(nodes: List[Dict], selections: int) -> float:
+    loads = make_loads(nodes)
+    started = time.perf_counter()
+    for _ in range(selections):
+        current = dict(loads)  # новый снимок нагрузки на каждый выбор
+        address = min(nodes, key=lambda node: current[node['address']])['address']
+        loads[address] += 1
+    return (time.perf_counter() - started) / selections
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Node selection cost vs node count")
+    parser.add_argument('--nodes', default='2,10,100,1000,10000')
+    parser.add_argument('--selections', type=int, default=20000)
+    args = parser.parse_args()
+
+    counts = [int(value) for value in args.nodes.split(',')]
+    names = list(STRATEGIES) + ['uncached_scan']
+    print(f"{'nodes':>7} " + " ".join(f"{name:>16}" for name in names) + "   (us per selection)")
+    for count in counts:
+        nodes = make_nodes(count)
+        results = [bench_strategy(name, nodes, args.selections) for name in STRATEGIES]
+        results.append(bench_uncached(nodes, max(args.selections // max(count // 100, 1), 100)))
+        print(f"{count:>7} " + " ".join(f"{value * 1e6:16.2f}" for value in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Нагрузочный прогон Marzban-зависимых путей бота против локальной заглушки.
+
+Примеры:
+    python -m benchmarks.bench_marzban --scenario add_device --requests 500 --concurrency 16
+    python -m benchmarks.bench_marzban --scenario sweep --users 2000 --latency lognormal:-4,0.6
+    python -m benchmarks.bench_marzban --scenario show_config --error-rate 0.02 --token-ttl 5
+"""
+import argparse
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from benchmarks.common import latency_summary, format_summary
+from benchmarks.fake_marzban import FakeMarzbanServer, FakeMarzbanState
+from services.marzban_service import MarzbanService
+
+_counter = itertools.count()
+
+
+def _timed(operation: Callable[[], bool]) -> Tuple[float, bool]:
+    started = time.perf_counter()
+    ok = bool(operation())
+    return time.perf_counter() - started, ok
+
+
+def scenario_add_device(marzban: MarzbanService, seeded: List[str]) -> Callable[[], bool]:
+    """create_user + get_user_config, как в DeviceService.add_device и показе QR."""
+    def operation():
+        username = f"bench_{next(_counter)}"
+        return marzban.create_user(username, days=30) and marzban.get_user_config(username)
+    return operation
+
+
+def scenario_show_config(marzban: MarzbanService, seeded: List[str]) -> Callable[[], bool]:
+    """get_user_config для существующего пользователя (handle_devices / handle_show_config)."""
+    def operation():
+        return marzban.get_user_config(seeded[next(_counter) % len(seeded)])
+    return operation
+
+
+def scenario_delete(marzban: MarzbanService, seeded: List[str]) -> Callable[[], bool]:
+    """delete_user, как в почасовой проверке истечения срока."""
+    def operation():
+        return marzban.delete_user(seeded[next(_counter) % len(seeded)])
+    return operation
+
+
+SCENARIOS = {
+    'add_device': scenario_add_device,
+    'show_config': scenario_show_config,
+    'delete': scenario_delete,
+}
+
+
+def run_load(operation: Callable[[], bool], requests_count: int, concurrency: int) -> None:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: _timed(operation), range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, ok in results if not ok)
+    print(format_summary('requests', latency_summary(latencies)))
+    print(f"throughput={requests_count / elapsed:.1f} req/s errors={errors} elapsed={elapsed:.2f}s")
+
+
+def run_sweep(marzban: MarzbanService, seeded: List[str]) -> None:
+    """Последовательный обход всех устройств, как в полной сверке с Marzban."""
+    latencies = []
+    started = time.perf_counter()
+    for username in seeded:
+        latency, _ = _timed(lambda: marzban.get_user_config(username))
+        latencies.append(latency)
+    elapsed = time.perf_counter() - started
+    print(format_summary('sweep call', latency_summary(latencies)))
+    print(f"sweep over {len(seeded)} devices took {elapsed:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Marzban-bound paths against a fake panel")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['sweep'], default='add_device')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=500, help="pre-seeded panel users")
+    parser.add_argument('--latency', default='uniform:0.01,0.05')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--token-ttl', type=float, default=86400)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    state = FakeMarzbanState(
+        admin_username='admin',
+        admin_password='admin',
+        latency=args.latency,
+        error_rate=args.error_rate,
+        token_ttl=args.token_ttl
+    )
+    state.seed_users(args.users)
+    seeded = list(state.users)
+
+    with FakeMarzbanServer(state) as server:
+        marzban = MarzbanService(host=server.url, username='admin', password='admin', node_manager=None)
+        if args.scenario == 'sweep':
+            run_sweep(marzban, seeded)
+        else:
+            run_load(SCENARIOS[args.scenario](marzban, seeded), args.requests, args.concurrency)
+        print(f"panel requests: {state.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Отрисовка QR-кодов в потоке обработчика и в пуле процессов.
+
+Клиентские потоки одновременно запрашивают QR-коды для уникальных ссылок
+(кэш QRService отключен), параллельно поток-"обработчик" каждые 5 мс
+выполняет короткую работу и замеряет, насколько она задержалась - так видно,
+как отрисовка через GIL тормозит остальные обработчики бота.
+
+    python -m benchmarks.bench_qr --clients 16 --requests 400 --workers 2
+"""
+import argparse
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from benchmarks.common import latency_summary, format_summary
+from services.qr_service import QRService, QRRenderPool
+
+
+def make_link() -> str:
+    return (f"vless://{uuid.uuid4()}@150.241.108.35:443?security=reality&type=tcp"
+            f"&flow=xtls-rprx-vision&sni=google.com&fp=chrome&pbk={uuid.uuid4().hex}&sid=ab#Marz")
+
+
+def run_load(qr_service: QRService, clients: int, requests: int) -> Dict[str, object]:
+    links = [make_link() for _ in range(requests)]
+    latencies: List[float] = []
+    stalls: List[float] = []
+    failures = itertools.count()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def handler_probe():
+        interval = 0.005
+        while not stop.is_set():
+            expected = time.perf_counter() + interval
+            time.sleep(interval)
+            stalls.append(max(time.perf_counter() - expected, 0.0))
+
+    def render(link: str):
+        started = time.perf_counter()
+        try:
+            qr_service.render_png(link)
+        except TimeoutError:
+            next(failures)
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    probe = threading.Thread(target=handler_probe, daemon=True)
+    probe.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(render, links))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    probe.join()
+
+    return {
+        'throughput': len(latencies) / elapsed,
+        'failed': next(failures),
+        'render': latency_summary(latencies),
+        'stall': latency_summary(stalls)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inline vs process-pool QR rendering under concurrent load")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=5)
+    args = parser.parse_args()
+
+    pool = QRRenderPool(workers=args.workers, max_pending=args.max_pending, timeout=args.timeout)
+    pool.start()  # запуск процессов не входит в замер
+    modes = {
+        'inline': QRService(max_bytes=0, backend='inline'),
+        'process': QRService(max_bytes=0, render_pool=pool)
+    }
+
+    for mode, qr_service in modes.items():
+        result = run_load(qr_service, args.clients, args.requests)
+        print(f"--- {mode}: {result['throughput']:.1f} QR/s, {result['failed']} failed ---")
+        print(format_summary('render', result['render']))
+        print(format_summary('handler stall', result['stall']))
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
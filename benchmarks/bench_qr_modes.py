@@ -0,0 +1,55 @@
+"""
+Размер и время отрисовки QR-кода в разных режимах.
+
+Для ссылок разной длины сравниваются classic (PNG, box_size=10, уровень L),
+compact (1-битный PNG под QR_TARGET_SIZE, уровень коррекции по длине) и svg.
+Кэш QRService не используется - замеряется сама отрисовка.
+
+    python -m benchmarks.bench_qr_modes --lengths 80,220,400 --repeat 50
+"""
+import argparse
+import random
+import string
+import time
+
+from qrcode.constants import ERROR_CORRECT_L
+
+from services.qr_service import render_qr_png, choose_error_correction
+
+EC_NAMES = {0: 'M', 1: 'L', 2: 'H', 3: 'Q'}
+
+MODES = {
+    'classic': lambda data: render_qr_png(data, ERROR_CORRECT_L, 10, 4, 'classic'),
+    'compact': lambda data: render_qr_png(data, None, None, 4, 'compact'),
+    'svg': lambda data: render_qr_png(data, None, None, 4, 'svg')
+}
+
+
+def make_payload(length: int) -> str:
+    prefix = "vless://"
+    alphabet = string.ascii_letters + string.digits + "-_&=?"
+    return prefix + "".join(random.choice(alphabet) for _ in range(max(length - len(prefix), 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes and milliseconds per QR code for each mode")
+    parser.add_argument('--lengths', default='80,220,400')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'length':>6} {'ec':>3} {'mode':>8} {'bytes':>8} {'ms/qr':>8}")
+    for length in (int(value) for value in args.lengths.split(',')):
+        payload = make_payload(length)
+        level = EC_NAMES[choose_error_correction(payload)]
+        for mode, render in MODES.items():
+            output = render(payload)
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                render(payload)
+            elapsed = (time.perf_counter() - started) / args.repeat
+            print(f"{length:>6} {level if mode != 'classic' else 'L':>3} {mode:>8} "
+                  f"{len(output):>8} {elapsed * 1000:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Задержки запросов к Marzban по классам под синтетической смешанной нагрузкой.
+
+Фоновые проверки непрерывно забивают панель, пока пользовательские и
+платежные запросы приходят пуассоновским потоком. Сравниваются приоритетный
+планировщик и FIFO с тем же числом рабочих потоков.
+
+    python -m benchmarks.bench_scheduler --duration 10 --workers 4 --latency const:0.02
+"""
+import argparse
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from benchmarks.common import latency_summary, format_summary
+from benchmarks.fake_marzban import FakeMarzbanServer, FakeMarzbanState
+from services.marzban_scheduler import MarzbanRequestScheduler
+from services.marzban_service import MarzbanService
+from utils.rate_limiter import TokenBucket
+
+
+def run_mixed_load(server_url: str, seeded: List[str], scheduler: MarzbanRequestScheduler,
+                   duration: float, background_threads: int,
+                   interactive_rate: float, payment_rate: float) -> Dict[str, List[float]]:
+    marzban = MarzbanService(host=server_url, username='admin', password='admin',
+                             node_manager=None, scheduler=scheduler)
+    # Измеряем только планирование, без ограничителя исходящих запросов
+    marzban.buckets = {name: TokenBucket(0, 0) for name in marzban.buckets}
+
+    latencies: Dict[str, List[float]] = {'interactive': [], 'payment': [], 'background': []}
+    lock = threading.Lock()
+    stop = threading.Event()
+    counter = itertools.count()
+
+    def timed(traffic_class: str, operation):
+        started = time.perf_counter()
+        with marzban.traffic(traffic_class):
+            operation()
+        with lock:
+            latencies[traffic_class].append(time.perf_counter() - started)
+
+    def background_loop():
+        while not stop.is_set():
+            timed('background', lambda: marzban.get_user_config(seeded[next(counter) % len(seeded)]))
+
+    def arrivals(traffic_class: str, rate: float, operation, pool: ThreadPoolExecutor):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            time.sleep(random.expovariate(rate))
+            pool.submit(timed, traffic_class, operation)
+
+    def show_config():
+        marzban.get_user_config(seeded[next(counter) % len(seeded)])
+
+    def create_device():
+        marzban.create_user(f"bench_pay_{next(counter)}", days=30)
+
+    scheduler.start()
+    background = [threading.Thread(target=background_loop, daemon=True) for _ in range(background_threads)]
+    for thread in background:
+        thread.start()
+
+    with ThreadPoolExecutor(max_workers=128) as pool:
+        producers = [
+            threading.Thread(target=arrivals, args=('interactive', interactive_rate, show_config, pool)),
+            threading.Thread(target=arrivals, args=('payment', payment_rate, create_device, pool))
+        ]
+        for thread in producers:
+            thread.start()
+        for thread in producers:
+            thread.join()
+
+    stop.set()
+    for thread in background:
+        thread.join()
+    scheduler.stop()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-class latency of Marzban requests under mixed load")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--background-threads', type=int, default=16)
+    parser.add_argument('--interactive-rate', type=float, default=20, help="requests per second")
+    parser.add_argument('--payment-rate', type=float, default=5, help="requests per second")
+    parser.add_argument('--latency', default='const:0.02')
+    parser.add_argument('--aging', type=float, default=2.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    state = FakeMarzbanState(admin_username='admin', admin_password='admin', latency=args.latency)
+    state.seed_users(1000)
+    seeded = list(state.users)
+
+    modes = {
+        'priority': MarzbanRequestScheduler(workers=args.workers, aging_seconds=args.aging),
+        # Одинаковый приоритет + aging = обслуживание в порядке поступления
+        'fifo': MarzbanRequestScheduler(workers=args.workers, aging_seconds=args.aging,
+                                        priorities={'interactive': 0, 'payment': 0, 'background': 0})
+    }
+
+    with FakeMarzbanServer(state) as server:
+        for mode, scheduler in modes.items():
+            latencies = run_mixed_load(server.url, seeded, scheduler, args.duration, args.background_threads,
+                                       args.interactive_rate, args.payment_rate)
+            print(f"--- {mode} ({args.workers} workers) ---")
+            for traffic_class, values in latencies.items():
+                print(format_summary(traffic_class, latency_summary(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Сравнение памяти и времени подсчета активных пользователей Marzban.
+
+Заглушка панели запускается в отдельном процессе, чтобы tracemalloc учитывал
+только память клиента.
+
+    python -m benchmarks.bench_users_count --users 50000
+"""
+import argparse
+import logging
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import requests
+
+from services.marzban_service import MarzbanService
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.post(f"{url}/api/admin/token", data={'username': 'admin', 'password': 'admin'}, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("Fake Marzban did not start")
+
+
+def _measure(name: str, operation: Callable[[], Optional[int]]) -> None:
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = operation()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<14} result={result} time={elapsed * 1000:9.1f}ms peak_mem={peak / 1024 / 1024:8.2f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark active users counting")
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_marzban', '--port', str(port),
+         '--username', 'admin', '--password', 'admin', '--seed-users', str(args.users)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_ready(url)
+        marzban = MarzbanService(host=url, username='admin', password='admin', node_manager=None)
+
+        def legacy_count():
+            # Прежняя реализация: весь список в память и фильтр в Python
+            users = marzban._request("GET", "/api/users").json()['users']
+            return len([u for u in users if u.get('status') == 'active'])
+
+        _measure('legacy', legacy_count)
+        _measure('streaming', lambda: sum(1 for _ in marzban.iter_users(status='active', page_size=args.page_size)))
+        _measure('fast path', marzban.get_active_users_count)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
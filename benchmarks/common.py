@@ -0,0 +1,25 @@
+"""Общие утилиты для бенчмарков."""
+from typing import Dict, List
+
+from utils.stats import percentile
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """Сводка задержек в миллисекундах."""
+    return {
+        'count': len(latencies),
+        'mean_ms': (sum(latencies) / len(latencies) * 1000) if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0
+    }
+
+
+def format_summary(name: str, summary: Dict[str, float]) -> str:
+    return (
+        f"{name:<16} n={summary['count']:<6} "
+        f"mean={summary['mean_ms']:8.2f}ms p50={summary['p50_ms']:8.2f}ms "
+        f"p95={summary['p95_ms']:8.2f}ms p99={summary['p99_ms']:8.2f}ms "
+        f"max={summary['max_ms']:8.2f}ms"
+    )
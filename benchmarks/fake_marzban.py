@@ -0,0 +1,454 @@
+"""
+Локальная заглушка Marzban API для нагрузочного тестирования.
+
+Реализует подмножество API панели (токен, пользователи, статистика, ноды, система)
+поверх состояния в памяти. Задержки, доля ошибок и время жизни токена
+настраиваются, поэтому пропускную способность бота можно мерить без
+обращения к боевой панели.
+
+Запуск:
+    python -m benchmarks.fake_marzban --port 7575 --latency uniform:0.02,0.08 --error-rate 0.01
+"""
+import argparse
+import logging
+import random
+import secrets
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Any
+
+import requests
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+logger = logging.getLogger('fake_marzban')
+
+DEFAULT_HOSTS = [
+    {"remark": "Marz", "address": "150.241.108.35"},
+    {"remark": "Marzban2", "address": "150.241.108.166"}
+]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    Разбор описания распределения задержки (в секундах).
+
+    Поддерживаемые форматы:
+        0.05 / const:0.05      - фиксированная задержка
+        uniform:0.01,0.1       - равномерное распределение
+        normal:0.05,0.01       - нормальное (mu, sigma), обрезается снизу нулем
+        lognormal:-3,0.5       - логнормальное (mu, sigma)
+        exp:0.05               - экспоненциальное со средним 0.05
+    """
+    spec = (spec or '0').strip()
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'const', kind
+    values = [float(p) for p in params.split(',') if p]
+
+    if kind == 'const':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(values[0], values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeMarzbanState:
+    def __init__(self, admin_username: str = 'admin', admin_password: str = 'admin',
+                 latency: str = '0', endpoint_latency: Optional[Dict[str, str]] = None,
+                 error_rate: float = 0.0, error_status: int = 500, token_ttl: float = 86400,
+                 hosts: Optional[List[Dict[str, str]]] = None, link_port: int = 443,
+                 webhook_address: Optional[str] = None, webhook_secret: str = ''):
+        self.admin_username = admin_username
+        self.admin_password = admin_password
+        self.latency = parse_latency(latency)
+        self.endpoint_latency = {
+            endpoint: parse_latency(spec)
+            for endpoint, spec in (endpoint_latency or {}).items()
+        }
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_ttl = token_ttl
+        self.hosts = hosts or DEFAULT_HOSTS
+        self.link_port = link_port
+        self.webhook_address = webhook_address
+        self.webhook_secret = webhook_secret
+
+        # Первый хост - сам мастер-сервер, остальные подключены как ноды
+        self.nodes = [
+            {"id": i, "name": host['remark'], "address": host['address'], "port": 62050,
+             "api_port": 62051, "usage_coefficient": 1.0, "xray_version": "1.8.4",
+             "status": "connected", "message": None}
+            for i, host in enumerate(self.hosts[1:], start=1)
+        ]
+
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self.tokens: Dict[str, float] = {}
+        self.stats: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def issue_token(self) -> str:
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def is_token_valid(self, token: str) -> bool:
+        with self.lock:
+            expires_at = self.tokens.get(token)
+            if expires_at is None:
+                return False
+            if expires_at < time.time():
+                del self.tokens[token]
+                return False
+            return True
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+    def delay_for(self, endpoint: str) -> float:
+        return self.endpoint_latency.get(endpoint, self.latency)()
+
+    def emit(self, action: str, user: Dict[str, Any]) -> None:
+        """Отправка события на вебхук бота (как WEBHOOK_ADDRESS в Marzban)."""
+        if not self.webhook_address:
+            return
+        event = {
+            "username": user['username'],
+            "action": action,
+            "user": {k: v for k, v in user.items() if not k.startswith('_')},
+            "by": {"username": self.admin_username},
+            "enqueued_at": time.time(),
+            "send_at": time.time(),
+            "tries": 0
+        }
+
+        def send():
+            try:
+                requests.post(self.webhook_address, json=[event],
+                              headers={"x-webhook-secret": self.webhook_secret}, timeout=5)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Webhook delivery failed: {e}")
+
+        threading.Thread(target=send, daemon=True).start()
+
+    def build_user(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание записи пользователя по телу запроса POST /api/user."""
+        proxies = data.get('proxies') or {"vless": {}}
+        proxies = {
+            protocol: {"id": str(uuid.uuid4()), **(settings or {})}
+            for protocol, settings in proxies.items()
+        }
+        hosts = []
+        for host_list in (data.get('hosts') or {}).values():
+            hosts.extend(host_list)
+
+        return {
+            "username": data['username'],
+            "proxies": proxies,
+            "expire": data.get('expire'),
+            "data_limit": data.get('data_limit') or 0,
+            "data_limit_reset_strategy": data.get('data_limit_reset_strategy', 'no_reset'),
+            "inbounds": data.get('inbounds') or {},
+            "note": data.get('note'),
+            "status": data.get('status', 'active'),
+            "used_traffic": 0,
+            "lifetime_used_traffic": 0,
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "online_at": None,
+            "_hosts": hosts or self.hosts
+        }
+
+    def refresh_status(self, user: Dict[str, Any]) -> None:
+        """Перевод пользователя в expired, как это делает фоновая задача Marzban."""
+        if user['status'] == 'active' and user['expire'] and user['expire'] < time.time():
+            user['status'] = 'expired'
+
+    def render_user(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        self.refresh_status(user)
+        payload = {k: v for k, v in user.items() if not k.startswith('_')}
+        vless_id = user['proxies'].get('vless', {}).get('id', '')
+        payload['links'] = [
+            f"vless://{vless_id}@{host['address']}:{self.link_port}"
+            f"?security=reality&type=tcp&headerType=&flow=&sni=www.google.com#{host['remark']}"
+            for host in user['_hosts']
+        ]
+        payload['subscription_url'] = f"/sub/{user['username']}"
+        return payload
+
+    def seed_users(self, count: int, status: str = 'active', prefix: str = 'seed') -> None:
+        """Быстрое наполнение панели пользователями для тестов больших выборок."""
+        expire = int(time.time()) + 30 * 86400
+        with self.lock:
+            for i in range(count):
+                username = f"{prefix}_{i}"
+                self.users[username] = self.build_user({
+                    "username": username,
+                    "expire": expire,
+                    "status": status
+                })
+
+
+def create_app(state: FakeMarzbanState) -> Flask:
+    app = Flask(__name__)
+
+    @app.before_request
+    def _inject_faults():
+        endpoint = request.endpoint or 'unknown'
+        if endpoint == 'fake_stats':
+            return None
+        state.count(endpoint)
+
+        delay = state.delay_for(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+
+        if state.error_rate and random.random() < state.error_rate:
+            return jsonify({"detail": "Injected error"}), state.error_status
+
+        if endpoint != 'admin_token':
+            auth = request.headers.get('Authorization', '')
+            token = auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+            if not state.is_token_valid(token):
+                return jsonify({"detail": "Could not validate credentials"}), 401
+        return None
+
+    def _not_found():
+        return jsonify({"detail": "User not found"}), 404
+
+    @app.route('/api/admin/token', methods=['POST'], endpoint='admin_token')
+    def admin_token():
+        if (request.form.get('username') != state.admin_username
+                or request.form.get('password') != state.admin_password):
+            return jsonify({"detail": "Incorrect username or password"}), 401
+        return jsonify({"access_token": state.issue_token(), "token_type": "bearer"})
+
+    @app.route('/api/user', methods=['POST'], endpoint='create_user')
+    def create_user():
+        data = request.get_json(force=True)
+        with state.lock:
+            if data.get('username') in state.users:
+                return jsonify({"detail": "User already exists"}), 409
+            user = state.build_user(data)
+            state.users[user['username']] = user
+            return jsonify(state.render_user(user))
+
+    @app.route('/api/user/<username>', methods=['GET'], endpoint='get_user')
+    def get_user(username):
+        with state.lock:
+            user = state.users.get(username)
+            if not user:
+                return _not_found()
+            return jsonify(state.render_user(user))
+
+    @app.route('/api/user/<username>', methods=['PUT'], endpoint='modify_user')
+    def modify_user(username):
+        data = request.get_json(force=True) or {}
+        with state.lock:
+            user = state.users.get(username)
+            if not user:
+                return _not_found()
+            previous_status = user['status']
+            for field in ('expire', 'data_limit', 'status', 'note', 'inbounds'):
+                if field in data:
+                    user[field] = data[field]
+            payload = state.render_user(user)
+        if user['status'] != previous_status:
+            state.emit(f"user_{'enabled' if user['status'] == 'active' else user['status']}", user)
+        return jsonify(payload)
+
+    @app.route('/api/user/<username>', methods=['DELETE'], endpoint='delete_user')
+    def delete_user(username):
+        with state.lock:
+            user = state.users.pop(username, None)
+            if user is None:
+                return _not_found()
+        state.emit('user_deleted', user)
+        return jsonify({"detail": "User successfully deleted"})
+
+    @app.route('/api/user/<username>/reset', methods=['POST'], endpoint='reset_user')
+    def reset_user(username):
+        with state.lock:
+            user = state.users.get(username)
+            if not user:
+                return _not_found()
+            user['used_traffic'] = 0
+            return jsonify(state.render_user(user))
+
+    @app.route('/api/user/<username>/usage', methods=['GET'], endpoint='user_usage')
+    def user_usage(username):
+        with state.lock:
+            user = state.users.get(username)
+            if not user:
+                return _not_found()
+            return jsonify({
+                "username": username,
+                "usages": [{"node_id": None, "node_name": "Master", "used_traffic": user['used_traffic']}]
+            })
+
+    @app.route('/api/users', methods=['GET'], endpoint='list_users')
+    def list_users():
+        offset = request.args.get('offset', default=0, type=int)
+        limit = request.args.get('limit', type=int)
+        status = request.args.get('status')
+        usernames = set(request.args.getlist('username'))
+
+        with state.lock:
+            matched = []
+            for user in state.users.values():
+                state.refresh_status(user)
+                if status and user['status'] != status:
+                    continue
+                if usernames and user['username'] not in usernames:
+                    continue
+                matched.append(user)
+            page = matched[offset:offset + limit if limit is not None else None]
+            return jsonify({
+                "users": [state.render_user(user) for user in page],
+                "total": len(matched)
+            })
+
+    @app.route('/api/users/expired', methods=['DELETE'], endpoint='delete_expired')
+    def delete_expired():
+        before = request.args.get('expired_before')
+        after = request.args.get('expired_after')
+        before_ts = datetime.fromisoformat(before).timestamp() if before else time.time()
+        after_ts = datetime.fromisoformat(after).timestamp() if after else 0
+
+        with state.lock:
+            removed = []
+            for username, user in list(state.users.items()):
+                state.refresh_status(user)
+                if user['status'] in ('expired', 'limited') and after_ts <= (user['expire'] or 0) <= before_ts:
+                    removed.append(username)
+                    del state.users[username]
+        if not removed:
+            return jsonify({"detail": "No expired users found in the specified date range"}), 404
+        return jsonify(removed)
+
+    @app.route('/api/system', methods=['GET'], endpoint='system')
+    def system():
+        with state.lock:
+            for user in state.users.values():
+                state.refresh_status(user)
+            active = sum(1 for user in state.users.values() if user['status'] == 'active')
+            return jsonify({
+                "version": "0.0.0-fake",
+                "mem_total": 2 * 1024 ** 3,
+                "mem_used": 1024 ** 3,
+                "cpu_cores": 2,
+                "cpu_usage": round(random.uniform(5, 40), 1),
+                "total_user": len(state.users),
+                "users_active": active,
+                "incoming_bandwidth": 0,
+                "outgoing_bandwidth": 0,
+                "incoming_bandwidth_speed": 0,
+                "outgoing_bandwidth_speed": 0
+            })
+
+    @app.route('/api/nodes', methods=['GET'], endpoint='nodes')
+    def nodes():
+        return jsonify(state.nodes)
+
+    @app.route('/api/nodes/usage', methods=['GET'], endpoint='nodes_usage')
+    def nodes_usage():
+        try:
+            start = datetime.fromisoformat(request.args['start'])
+            end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else datetime.now(timezone.utc)
+            # Клиент передает время в UTC; наивные значения считаем UTC, чтобы не смешивать с aware
+            start, end = (value if value.tzinfo else value.replace(tzinfo=timezone.utc) for value in (start, end))
+        except (KeyError, ValueError):
+            return jsonify({"detail": "Invalid date range"}), 400
+        seconds = max((end - start).total_seconds(), 0)
+        usages = [{"node_id": None, "node_name": "Master"}]
+        usages += [{"node_id": node['id'], "node_name": node['name']} for node in state.nodes]
+        for usage in usages:
+            # Случайная скорость 1-10 МБ/с в каждую сторону
+            usage['uplink'] = int(random.uniform(1, 10) * 1024 ** 2 * seconds)
+            usage['downlink'] = int(random.uniform(1, 10) * 1024 ** 2 * seconds)
+        return jsonify({"usages": usages})
+
+    @app.route('/_fake/stats', methods=['GET'], endpoint='fake_stats')
+    def fake_stats():
+        with state.lock:
+            return jsonify({"requests": dict(state.stats), "users": len(state.users)})
+
+    return app
+
+
+class FakeMarzbanServer:
+    """Заглушка Marzban в фоновом потоке (для бенчмарков в одном процессе)."""
+
+    def __init__(self, state: Optional[FakeMarzbanState] = None, host: str = '127.0.0.1', port: int = 0):
+        self.state = state or FakeMarzbanState()
+        self._server = make_server(host, port, create_app(self.state), threaded=True)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._server.host}:{self._server.port}"
+
+    def start(self) -> 'FakeMarzbanServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeMarzban", daemon=True)
+        self._thread.start()
+        logger.info(f"Fake Marzban listening on {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def __enter__(self) -> 'FakeMarzbanServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Marzban API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7575)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--latency', default='0', help="e.g. const:0.05, uniform:0.01,0.1, lognormal:-3,0.5")
+    parser.add_argument('--endpoint-latency', action='append', default=[],
+                        help="per-endpoint override, e.g. get_user=exp:0.2 (repeatable)")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--token-ttl', type=float, default=86400, help="token lifetime in seconds")
+    parser.add_argument('--seed-users', type=int, default=0)
+    parser.add_argument('--webhook-address', help="bot endpoint for user events, e.g. http://127.0.0.1:8080/marzban-webhook")
+    parser.add_argument('--webhook-secret', default='')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    state = FakeMarzbanState(
+        admin_username=args.username,
+        admin_password=args.password,
+        latency=args.latency,
+        endpoint_latency=dict(item.split('=', 1) for item in args.endpoint_latency),
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        token_ttl=args.token_ttl,
+        webhook_address=args.webhook_address,
+        webhook_secret=args.webhook_secret
+    )
+    if args.seed_users:
+        state.seed_users(args.seed_users)
+
+    create_app(state).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,14 +11,25 @@ from config.settings import (
 )
 import schedule
 from services.node_manager import NodeManager
+from services.marzban_cluster import MarzbanCluster
+from services.node_telemetry import NodeTelemetryCollector
+from services.node_prober import NodeLatencyProber
+from services.rebalancer import NodeRebalancer
+from services.health_checker import IncrementalHealthChecker
 import time
 from services.device_service import DeviceService
+from services.user_pool import MarzbanUserPool
+from services.marzban_scheduler import MarzbanRequestScheduler
 from config.settings import (
     TOKEN,
     DB_NAME,
     MARZBAN_HOST,
     MARZBAN_USERNAME,
-    MARZBAN_PASSWORD
+    MARZBAN_PASSWORD,
+    MARZBAN_WEBHOOK_SECRET,
+    MARZBAN_RECONCILE_INTERVAL,
+    REBALANCE_INTERVAL,
+    EXPIRY_RECONCILE_INTERVAL
 )
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -35,8 +46,11 @@ from handlers.command_handler import CommandHandler
 from handlers.callback_handler import CallbackHandler
 from services.backup_service import BackupService
 from services.notification_service import NotificationService
+from services.notification_dispatcher import NotificationDispatcher
+from services.expiry_scheduler import ExpiryScheduler
 from services.payment_service import PaymentService
 from services.qr_service import QRService
+from services.media_cache import MediaCache
 from utils.network import check_network_connectivity, test_telegram_api
 from utils.rate_limiter import RateLimiter
 from utils.helpers import setup_logger, print_fancy_header
@@ -48,6 +62,7 @@ logger = setup_logger(__name__)
 # Инициализация Flask для вебхуков
 app = Flask(__name__)
 payment_service = None
+device_service = None
 
 
 @app.route('/payment-notification', methods=['POST'])
@@ -85,6 +100,44 @@ def payment_notification():
         logger.error(f"Error processing webhook: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/marzban-webhook', methods=['POST'])
+def marzban_webhook():
+    """Приём событий пользователей от Marzban (WEBHOOK_ADDRESS панели)."""
+    try:
+        secret = request.headers.get('x-webhook-secret', '')
+        if not MARZBAN_WEBHOOK_SECRET or not hmac.compare_digest(secret, MARZBAN_WEBHOOK_SECRET):
+            logger.error("Invalid Marzban webhook secret")
+            return jsonify({'error': 'Invalid secret'}), 403
+
+        events = request.get_json(silent=True)
+        if isinstance(events, dict):
+            events = [events]
+        if not isinstance(events, list):
+            return jsonify({'error': 'Invalid payload'}), 400
+
+        processed = device_service.handle_marzban_events(events)
+        logger.info(f"Marzban webhook: {len(events)} events, {processed} devices deactivated")
+        return jsonify({'success': True, 'processed': processed}), 200
+
+    except Exception as e:
+        logger.error(f"Error processing Marzban webhook: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/sub/<token>', methods=['GET'])
+@app.route('/sub/<token>/<fmt>', methods=['GET'])
+def subscription(token, fmt='subscription'):
+    """Подписка устройства для автообновления в VPN-клиентах."""
+    try:
+        status, body, headers = device_service.subscription.serve(
+            token, fmt, request.headers.get('If-None-Match')
+        )
+        return body, status, headers
+    except Exception as e:
+        logger.error(f"Error serving subscription: {e}", exc_info=True)
+        return 'Internal error', 500
+
+
 def verify_webhook_signature(signature: str, body: str) -> bool:
     """Verify YooKassa webhook signature."""
     try:
@@ -116,41 +169,86 @@ class VPNBot:
         self.bot = telebot.TeleBot(TOKEN)
         self.db_manager = DatabaseManager(DB_NAME)
         self.backup_service = BackupService(DB_NAME)
-        self.notification_service = NotificationService(self.bot, self.db_manager)
         self.qr_service = QRService()
+        # file_id загруженных в Telegram QR-кодов, анимаций и документов
+        self.media_cache = MediaCache(self.bot, self.db_manager)
         self.rate_limiter = RateLimiter()
         self.payment_service = PaymentService(self.db_manager)
         self.backup_service.setup_auto_cleanup(max_backups=5)
-        self.node_manager = NodeManager()
-        self.marzban_service = MarzbanService(
-            host=MARZBAN_HOST,
-            username=MARZBAN_USERNAME,
-            password=MARZBAN_PASSWORD,
-            node_manager=self.node_manager  # Добавляем node_manager
+        self.node_manager = NodeManager(db_manager=self.db_manager)
+        # Пользовательские запросы к Marzban обслуживаются раньше фоновых
+        self.marzban_scheduler = MarzbanRequestScheduler()
+        # Пользователи распределены по панелям Marzban (MARZBAN_PANELS)
+        self.marzban_service = MarzbanCluster(
+            node_manager=self.node_manager,  # Добавляем node_manager
+            db_manager=self.db_manager,
+            scheduler=self.marzban_scheduler
+        )
+        self.node_telemetry = NodeTelemetryCollector(
+            node_manager=self.node_manager,
+            marzban_service=self.marzban_service,
+            db_manager=self.db_manager
+        )
+        self.node_prober = NodeLatencyProber(self.node_manager)
+        # Все уведомления пользователям идут через общую очередь с лимитами Telegram
+        self.notification_dispatcher = NotificationDispatcher(self.bot, self.db_manager)
+        self.notification_service = NotificationService(
+            self.bot, self.db_manager, self.marzban_service, self.notification_dispatcher
         )
+        # Деактивация и предупреждения точно в срок вместо ежечасного просмотра БД
+        self.expiry_scheduler = ExpiryScheduler(self.db_manager, self.notification_service)
         # Устанавливаем payment_service для вебхук-сервера
         global payment_service
         payment_service = self.payment_service
 
+        # Пул заранее созданных пользователей Marzban
+        self.user_pool = MarzbanUserPool(
+            db_manager=self.db_manager,
+            marzban_service=self.marzban_service
+        )
+
         # Передаем marzban_service в DeviceService
         self.device_service = DeviceService(
             db_manager=self.db_manager,
             marzban_service=self.marzban_service,
-            bot=self.bot
+            bot=self.bot,
+            user_pool=self.user_pool,
+            qr_service=self.qr_service,
+            dispatcher=self.notification_dispatcher
         )
+        self.rebalancer = NodeRebalancer(
+            db_manager=self.db_manager,
+            node_manager=self.node_manager,
+            marzban_service=self.marzban_service,
+            dispatcher=self.notification_dispatcher
+        )
+        # При настроенном вебхуке Marzban опрос панели - только страховочная сверка
+        self.health_checker = IncrementalHealthChecker(
+            db_manager=self.db_manager,
+            device_service=self.device_service,
+            interval=MARZBAN_RECONCILE_INTERVAL if MARZBAN_WEBHOOK_SECRET else 1
+        )
+        # Устанавливаем device_service для вебхука Marzban
+        global device_service
+        device_service = self.device_service
 
         # Инициализация обработчиков
         self.command_handler = CommandHandler(
             bot=self.bot,
             db_manager=self.db_manager,
-            node_manager=self.node_manager  # Добавляем node_manager
+            node_manager=self.node_manager,  # Добавляем node_manager
+            marzban_service=self.marzban_service,
+            device_service=self.device_service
         )
         self.callback_handler = CallbackHandler(
             bot=self.bot,
             db_manager=self.db_manager,
             qr_service=self.qr_service,
             rate_limiter=self.rate_limiter,
-            node_manager=self.node_manager  # Добавляем node_manager
+            node_manager=self.node_manager,  # Добавляем node_manager
+            marzban_service=self.marzban_service,
+            device_service=self.device_service,
+            media_cache=self.media_cache
         )
 
     def setup(self):
@@ -179,6 +277,13 @@ class VPNBot:
             logger.info("Starting schedulers...")
             self.backup_service.schedule_backups()
             self.notification_service.schedule_balance_checks()
+            self.marzban_scheduler.start()
+            self.user_pool.start()
+            self.node_telemetry.start()
+            self.node_prober.start()
+            self.qr_service.start()
+            self.notification_dispatcher.start()
+            self.expiry_scheduler.start()
 
             # Добавляем проверку конфигов каждые 5 минут
             #schedule.every(5).minutes.do(
@@ -191,14 +296,24 @@ class VPNBot:
             self.callback_handler.register_handlers()
 
             # Добавляем периодические проверки
-            schedule.every(1).hours.do(
-                self.notification_service.check_device_expiration
+            schedule.every(EXPIRY_RECONCILE_INTERVAL).hours.do(
+                self.expiry_scheduler.reconcile
             )
             schedule.every(6).hours.do(
                 self.notification_service.check_marzban_configs
             )
-            schedule.every(1).minutes.do(
-                self.device_service.check_deactivated_configs
+            schedule.every(10).minutes.do(
+                self.device_service.provisioning.release_stale_reservations
+            )
+            schedule.every(1).hours.do(
+                self.qr_service.cleanup_cache
+            )
+            schedule.every(REBALANCE_INTERVAL).minutes.do(
+                self.rebalancer.run_step
+            )
+            # Сверка с Marzban срезами в пределах бюджета времени
+            schedule.every(self.health_checker.interval).minutes.do(
+                self.health_checker.run_tick
             )
 
             # Запускаем планировщик в отдельном потоке
@@ -243,6 +358,9 @@ class VPNBot:
             logger.error(f"❌ Critical error: {e}", exc_info=True)
         finally:
             # Создаем финальный бэкап перед выключением
+            self.qr_service.shutdown()
+            self.expiry_scheduler.stop()
+            self.notification_dispatcher.stop()
             logger.info("Creating final backup...")
             self.backup_service.create_backup()
             logger.info("👋 Bot stopped")
@@ -1,4 +1,5 @@
 import os
+import json
 from typing import List, Dict
 
 # Bot Configuration
@@ -10,6 +11,144 @@ BOT_USERNAME = "VangVPN_bot"
 MARZBAN_HOST = os.getenv('MARZBAN_HOST', 'http://150.241.108.35:7575')
 MARZBAN_USERNAME = os.getenv('MARZBAN_USERNAME', 'admin')
 MARZBAN_PASSWORD = os.getenv('MARZBAN_PASSWORD', 'JmnutmenfBp7')
+# Панели Marzban для шардирования пользователей (JSON-список в MARZBAN_PANELS):
+# name, host, username, password, weight, max_users (0 - без лимита)
+MARZBAN_PANELS = json.loads(os.getenv('MARZBAN_PANELS', 'null')) or [
+    {"name": "main", "host": MARZBAN_HOST, "username": MARZBAN_USERNAME,
+     "password": MARZBAN_PASSWORD, "weight": 1, "max_users": 0}
+]
+MARZBAN_USERS_PAGE_SIZE = int(os.getenv('MARZBAN_USERS_PAGE_SIZE', '500'))
+
+# Ограничение исходящих запросов к Marzban (запросов в секунду / размер всплеска)
+MARZBAN_INTERACTIVE_RPS = float(os.getenv('MARZBAN_INTERACTIVE_RPS', '10'))
+MARZBAN_INTERACTIVE_BURST = int(os.getenv('MARZBAN_INTERACTIVE_BURST', '20'))
+MARZBAN_BACKGROUND_RPS = float(os.getenv('MARZBAN_BACKGROUND_RPS', '2'))
+MARZBAN_BACKGROUND_BURST = int(os.getenv('MARZBAN_BACKGROUND_BURST', '5'))
+
+# Приоритетный планировщик запросов к Marzban
+MARZBAN_SCHEDULER_WORKERS = int(os.getenv('MARZBAN_SCHEDULER_WORKERS', '8'))
+MARZBAN_SCHEDULER_MAX_QUEUE = int(os.getenv('MARZBAN_SCHEDULER_MAX_QUEUE', '1000'))
+MARZBAN_SCHEDULER_AGING = float(os.getenv('MARZBAN_SCHEDULER_AGING', '2.0'))  # секунд ожидания на уровень приоритета
+
+# Параллельность пакетного удаления пользователей Marzban
+MARZBAN_BULK_DELETE_CONCURRENCY = int(os.getenv('MARZBAN_BULK_DELETE_CONCURRENCY', '8'))
+
+# Телеметрия нод: период опроса (сек), коэффициент EWMA, порог устаревания (сек)
+NODE_TELEMETRY_INTERVAL = int(os.getenv('NODE_TELEMETRY_INTERVAL', '60'))
+NODE_TELEMETRY_ALPHA = float(os.getenv('NODE_TELEMETRY_ALPHA', '0.3'))
+NODE_TELEMETRY_STALE_AFTER = int(os.getenv('NODE_TELEMETRY_STALE_AFTER', '300'))
+
+# Активная проверка доступности нод (TCP connect): период и таймаут (сек),
+# число параллельных проверок, размер окна замеров, порог подряд неудачных проверок
+NODE_PROBE_INTERVAL = int(os.getenv('NODE_PROBE_INTERVAL', '15'))
+NODE_PROBE_TIMEOUT = float(os.getenv('NODE_PROBE_TIMEOUT', '3'))
+NODE_PROBE_CONCURRENCY = int(os.getenv('NODE_PROBE_CONCURRENCY', '16'))
+NODE_PROBE_WINDOW = int(os.getenv('NODE_PROBE_WINDOW', '100'))
+NODE_PROBE_FAILURE_THRESHOLD = int(os.getenv('NODE_PROBE_FAILURE_THRESHOLD', '3'))
+NODE_PROBE_PORTS = [int(port) for port in os.getenv('NODE_PROBE_PORTS', '443').split(',') if port]
+
+# Перераспределение устройств с перегруженных нод: период (мин), допустимое
+# превышение справедливой доли (доля), переносов за шаг, пауза до повторного переноса (часы)
+REBALANCE_INTERVAL = int(os.getenv('REBALANCE_INTERVAL', '30'))
+REBALANCE_TOLERANCE = float(os.getenv('REBALANCE_TOLERANCE', '0.2'))
+REBALANCE_BATCH_SIZE = int(os.getenv('REBALANCE_BATCH_SIZE', '50'))
+REBALANCE_COOLDOWN_HOURS = int(os.getenv('REBALANCE_COOLDOWN_HOURS', '24'))
+
+# Резерв средств под создание устройства, не завершенный за это время (сек), возвращается
+PROVISIONING_RESERVATION_TIMEOUT = int(os.getenv('PROVISIONING_RESERVATION_TIMEOUT', '600'))
+
+# Инкрементальная сверка устройств с Marzban: бюджет времени на запуск (сек), размер пакета,
+# минимальный интервал повторной сверки (мин), максимальный возраст сверки (мин),
+# окно риска для новых и истекающих устройств (часы)
+HEALTH_CHECK_TIME_BUDGET = float(os.getenv('HEALTH_CHECK_TIME_BUDGET', '20'))
+HEALTH_CHECK_BATCH_SIZE = int(os.getenv('HEALTH_CHECK_BATCH_SIZE', '200'))
+HEALTH_CHECK_MIN_RECHECK = int(os.getenv('HEALTH_CHECK_MIN_RECHECK', '10'))
+HEALTH_CHECK_MAX_STALENESS = int(os.getenv('HEALTH_CHECK_MAX_STALENESS', '60'))
+HEALTH_CHECK_RISK_WINDOW = int(os.getenv('HEALTH_CHECK_RISK_WINDOW', '24'))
+
+# Страховочная перезагрузка сроков устройств из БД (часы): ловит сроки,
+# записанные в обход DatabaseManager, и перезапускает упавший поток
+EXPIRY_RECONCILE_INTERVAL = int(os.getenv('EXPIRY_RECONCILE_INTERVAL', '24'))
+
+# Кэш PNG с QR-кодами: предел памяти (байты) и время жизни (сек)
+QR_CACHE_MAX_BYTES = int(os.getenv('QR_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+QR_CACHE_TTL = int(os.getenv('QR_CACHE_TTL', '3600'))
+
+# Отрисовка QR-кодов: process - в пуле процессов, inline - в потоке обработчика;
+# число процессов, предел ожидающих задач, таймаут ожидания и отрисовки (сек)
+QR_RENDER_BACKEND = os.getenv('QR_RENDER_BACKEND', 'process')
+QR_RENDER_WORKERS = int(os.getenv('QR_RENDER_WORKERS', '2'))
+QR_RENDER_MAX_PENDING = int(os.getenv('QR_RENDER_MAX_PENDING', '32'))
+QR_RENDER_TIMEOUT = float(os.getenv('QR_RENDER_TIMEOUT', '5'))
+
+# Вид QR-кодов: compact - 1-битный PNG примерно QR_TARGET_SIZE пикселей с уровнем коррекции
+# по длине данных (самый сильный, при котором версия не больше QR_MAX_VERSION), classic - прежний
+QR_RENDER_MODE = os.getenv('QR_RENDER_MODE', 'compact')
+QR_TARGET_SIZE = int(os.getenv('QR_TARGET_SIZE', '512'))
+QR_MAX_VERSION = int(os.getenv('QR_MAX_VERSION', '10'))
+
+# Анимация к сообщению о пополнении баланса: локальный файл (загружается один раз,
+# дальше отправляется по file_id) и ссылка на случай, если файла нет
+BALANCE_ANIMATION_PATH = os.getenv(
+    'BALANCE_ANIMATION_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'balance.gif')
+)
+BALANCE_ANIMATION_URL = "https://i.giphy.com/media/v1.Y2lkPTc5MGI3NjExOW9rMWU2MTRybG4yYTJ5ajI2eDI4YzRjNjZpMHNwam55OXJzcDh2bCZlcD12MV9pbnRlcm5hbF9naWZfYnlfaWQmY3Q9Zw/40KHD3lKSZC4FNysxY/giphy.gif"
+
+# Рассылка уведомлений: общий темп (сообщений/сек), темп на один чат,
+# число потоков отправки, повторов при временных ошибках
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '30'))
+NOTIFY_PER_CHAT_RATE = float(os.getenv('NOTIFY_PER_CHAT_RATE', '1'))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '4'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '5'))
+
+# Число файлов конфигураций (устройство + формат), хранимых в памяти
+CONFIG_RENDER_CACHE_SIZE = int(os.getenv('CONFIG_RENDER_CACHE_SIZE', '2000'))
+
+# Подписка устройств по HTTP: публичный адрес вебхук-сервера (пусто - ссылки не выдаются),
+# секрет подписи ссылок (пусто - выводится из токена бота), max-age ответа (сек),
+# интервал автообновления профиля в клиентах (часы)
+SUBSCRIPTION_BASE_URL = os.getenv('SUBSCRIPTION_BASE_URL', '')
+SUBSCRIPTION_SECRET = os.getenv('SUBSCRIPTION_SECRET', '')
+SUBSCRIPTION_CACHE_MAX_AGE = int(os.getenv('SUBSCRIPTION_CACHE_MAX_AGE', '3600'))
+SUBSCRIPTION_UPDATE_INTERVAL = int(os.getenv('SUBSCRIPTION_UPDATE_INTERVAL', '12'))
+
+# Вебхук Marzban (WEBHOOK_ADDRESS / WEBHOOK_SECRET в настройках панели)
+MARZBAN_WEBHOOK_SECRET = os.getenv('MARZBAN_WEBHOOK_SECRET', '')
+# Страховочная сверка статусов с панелью (минуты), пока вебхук настроен
+MARZBAN_RECONCILE_INTERVAL = int(os.getenv('MARZBAN_RECONCILE_INTERVAL', '30'))
+
+# Ноды VPN (можно переопределить JSON-списком в VPN_NODES):
+# host - API ноды, address - IP в ссылках, remark - имя хоста в Marzban,
+# weight - относительная емкость, max_users - лимит устройств (0 - без лимита)
+VPN_NODES = json.loads(os.getenv('VPN_NODES', 'null')) or [
+    {"name": "Master", "host": "http://150.241.108.35:7575", "address": "150.241.108.35",
+     "remark": "Marz", "weight": 1, "max_users": 2},
+    {"name": "Marzban2", "host": "http://150.241.108.166:62051", "address": "150.241.108.166",
+     "remark": "Marzban2", "weight": 1, "max_users": 2}
+]
+
+# Балансировка новых устройств: least_loaded, weighted, power_of_two, capacity_capped
+NODE_BALANCING_STRATEGY = os.getenv('NODE_BALANCING_STRATEGY', 'least_loaded')
+NODE_LOAD_CACHE_TTL = float(os.getenv('NODE_LOAD_CACHE_TTL', '30'))  # секунды
+
+# Шаблоны создаваемых пользователей Marzban
+MARZBAN_USER_TEMPLATES = {
+    "vless_reality": {
+        "proxies": {"vless": {"flow": ""}},
+        "inbounds": {"vless": ["VLESS TCP REALITY"]},
+        "hosts": {
+            "VLESS TCP REALITY": [
+                {"remark": node["remark"], "address": node["address"]} for node in VPN_NODES
+            ]
+        }
+    }
+}
+MARZBAN_DEFAULT_TEMPLATE = "vless_reality"
+
+# Пул заранее созданных (отключенных) пользователей Marzban
+MARZBAN_POOL_TARGET_SIZE = int(os.getenv('MARZBAN_POOL_TARGET_SIZE', '5'))
+MARZBAN_POOL_REFILL_INTERVAL = int(os.getenv('MARZBAN_POOL_REFILL_INTERVAL', '300'))  # секунды
 MARZBAN_PROTOCOLS = {
     "IOS": {"vmess": True, "vless": True, "trojan": False, "shadowsocks": False},
     "Android": {"vmess": True, "vless": True, "trojan": True, "shadowsocks": True},
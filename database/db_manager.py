@@ -1,21 +1,39 @@
 import sqlite3
 import json
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any, Set, Tuple
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 import logging
-from config.settings import DB_NAME
-from .models import User, Device, Transaction, Plan, DB_SCHEMA
+from config.settings import DB_NAME, VPN_NODES
+from .models import User, Device, Transaction, Plan, DB_SCHEMA, SCHEMA_MIGRATIONS, MIGRATED_INDEXES
 logger = logging.getLogger(__name__)
 
 class DatabaseManager:
     def __init__(self, db_name: str = DB_NAME):
         self.db_name = db_name
+        # Подписчики на изменение срока устройства: (device_id, expires_at или None при деактивации)
+        self._expiry_listeners: List[Callable[[int, Optional[datetime]], None]] = []
         self._initialize_database()
 
+    def add_expiry_listener(self, listener: Callable[[int, Optional[datetime]], None]) -> None:
+        self._expiry_listeners.append(listener)
+
+    def _notify_expiry_changed(self, device_id: int, expires_at: Optional[datetime]) -> None:
+        for listener in self._expiry_listeners:
+            try:
+                listener(device_id, expires_at)
+            except Exception as e:
+                logger.error(f"Error in expiry listener: {e}")
+
     def _initialize_database(self) -> None:
         with self.get_connection() as conn:
             conn.executescript(DB_SCHEMA)
+            # Базы, созданные до появления колонок, дополняем
+            for table, column, definition in SCHEMA_MIGRATIONS:
+                columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            conn.executescript(MIGRATED_INDEXES)
 
     @contextmanager
     def get_connection(self):
@@ -88,8 +106,8 @@ class DatabaseManager:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO devices 
-                (telegram_id, device_type, config_data, created_at, expires_at, marzban_username, server_ip)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                (telegram_id, device_type, config_data, created_at, expires_at, marzban_username, server_ip, panel)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """, (
                 device.telegram_id,
                 device.device_type,
@@ -97,10 +115,108 @@ class DatabaseManager:
                 device.created_at,
                 device.expires_at,
                 device.marzban_username,
-                device.server_ip
+                device.server_ip,
+                device.panel
             ))
+            device_id = cursor.lastrowid
+        self._notify_expiry_changed(device_id, device.expires_at)
+        return device_id
+
+    def reserve_funds(self, telegram_id: int, amount: float) -> Optional[int]:
+        """
+        Атомарное списание суммы под создание устройства.
+        Возвращает id резерва или None, если баланса недостаточно.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                UPDATE users 
+                SET balance = balance - ? 
+                WHERE telegram_id = ? AND balance >= ?
+            """, (amount, telegram_id, amount))
+            if not cursor.rowcount:
+                return None
+            now = datetime.now()
+            cursor.execute("""
+                INSERT INTO device_reservations (telegram_id, amount, status, created_at, updated_at)
+                VALUES (?, ?, 'reserved', ?, ?)
+            """, (telegram_id, amount, now, now))
             return cursor.lastrowid
 
+    def set_reservation_user(self, reservation_id: int, marzban_username: str) -> None:
+        """Привязка пользователя Marzban к резерву (для отката после сбоя)."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE device_reservations 
+                SET marzban_username = ?, updated_at = ?
+                WHERE id = ?
+            """, (marzban_username, datetime.now(), reservation_id))
+
+    def commit_reservation(self, reservation_id: int, device: Device) -> Optional[int]:
+        """
+        Добавление устройства и закрытие резерва одной транзакцией.
+        Возвращает id устройства или None, если резерв уже отменен.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                UPDATE device_reservations 
+                SET status = 'committed', updated_at = ?
+                WHERE id = ? AND status = 'reserved'
+            """, (datetime.now(), reservation_id))
+            if not cursor.rowcount:
+                return None
+            cursor.execute("""
+                INSERT INTO devices 
+                (telegram_id, device_type, config_data, created_at, expires_at, marzban_username, server_ip, panel)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                device.telegram_id,
+                device.device_type,
+                device.config_data,
+                device.created_at,
+                device.expires_at,
+                device.marzban_username,
+                device.server_ip,
+                device.panel
+            ))
+            device_id = cursor.lastrowid
+            cursor.execute("UPDATE device_reservations SET device_id = ? WHERE id = ?", (device_id, reservation_id))
+        self._notify_expiry_changed(device_id, device.expires_at)
+        return device_id
+
+    def release_reservation(self, reservation_id: int) -> bool:
+        """Возврат средств по незавершенному резерву одной транзакцией."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                UPDATE device_reservations 
+                SET status = 'released', updated_at = ?
+                WHERE id = ? AND status = 'reserved'
+            """, (datetime.now(), reservation_id))
+            if not cursor.rowcount:
+                return False
+            cursor.execute("""
+                UPDATE users 
+                SET balance = balance + (SELECT amount FROM device_reservations WHERE id = ?)
+                WHERE telegram_id = (SELECT telegram_id FROM device_reservations WHERE id = ?)
+            """, (reservation_id, reservation_id))
+            return True
+
+    def get_stale_reservations(self, created_before: datetime) -> List[Dict[str, Any]]:
+        """Резервы, зависшие после сбоя процесса."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM device_reservations 
+                WHERE status = 'reserved' AND created_at < ?
+            """, (created_before,))
+            return [dict(row) for row in cursor.fetchall()]
+
     def add_transaction(self, transaction: Transaction) -> int:
         with self.get_connection() as conn:
             cursor = conn.cursor()
@@ -469,11 +585,134 @@ class DatabaseManager:
                     SET expires_at = ? 
                     WHERE id = ?
                 """, (new_expiry, device_id))
-                return True
+            self._notify_expiry_changed(device_id, new_expiry)
+            return True
         except Exception as e:
             logger.error(f"Error updating device expiry: {e}")
             return False
 
+    def get_expired_active_devices(self, now: datetime) -> List[Device]:
+        """Активные устройства с истекшим сроком действия."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM devices 
+                WHERE is_active = 1 AND expires_at IS NOT NULL AND expires_at <= ?
+            """, (now,))
+            return [Device(**dict(row)) for row in cursor.fetchall()]
+
+    def get_devices_expiring_between(self, start: datetime, end: datetime) -> List[Device]:
+        """Активные устройства, срок которых истекает в интервале (start, end]."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM devices 
+                WHERE is_active = 1 AND expires_at > ? AND expires_at <= ?
+            """, (start, end))
+            return [Device(**dict(row)) for row in cursor.fetchall()]
+
+    def get_devices_to_check(self, limit: int, checked_before: datetime, overdue_before: datetime,
+                             recent_after: datetime, expiring_before: datetime) -> List[Device]:
+        """
+        Очередной срез устройств для сверки с Marzban.
+
+        Устройства, сверенные после checked_before, пропускаются. Порядок:
+        просроченные (не сверялись с overdue_before или никогда), отмеченные
+        событием после последней сверки, недавно созданные, скоро истекающие,
+        остальные - по давности последней сверки.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM devices
+                WHERE is_active = 1 AND (last_checked_at IS NULL OR last_checked_at < ?)
+                ORDER BY
+                    CASE
+                        WHEN last_checked_at IS NULL OR last_checked_at < ? THEN 0
+                        WHEN health_flagged_at > last_checked_at THEN 1
+                        WHEN created_at > ? THEN 2
+                        WHEN expires_at < ? THEN 3
+                        ELSE 4
+                    END,
+                    last_checked_at
+                LIMIT ?
+            """, (checked_before, overdue_before, recent_after, expiring_before, limit))
+            return [Device(**dict(row)) for row in cursor.fetchall()]
+
+    def mark_devices_checked(self, device_ids: List[int], checked_at: datetime) -> None:
+        """Сдвиг курсора сверки для устройств."""
+        with self.get_connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                conn.execute(f"""
+                    UPDATE devices SET last_checked_at = ?
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                """, [checked_at, *chunk])
+
+    def flag_device_for_check(self, marzban_username: str, flagged_at: datetime) -> bool:
+        """Отметка устройства для внеочередной сверки."""
+        with self.get_connection() as conn:
+            cursor = conn.execute("""
+                UPDATE devices SET health_flagged_at = ?
+                WHERE marzban_username = ? AND is_active = 1
+            """, (flagged_at, marzban_username))
+            return cursor.rowcount > 0
+
+    def get_check_coverage(self, covered_after: datetime) -> Dict[str, Any]:
+        """Покрытие сверкой: всего активных, сверенных после covered_after, не сверенных ни разу."""
+        with self.get_connection() as conn:
+            row = conn.execute("""
+                SELECT COUNT(*) AS active,
+                       COALESCE(SUM(last_checked_at >= ?), 0) AS covered,
+                       COALESCE(SUM(last_checked_at IS NULL), 0) AS never_checked,
+                       MIN(last_checked_at) AS oldest_checked_at
+                FROM devices WHERE is_active = 1
+            """, (covered_after,)).fetchone()
+            return dict(row)
+
+    def deactivate_devices(self, device_ids: List[int]) -> int:
+        """Пакетная деактивация устройств одной транзакцией."""
+        if not device_ids:
+            return 0
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                updated = 0
+                # Ограничение SQLite на число параметров в запросе
+                for i in range(0, len(device_ids), 500):
+                    chunk = device_ids[i:i + 500]
+                    cursor.execute(f"""
+                        UPDATE devices 
+                        SET is_active = 0
+                        WHERE is_active = 1 AND id IN ({','.join('?' * len(chunk))})
+                    """, chunk)
+                    updated += cursor.rowcount
+            for device_id in device_ids:
+                self._notify_expiry_changed(device_id, None)
+            return updated
+        except Exception as e:
+            logger.error(f"Error deactivating devices: {e}")
+            return 0
+
+    def reactivate_devices(self, device_ids: List[int], notify: bool = True) -> None:
+        """
+        Возврат устройств в активные, если удалить пользователя в Marzban не удалось.
+        notify=False - не сообщать подписчикам на сроки (повтор планирует вызывающий).
+        """
+        expiries = []
+        with self.get_connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                conn.execute(f"UPDATE devices SET is_active = 1 WHERE id IN ({placeholders})", chunk)
+                if notify:
+                    expiries += conn.execute(f"""
+                        SELECT id, expires_at FROM devices
+                        WHERE id IN ({placeholders}) AND expires_at IS NOT NULL
+                    """, chunk).fetchall()
+        for row in expiries:
+            self._notify_expiry_changed(row['id'], row['expires_at'])
+
     def get_device_by_id(self, device_id: int) -> Optional[Device]:
         """Get device by ID."""
         with self.get_connection() as conn:
@@ -492,7 +731,9 @@ class DatabaseManager:
                     created_at=row['created_at'],
                     expires_at=row['expires_at'],
                     marzban_username=row['marzban_username'],
-                    id=row['id']
+                    server_ip=row['server_ip'],
+                    id=row['id'],
+                    panel=row['panel']
                 )
             return None
 
@@ -512,16 +753,18 @@ class DatabaseManager:
             return False
 
     def deactivate_device(self, device_id: int) -> bool:
-        """Деактивация устройства."""
+        """Деактивация устройства. False - устройство уже было неактивно."""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     UPDATE devices 
                     SET is_active = 0
-                    WHERE id = ?
+                    WHERE id = ? AND is_active = 1
                 """, (device_id,))
-                return True
+                updated = cursor.rowcount > 0
+            self._notify_expiry_changed(device_id, None)
+            return updated
         except Exception as e:
             logger.error(f"Error deactivating device: {e}")
             return False
@@ -582,34 +825,354 @@ class DatabaseManager:
             """, (host,))
             return cursor.fetchone()[0]
 
+    def get_server_loads(self) -> Dict[str, int]:
+        """Количество активных устройств по серверам."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT server_ip, COUNT(*) as count
+                FROM devices 
+                WHERE is_active = 1 
+                GROUP BY server_ip
+            """)
+            # проверка на не-NULL server_ip
+            return {row[0]: row[1] for row in cursor.fetchall() if row[0]}
+
+    def register_nodes(self, nodes: List[Dict[str, Any]]) -> None:
+        """
+        Синхронизация реестра нод с конфигурацией.
+
+        Ноды добавляются/обновляются, отсутствующие в конфигурации удаляются,
+        счетчики устройств пересчитываются по таблице devices.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for node in nodes:
+                cursor.execute("""
+                    INSERT INTO nodes (name, host, address, port, weight, max_users)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        host = excluded.host,
+                        address = excluded.address,
+                        port = excluded.port,
+                        weight = excluded.weight,
+                        max_users = excluded.max_users,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (node['name'], node['host'], node['address'], node.get('port'),
+                      node.get('weight', 1), node.get('max_users', 0)))
+
+            if nodes:
+                placeholders = ','.join('?' * len(nodes))
+                cursor.execute(f"DELETE FROM nodes WHERE name NOT IN ({placeholders})",
+                               [node['name'] for node in nodes])
+            else:
+                # Пустой VPN_NODES: NOT IN () - синтаксическая ошибка SQLite
+                cursor.execute("DELETE FROM nodes")
+            cursor.execute("""
+                UPDATE nodes SET current_users = (
+                    SELECT COUNT(*) FROM devices
+                    WHERE is_active = 1 AND server_ip = nodes.address
+                )
+            """)
+
+    def get_nodes(self) -> List[Dict[str, Any]]:
+        """Реестр нод."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM nodes ORDER BY rowid")
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_node_counters(self) -> Dict[str, int]:
+        """Количество активных устройств по IP нод из реестра."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT address, current_users FROM nodes")
+            return {row['address']: row['current_users'] for row in cursor.fetchall()}
+
+    def get_devices_to_move(self, server_ip: str, limit: int, moved_before: datetime) -> List[Device]:
+        """
+        Активные устройства сервера для переноса на другую ноду.
+
+        Недавно перенесенные устройства пропускаются, чтобы не гонять их между нодами.
+        Сначала берутся устройства с самым дальним сроком действия.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM devices d
+                WHERE d.is_active = 1 AND d.server_ip = ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM device_moves m
+                      WHERE m.device_id = d.id AND m.created_at > ?
+                  )
+                ORDER BY d.expires_at DESC
+                LIMIT ?
+            """, (server_ip, moved_before, limit))
+            return [Device(**dict(row)) for row in cursor.fetchall()]
+
+    def move_devices(self, moves: List[tuple]) -> List[int]:
+        """
+        Перенос устройств на другие серверы одной транзакцией.
+
+        Args:
+            moves: Список (device_id, from_server, to_server)
+
+        Returns:
+            List[int]: id перенесенных устройств (устройства, сменившие сервер
+            или статус с момента выборки, пропускаются)
+        """
+        moved = []
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for device_id, from_server, to_server in moves:
+                cursor.execute("""
+                    UPDATE devices SET server_ip = ?
+                    WHERE id = ? AND server_ip = ? AND is_active = 1
+                """, (to_server, device_id, from_server))
+                if cursor.rowcount:
+                    cursor.execute("""
+                        INSERT INTO device_moves (device_id, from_server, to_server, created_at)
+                        VALUES (?, ?, ?, ?)
+                    """, (device_id, from_server, to_server, datetime.now()))
+                    moved.append(device_id)
+        return moved
+
+    def get_pending_move_notifications(self, limit: int) -> List[Dict[str, Any]]:
+        """Переносы, о которых пользователь еще не уведомлен (только последний по устройству)."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT m.id AS move_id, m.to_server, d.*
+                FROM device_moves m
+                JOIN devices d ON d.id = m.device_id
+                WHERE m.notified_at IS NULL
+                  AND m.id = (SELECT MAX(id) FROM device_moves WHERE device_id = m.device_id)
+                ORDER BY m.id
+                LIMIT ?
+            """, (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def mark_moves_notified(self, device_ids: List[int]) -> None:
+        """Отметка об отправленных уведомлениях (все переносы устройства)."""
+        if not device_ids:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE device_moves SET notified_at = ?
+                WHERE notified_at IS NULL AND device_id IN ({','.join('?' * len(device_ids))})
+            """, [datetime.now()] + device_ids)
+
+    def get_panel_loads(self, default_panel: str) -> Dict[str, int]:
+        """Количество активных устройств по панелям Marzban."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COALESCE(panel, ?) AS panel, COUNT(*) AS count
+                FROM devices
+                WHERE is_active = 1
+                GROUP BY COALESCE(panel, ?)
+            """, (default_panel, default_panel))
+            return {row['panel']: row['count'] for row in cursor.fetchall()}
+
+    def get_pool_user_panels(self) -> Dict[str, str]:
+        """Панели заготовленных пользователей пула."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT username, panel FROM marzban_user_pool WHERE panel IS NOT NULL")
+            return {row['username']: row['panel'] for row in cursor.fetchall()}
+
+    def get_marzban_user_panel(self, username: str) -> Optional[str]:
+        """Панель пользователя Marzban (None - основная панель)."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT panel FROM devices WHERE marzban_username = ? AND panel IS NOT NULL
+                UNION ALL
+                SELECT panel FROM marzban_user_pool WHERE username = ? AND panel IS NOT NULL
+                LIMIT 1
+            """, (username, username))
+            row = cursor.fetchone()
+            return row['panel'] if row else None
+
     def get_optimal_server(self) -> str:
         """
         Определяет оптимальный сервер с учетом активных конфигов
         Returns:
             str: IP адрес оптимального сервера
         """
+        # Получаем количество активных конфигов на каждом сервере
+        server_loads = self.get_server_loads()
+
+        # Сервер с меньшей нагрузкой, при равенстве - первый в списке нод
+        return min(VPN_NODES, key=lambda node: server_loads.get(node['address'], 0))['address']
+
+    def add_pool_user(self, username: str, template: str, panel: Optional[str] = None) -> None:
+        """Добавление заготовленного пользователя Marzban в пул."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO marzban_user_pool (username, template, panel)
+                VALUES (?, ?, ?)
+            """, (username, template, panel))
 
-            # Получаем количество активных конфигов на каждом сервере
+    def add_marzban_orphan(self, username: str, reason: str) -> None:
+        """Пользователь Marzban, которого нужно удалить позже (откат не удался)."""
+        with self.get_connection() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO marzban_orphans (username, reason, created_at)
+                VALUES (?, ?, ?)
+            """, (username, reason, datetime.now()))
+
+    def get_marzban_orphans(self, limit: int = 100) -> List[str]:
+        """Пользователи к удалению, реже всего пробовавшиеся - первыми."""
+        with self.get_connection() as conn:
+            rows = conn.execute("""
+                SELECT username FROM marzban_orphans ORDER BY attempts, created_at LIMIT ?
+            """, (limit,)).fetchall()
+            return [row['username'] for row in rows]
+
+    def resolve_marzban_orphans(self, removed: List[str], failed: List[str]) -> None:
+        """Удаленные убираются из списка, у неудавшихся растет счетчик попыток."""
+        with self.get_connection() as conn:
+            conn.executemany("DELETE FROM marzban_orphans WHERE username = ?", [(u,) for u in removed])
+            conn.executemany(
+                "UPDATE marzban_orphans SET attempts = attempts + 1 WHERE username = ?", [(u,) for u in failed]
+            )
+
+    def claim_pool_user(self, template: str) -> Optional[str]:
+        """Атомарное извлечение самого старого пользователя из пула."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Блокируем запись сразу, чтобы два потока не забрали одного пользователя
+            cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("""
-                SELECT server_ip, COUNT(*) as count
-                FROM devices 
-                WHERE is_active = 1 
-                GROUP BY server_ip
-            """)
+                SELECT id, username FROM marzban_user_pool
+                WHERE template = ?
+                ORDER BY id
+                LIMIT 1
+            """, (template,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+
+            cursor.execute("DELETE FROM marzban_user_pool WHERE id = ?", (row['id'],))
+            return row['username']
 
-            server_loads = {}
-            for row in cursor.fetchall():
-                if row[0]:  # проверка на не-NULL server_ip
-                    server_loads[row[0]] = row[1]
+    def get_pool_size(self, template: str) -> int:
+        """Количество заготовленных пользователей по шаблону."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*) as count
+                FROM marzban_user_pool
+                WHERE template = ?
+            """, (template,))
+            return cursor.fetchone()['count']
+
+    def get_media_file_ids(self) -> Dict[tuple, str]:
+        """Сохраненные file_id Telegram: (хеш содержимого, тип) -> file_id."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT content_hash, kind, file_id FROM media_files")
+            return {(row['content_hash'], row['kind']): row['file_id'] for row in cursor.fetchall()}
 
-            # Если нет данных или равная нагрузка - возвращаем по умолчанию
-            master_count = server_loads.get('150.241.108.35', 0)
-            marzban2_count = server_loads.get('150.241.108.166', 0)
+    def save_media_file_id(self, content_hash: str, kind: str, file_id: str) -> None:
+        with self.get_connection() as conn:
+            conn.execute("""
+                INSERT INTO media_files (content_hash, kind, file_id, created_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (content_hash, kind) DO UPDATE SET
+                    file_id = excluded.file_id, created_at = excluded.created_at
+            """, (content_hash, kind, file_id, datetime.now()))
+
+    def delete_media_file_id(self, content_hash: str, kind: str) -> None:
+        with self.get_connection() as conn:
+            conn.execute(
+                "DELETE FROM media_files WHERE content_hash = ? AND kind = ?",
+                (content_hash, kind)
+            )
 
-            # Возвращаем сервер с меньшей нагрузкой
-            if master_count <= marzban2_count:
-                return '150.241.108.35'
-            else:
-                return '150.241.108.166'
\ No newline at end of file
+    def add_dead_letters(self, letters: List[tuple]) -> None:
+        """Сохранение недоставленных уведомлений: список (telegram_id, текст, ошибка)."""
+        if not letters:
+            return
+        now = datetime.now()
+        with self.get_connection() as conn:
+            conn.executemany("""
+                INSERT INTO notification_dead_letters (telegram_id, text, error, created_at)
+                VALUES (?, ?, ?, ?)
+            """, [(telegram_id, text, error, now) for telegram_id, text, error in letters])
+
+    def get_notified_device_ids(self, device_ids: List[int], kind: str, threshold: int) -> Set[int]:
+        """
+        Устройства из списка, которым уведомление уже отправлено.
+
+        Учитываются только записи для текущего срока устройства: после продления
+        expires_at меняется, и уведомление снова считается неотправленным.
+        """
+        notified = set()
+        with self.get_connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                rows = conn.execute(f"""
+                    SELECT n.device_id FROM notifications_sent n
+                    JOIN devices d ON d.id = n.device_id AND d.expires_at = n.expires_at
+                    WHERE n.kind = ? AND n.threshold = ? AND n.device_id IN ({','.join('?' * len(chunk))})
+                """, [kind, threshold, *chunk]).fetchall()
+                notified.update(row['device_id'] for row in rows)
+        return notified
+
+    def mark_devices_notified(self, device_ids: List[int], kind: str, threshold: int, sent_at: datetime) -> None:
+        """Запись об отправленном уведомлении вместе с текущим сроком устройства."""
+        with self.get_connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO notifications_sent (device_id, kind, threshold, expires_at, sent_at)
+                    SELECT id, ?, ?, expires_at, ? FROM devices
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                """, [kind, threshold, sent_at, *chunk])
+
+    def get_active_expiries(self) -> List[Tuple[int, Any]]:
+        """Сроки всех активных устройств: (id, expires_at)."""
+        with self.get_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, expires_at FROM devices
+                WHERE is_active = 1 AND expires_at IS NOT NULL
+            """).fetchall()
+            return [(row['id'], row['expires_at']) for row in rows]
+
+    def get_active_devices_by_ids(self, device_ids: List[int]) -> List[Device]:
+        """Активные устройства из списка."""
+        devices = []
+        with self.get_connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                rows = conn.execute(f"""
+                    SELECT * FROM devices
+                    WHERE is_active = 1 AND id IN ({','.join('?' * len(chunk))})
+                """, chunk).fetchall()
+                devices.extend(Device(**dict(row)) for row in rows)
+        return devices
+
+    def claim_notifications(self, device_ids: List[int], kind: str, threshold: int,
+                            sent_at: datetime) -> Set[int]:
+        """
+        Атомарная отметка уведомления как отправленного.
+        Возвращает устройства, для которых запись создана этим вызовом: только
+        им и нужно отправлять, остальным уведомление уже ушло другим путем.
+        """
+        claimed = set()
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for device_id in device_ids:
+                cursor = conn.execute("""
+                    INSERT OR IGNORE INTO notifications_sent (device_id, kind, threshold, expires_at, sent_at)
+                    SELECT id, ?, ?, expires_at, ? FROM devices WHERE id = ?
+                """, (kind, threshold, sent_at, device_id))
+                if cursor.rowcount:
+                    claimed.add(device_id)
+        return claimed
@@ -33,6 +33,9 @@ class Device:
     marzban_username: str = ""
     server_ip: str = ""  # Добавляем поле
     id: Optional[int] = None
+    panel: Optional[str] = None  # панель Marzban, на которой создан пользователь
+    last_checked_at: Optional[datetime] = None  # последняя сверка с Marzban
+    health_flagged_at: Optional[datetime] = None  # событие, требующее внеочередной сверки
 
 @dataclass
 class Transaction:
@@ -87,6 +90,9 @@ CREATE TABLE IF NOT EXISTS devices (
     expires_at TIMESTAMP,
     marzban_username TEXT,
     server_ip TEXT,
+    panel TEXT,
+    last_checked_at TIMESTAMP,
+    health_flagged_at TIMESTAMP,
     FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
 );
 
@@ -112,7 +118,122 @@ CREATE TABLE IF NOT EXISTS referrals (
     UNIQUE(referee_telegram_id)
 );
 
+CREATE TABLE IF NOT EXISTS marzban_user_pool (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,  -- заранее созданный отключенный пользователь Marzban
+    template TEXT NOT NULL,
+    panel TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS marzban_orphans (
+    username TEXT PRIMARY KEY,      -- пользователь Marzban, которого не удалось удалить при откате
+    reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    name TEXT PRIMARY KEY,
+    host TEXT NOT NULL,               -- API ноды
+    address TEXT UNIQUE NOT NULL,     -- IP в ссылках (devices.server_ip)
+    port INTEGER,
+    weight REAL DEFAULT 1,
+    max_users INTEGER DEFAULT 0,
+    current_users INTEGER DEFAULT 0,  -- активные устройства, ведется триггерами
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS device_moves (
+    id INTEGER PRIMARY KEY,
+    device_id INTEGER NOT NULL,
+    from_server TEXT,
+    to_server TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    notified_at TIMESTAMP,          -- NULL, пока пользователю не отправлена новая ссылка
+    FOREIGN KEY (device_id) REFERENCES devices(id)
+);
+
+CREATE TABLE IF NOT EXISTS device_reservations (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    amount REAL NOT NULL,               -- списанная при резервировании сумма
+    status TEXT NOT NULL DEFAULT 'reserved',  -- reserved / committed / released
+    marzban_username TEXT,              -- пользователь Marzban, созданный под резерв
+    device_id INTEGER,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS media_files (
+    content_hash TEXT NOT NULL,     -- SHA-256 содержимого (для документов - с именем файла)
+    kind TEXT NOT NULL,             -- photo / animation / document
+    file_id TEXT NOT NULL,          -- file_id Telegram после первой загрузки
+    created_at TIMESTAMP,
+    PRIMARY KEY (content_hash, kind)
+);
+
+CREATE TABLE IF NOT EXISTS notifications_sent (
+    device_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,             -- тип уведомления, например expiry_warning
+    threshold INTEGER NOT NULL,     -- порог (часов до окончания срока)
+    expires_at TIMESTAMP,           -- срок устройства на момент отправки
+    sent_at TIMESTAMP,
+    PRIMARY KEY (device_id, kind, threshold),
+    FOREIGN KEY (device_id) REFERENCES devices (id)
+);
+
+CREATE TABLE IF NOT EXISTS notification_dead_letters (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    error TEXT,                     -- причина: бот заблокирован, чат не найден, исчерпаны повторы
+    created_at TIMESTAMP
+);
+
+-- Счетчики устройств нод меняются в той же транзакции, что и сами устройства
+CREATE TRIGGER IF NOT EXISTS trg_devices_node_insert
+AFTER INSERT ON devices WHEN NEW.is_active = 1
+BEGIN
+    UPDATE nodes SET current_users = current_users + 1 WHERE address = NEW.server_ip;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_node_update
+AFTER UPDATE OF is_active, server_ip ON devices
+WHEN OLD.is_active IS NOT NEW.is_active OR OLD.server_ip IS NOT NEW.server_ip
+BEGIN
+    UPDATE nodes SET current_users = MAX(current_users - 1, 0)
+    WHERE OLD.is_active = 1 AND address = OLD.server_ip;
+    UPDATE nodes SET current_users = current_users + 1
+    WHERE NEW.is_active = 1 AND address = NEW.server_ip;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_node_delete
+AFTER DELETE ON devices WHEN OLD.is_active = 1
+BEGIN
+    UPDATE nodes SET current_users = MAX(current_users - 1, 0) WHERE address = OLD.server_ip;
+END;
+
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_devices_telegram_id ON devices(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_transactions_telegram_id ON transactions(telegram_id);
-"""
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_marzban_user_pool_template ON marzban_user_pool(template);
+CREATE INDEX IF NOT EXISTS idx_device_reservations_status ON device_reservations(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_device_moves_device_id ON device_moves(device_id);
+CREATE INDEX IF NOT EXISTS idx_device_moves_pending ON device_moves(notified_at);
+CREATE INDEX IF NOT EXISTS idx_devices_server_ip ON devices(server_ip, is_active);
+"""
+
+# Колонки, добавленные в существующие таблицы: (таблица, колонка, определение)
+SCHEMA_MIGRATIONS = [
+    ("devices", "panel", "TEXT"),
+    ("marzban_user_pool", "panel", "TEXT"),
+    ("devices", "last_checked_at", "TIMESTAMP"),
+    ("devices", "health_flagged_at", "TIMESTAMP"),
+]
+
+# Индексы по колонкам из SCHEMA_MIGRATIONS - создаются после миграций
+MIGRATED_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_devices_last_checked ON devices(is_active, last_checked_at);
+"""
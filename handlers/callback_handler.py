@@ -11,17 +11,17 @@ from services.device_service import DeviceService
 from services.payment_service import PaymentService
 from services.support_service import SupportService
 from services.qr_service import QRService
+from services.media_cache import MediaCache
 from utils.rate_limiter import RateLimiter
-import io
 from .menu_handler import MenuHandler
 from config.settings import MESSAGE_TEMPLATES, SUPPORT_WELCOME_MESSAGE
 import logging
-import qrcode
 from datetime import datetime, timedelta, timezone
 from config.settings import DEFAULT_PLAN_PRICE
 from database.models import Device
 import json
-from config.settings import MARZBAN_HOST, MARZBAN_USERNAME, MARZBAN_PASSWORD
+from config.settings import MARZBAN_HOST, MARZBAN_USERNAME, MARZBAN_PASSWORD, VPN_NODES
+from config.settings import BALANCE_ANIMATION_PATH, BALANCE_ANIMATION_URL
 from services.marzban_service import MarzbanService
 from services.node_manager import NodeManager
 
@@ -30,24 +30,22 @@ logger = logging.getLogger('callback_handler')
 
 class CallbackHandler:
     # In callback_handler.py
-    def __init__(self, bot: TeleBot, db_manager: DatabaseManager, qr_service: QRService = None,
-                 rate_limiter: RateLimiter = None, node_manager: NodeManager = None):
+    def __init__(self, bot: TeleBot, db_manager: DatabaseManager, qr_service: QRService,
+                 device_service: DeviceService, rate_limiter: RateLimiter = None,
+                 node_manager: NodeManager = None, marzban_service: MarzbanService = None,
+                 media_cache: MediaCache = None):
         self.bot = bot
         self.db_manager = db_manager
-        # Создаем экземпляр MarzbanService
-        self.marzban_service = MarzbanService(
+        # Используем общий MarzbanService бота или создаем свой
+        self.marzban_service = marzban_service or MarzbanService(
             host=MARZBAN_HOST,
             username=MARZBAN_USERNAME,
             password=MARZBAN_PASSWORD,
             node_manager=node_manager
         )
-        # Передаем его в DeviceService
-        self.device_service = DeviceService(
-            db_manager=self.db_manager,
-            marzban_service=self.marzban_service,
-            bot=self.bot
-        )
-        self.qr_service = qr_service or QRService()
+        self.qr_service = qr_service
+        self.media_cache = media_cache or MediaCache(bot, db_manager)
+        self.device_service = device_service
         self.rate_limiter = rate_limiter or RateLimiter()
         self.user_service = UserService(db_manager)
         self.payment_service = PaymentService(db_manager)
@@ -121,6 +119,10 @@ class CallbackHandler:
                 self.handle_select_device(call)
             elif call.data.startswith('show_config_'):
                 self.handle_show_config(call)
+            elif call.data.startswith('refresh_config_'):
+                self.handle_refresh_config(call)
+            elif call.data.startswith('export_config_'):
+                self.handle_export_config(call)
 
         except Exception as e:
             logger.error(f"Error handling callback: {e}")
@@ -433,13 +435,10 @@ class CallbackHandler:
             server_ip = device.server_ip or self.db_manager.get_optimal_server()
 
             # Находим соответствующую ссылку
-            optimal_link = next(
-                (link for link in links if server_ip in link),
-                links[0]
-            )
+            optimal_link = self.device_service.select_link(links, server_ip)
 
             # Определяем имя сервера
-            server_name = "Master" if optimal_server == "150.241.108.35" else "Marzban2"
+            server_name = next((node['name'] for node in VPN_NODES if node['address'] == optimal_server), optimal_server)
 
             # Получаем статистику использования
             users_count = self.db_manager.get_active_devices_count_by_host(optimal_server)
@@ -456,14 +455,12 @@ class CallbackHandler:
                 "*Ссылка для подключения:*\n"
                 f"`{optimal_link}`\n\n"
             )
+            subscription_url = self.device_service.subscription.get_url(device)
+            if subscription_url:
+                info_text += f"*Подписка (автообновление в клиенте):*\n`{subscription_url}`\n"
 
-            # Генерируем QR-код
-            qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-            qr.add_data(optimal_link)
-            qr.make(fit=True)
-            qr_buffer = io.BytesIO()
-            qr.make_image().save(qr_buffer, format='PNG')
-            qr_buffer.seek(0)
+            # QR-код из кэша QRService
+            qr_png = self.qr_service.render_png(optimal_link)
 
             # Удаляем предыдущее сообщение
             self.bot.delete_message(
@@ -471,12 +468,13 @@ class CallbackHandler:
                 message_id=call.message.message_id
             )
 
-            self.bot.send_photo(
+            # Повторный показ того же QR-кода отправляется по file_id без загрузки
+            self.media_cache.send_photo(
                 call.message.chat.id,
-                qr_buffer,
+                qr_png,
                 caption=info_text,
                 parse_mode='Markdown',
-                reply_markup=self.menu_handler.create_my_devices_button()
+                reply_markup=self.menu_handler.create_config_export_menu(device.id)
             )
 
         except Exception as e:
@@ -645,9 +643,11 @@ class CallbackHandler:
                 )
 
                 # Отправляем GIF и сообщение
-                self.bot.send_animation(
+                # GIF загружается один раз, дальше отправляется по file_id
+                self.media_cache.send_animation_file(
                     message.chat.id,
-                    "https://i.giphy.com/media/v1.Y2lkPTc5MGI3NjExOW9rMWU2MTRybG4yYTJ5ajI2eDI4YzRjNjZpMHNwam55OXJzcDh2bCZlcD12MV9pbnRlcm5hbF9naWZfYnlfaWQmY3Q9Zw/40KHD3lKSZC4FNysxY/giphy.gif",  # Замените на вашу ссылку из imgur
+                    BALANCE_ANIMATION_PATH,
+                    fallback_url=BALANCE_ANIMATION_URL,
                     caption=(
                         "💰 *Пополнение баланса*\n\n"
                         f"Сумма: *{amount}* руб.\n"
@@ -747,7 +747,8 @@ class CallbackHandler:
             )
 
             if device:
-                marzban_config = self.device_service.marzban.get_user_config(device.marzban_username)
+                # Конфигурация уже получена при создании - лишний запрос к Marzban не нужен
+                marzban_config = json.loads(device.config_data)
 
                 if not marzban_config:
                     return
@@ -763,13 +764,10 @@ class CallbackHandler:
                 server_ip = device.server_ip or self.db_manager.get_optimal_server()
 
                 # Находим соответствующую ссылку
-                optimal_link = next(
-                    (link for link in links if server_ip in link),
-                    links[0]
-                )
+                optimal_link = self.device_service.select_link(links, server_ip)
 
                 # Определяем имя сервера и статистику
-                server_name = "Master" if optimal_server == "150.241.108.35" else "Marzban2"
+                server_name = next((node['name'] for node in VPN_NODES if node['address'] == optimal_server), optimal_server)
                 users_count = self.db_manager.get_active_devices_count_by_host(optimal_server)
 
                 config_message = (
@@ -785,17 +783,12 @@ class CallbackHandler:
                     f"`{optimal_link}`\n\n"
                 )
 
-                # Генерируем QR-код для выбранной ссылки
-                qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-                qr.add_data(optimal_link)
-                qr.make(fit=True)
-                qr_buffer = io.BytesIO()
-                qr.make_image().save(qr_buffer, format='PNG')
-                qr_buffer.seek(0)
+                # QR-код для выбранной ссылки из кэша QRService
+                qr_png = self.qr_service.render_png(optimal_link)
 
-                self.bot.send_photo(
+                self.media_cache.send_photo(
                     message.chat.id,
-                    qr_buffer,
+                    qr_png,
                     caption=config_message,
                     parse_mode='Markdown',
                     reply_markup=self.menu_handler.create_my_devices_button()
@@ -869,12 +862,12 @@ class CallbackHandler:
             device_id = int(call.data.split('_')[2])
             device = self.db_manager.get_device_by_id(device_id)
 
-            if not device:
+            if not device or device.telegram_id != call.from_user.id:
                 self.bot.answer_callback_query(call.id, "Устройство не найдено")
                 return
 
             # Получаем новую конфигурацию из Marzban
-            new_config = self.marzban.get_user_config(device.marzban_username)
+            new_config = self.marzban_service.get_user_config(device.marzban_username)
             if not new_config:
                 self.bot.answer_callback_query(call.id, "Ошибка обновления конфигурации")
                 return
@@ -883,20 +876,15 @@ class CallbackHandler:
             device.config_data = json.dumps(new_config)
             self.db_manager.update_device_config(device.id, device.config_data)
 
-            # Отправляем новый конфиг пользователю
-            config_file = self.device_service.save_config_file(
-                device.config_data,
-                device.device_type
-            )
-
-            if config_file:
-                with open(config_file, 'rb') as config:
-                    self.bot.send_document(
-                        call.message.chat.id,
-                        config,
-                        caption="📋 Обновленная конфигурация"
-                    )
-                self.device_service.cleanup_config_file(config_file)
+            # Отправляем новый конфиг пользователю (файл собирается в памяти)
+            rendered = self.device_service.render_config(device)
+            if rendered:
+                self.media_cache.send_document(
+                    call.message.chat.id,
+                    rendered.content,
+                    rendered.filename,
+                    caption="📋 Обновленная конфигурация"
+                )
 
             self.bot.answer_callback_query(call.id, "✅ Конфигурация обновлена")
 
@@ -904,6 +892,34 @@ class CallbackHandler:
             logger.error(f"Error refreshing config: {e}")
             self.bot.answer_callback_query(call.id, "Произошла ошибка. Попробуйте позже")
 
+    def handle_export_config(self, call: CallbackQuery):
+        """Выгрузка конфигурации в формате клиента (export_config_{формат}_{id})."""
+        try:
+            _, _, fmt, device_id = call.data.split('_', 3)
+            device = self.db_manager.get_device_by_id(int(device_id))
+
+            if not device or device.telegram_id != call.from_user.id:
+                self.bot.answer_callback_query(call.id, "Устройство не найдено")
+                return
+
+            # Файл строится из сохраненной конфигурации, повторная выдача берется из кэша
+            rendered = self.device_service.render_config(device, fmt)
+            if not rendered:
+                self.bot.answer_callback_query(call.id, "Нет доступных конфигураций")
+                return
+
+            self.media_cache.send_document(
+                call.message.chat.id,
+                rendered.content,
+                rendered.filename,
+                caption=f"📋 Конфигурация {device.device_type}"
+            )
+            self.bot.answer_callback_query(call.id)
+
+        except Exception as e:
+            logger.error(f"Error exporting config: {e}")
+            self.bot.answer_callback_query(call.id, "Ошибка выгрузки конфигурации")
+
     def handle_delete_device(self, call: CallbackQuery):
         """Удаление устройства."""
         try:
@@ -914,11 +930,8 @@ class CallbackHandler:
                 self.bot.answer_callback_query(call.id, "Устройство не найдено")
                 return
 
-            # Удаляем пользователя из Marzban
-            if self.marzban.delete_user(device.marzban_username):
-                # Деактивируем устройство в БД
-                self.db_manager.deactivate_device(device.id)
-
+            # Деактивация в БД и удаление пользователя из Marzban
+            if self.device_service.remove_device(device):
                 self.bot.answer_callback_query(call.id, "✅ Устройство удалено")
                 # Возвращаемся к списку устройств
                 self.handle_devices(call)
@@ -73,7 +73,8 @@ class CommandRateLimit:
 
 
 class CommandHandler:
-    def __init__(self, bot: TeleBot, db_manager: DatabaseManager, node_manager: NodeManager = None):
+    def __init__(self, bot: TeleBot, db_manager: DatabaseManager, device_service: DeviceService,
+                 node_manager: NodeManager = None, marzban_service: MarzbanService = None):
         self.bot = bot
         self.db_manager = db_manager
         self.user_service = UserService(db_manager)
@@ -81,17 +82,13 @@ class CommandHandler:
         self.support_service = SupportService(bot, db_manager)
         self.menu_handler = MenuHandler()
         self.rate_limiter = CommandRateLimit()
-        self.marzban_service = MarzbanService(
+        self.marzban_service = marzban_service or MarzbanService(
             host=MARZBAN_HOST,
             username=MARZBAN_USERNAME,
             password=MARZBAN_PASSWORD,
             node_manager=node_manager
         )
-        self.device_service = DeviceService(
-            db_manager=self.db_manager,
-            marzban_service=self.marzban_service,
-            bot=self.bot  # Добавляем параметр bot
-        )
+        self.device_service = device_service
 
     def register_handlers(self):
         """Register command handlers."""
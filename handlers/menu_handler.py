@@ -78,6 +78,18 @@ class MenuHandler:
         keyboard.row(InlineKeyboardButton("🔙 Вернуться в меню", callback_data='back_to_menu'))
         return keyboard
 
+    def create_config_export_menu(self, device_id: int) -> InlineKeyboardMarkup:
+        """Create config export keyboard."""
+        keyboard = InlineKeyboardMarkup()
+        keyboard.row(
+            InlineKeyboardButton("📄 Подписка", callback_data=f"export_config_subscription_{device_id}"),
+            InlineKeyboardButton("📦 sing-box", callback_data=f"export_config_singbox_{device_id}"),
+            InlineKeyboardButton("🐱 Clash", callback_data=f"export_config_clash_{device_id}")
+        )
+        keyboard.row(InlineKeyboardButton("🔄 Обновить конфиг", callback_data=f"refresh_config_{device_id}"))
+        keyboard.row(InlineKeyboardButton("📱 К моим устройствам", callback_data='my_devices'))
+        return keyboard
+
     def create_my_devices_button(self) -> InlineKeyboardMarkup:
         """Create button to return to devices menu."""
         keyboard = InlineKeyboardMarkup()
@@ -0,0 +1,332 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+from config.settings import CONFIG_RENDER_CACHE_SIZE, MARZBAN_PROTOCOLS
+from database.models import Device
+
+logger = logging.getLogger('config_renderer')
+
+# Формат -> (расширение файла, MIME-тип)
+FORMATS = {
+    'text': ('txt', 'text/plain; charset=utf-8'),
+    'subscription': ('txt', 'text/plain; charset=utf-8'),
+    'singbox': ('json', 'application/json'),
+    'clash': ('yaml', 'application/yaml')
+}
+
+_SCHEMES = {'vless': 'vless', 'vmess': 'vmess', 'trojan': 'trojan', 'ss': 'shadowsocks'}
+
+
+@dataclass
+class RenderedConfig:
+    """Готовый файл конфигурации в памяти."""
+    content: bytes
+    filename: str
+    media_type: str
+    config_hash: str
+
+    def as_document(self) -> io.BytesIO:
+        """Новый буфер для отправки в Telegram (имя файла берется из .name)."""
+        buffer = io.BytesIO(self.content)
+        buffer.name = self.filename
+        return buffer
+
+
+def _b64decode(value: str) -> str:
+    value = value.strip().replace('-', '+').replace('_', '/')
+    return base64.b64decode(value + '=' * (-len(value) % 4)).decode('utf-8')
+
+
+def parse_link(link: str) -> Optional[Dict[str, Any]]:
+    """Разбор ссылки vless/vmess/trojan/ss в общий вид. None - формат не поддерживается."""
+    try:
+        scheme = link.split('://', 1)[0].lower()
+        protocol = _SCHEMES.get(scheme)
+        if protocol is None:
+            return None
+
+        if protocol == 'vmess':
+            data = json.loads(_b64decode(link[len('vmess://'):]))
+            return {
+                'protocol': protocol,
+                'name': data.get('ps') or data.get('add'),
+                'server': data['add'],
+                'port': int(data['port']),
+                'uuid': data['id'],
+                'network': data.get('net') or 'tcp',
+                'security': 'tls' if data.get('tls') == 'tls' else 'none',
+                'sni': data.get('sni') or data.get('host') or '',
+                'path': data.get('path') or '',
+                'host': data.get('host') or '',
+                'params': {}
+            }
+
+        parsed = urlparse(link)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        proxy = {
+            'protocol': protocol,
+            'name': unquote(parsed.fragment) or parsed.hostname,
+            'server': parsed.hostname,
+            'port': parsed.port,
+            'network': params.get('type') or 'tcp',
+            'security': params.get('security') or ('tls' if protocol == 'trojan' else 'none'),
+            'sni': params.get('sni') or '',
+            'path': unquote(params.get('path') or params.get('serviceName') or ''),
+            'host': params.get('host') or '',
+            'params': params
+        }
+        userinfo = unquote(parsed.username or '')
+        if protocol == 'shadowsocks':
+            # SIP002: ss://base64(method:password)@host:port
+            method, password = (userinfo if ':' in userinfo else _b64decode(userinfo)).split(':', 1)
+            proxy.update(method=method, password=password)
+        elif protocol == 'trojan':
+            proxy['password'] = userinfo
+        else:
+            proxy['uuid'] = userinfo
+        return proxy
+    except Exception as e:
+        logger.warning(f"Unsupported link {link[:32]}...: {e}")
+        return None
+
+
+def _singbox_outbound(proxy: Dict[str, Any]) -> Dict[str, Any]:
+    params = proxy['params']
+    outbound = {
+        'type': proxy['protocol'],
+        'tag': proxy['name'],
+        'server': proxy['server'],
+        'server_port': proxy['port']
+    }
+    if proxy['protocol'] == 'shadowsocks':
+        outbound.update(method=proxy['method'], password=proxy['password'])
+        return outbound
+    if proxy['protocol'] == 'trojan':
+        outbound['password'] = proxy['password']
+    else:
+        outbound['uuid'] = proxy['uuid']
+    if params.get('flow'):
+        outbound['flow'] = params['flow']
+
+    if proxy['security'] in ('tls', 'reality'):
+        tls = {'enabled': True, 'server_name': proxy['sni'] or proxy['server']}
+        if params.get('fp'):
+            tls['utls'] = {'enabled': True, 'fingerprint': params['fp']}
+        if proxy['security'] == 'reality':
+            tls['reality'] = {'enabled': True, 'public_key': params.get('pbk', ''), 'short_id': params.get('sid', '')}
+        outbound['tls'] = tls
+
+    if proxy['network'] == 'ws':
+        outbound['transport'] = {'type': 'ws', 'path': proxy['path'] or '/',
+                                 'headers': {'Host': proxy['host']} if proxy['host'] else {}}
+    elif proxy['network'] == 'grpc':
+        outbound['transport'] = {'type': 'grpc', 'service_name': proxy['path']}
+    return outbound
+
+
+def _yaml(value: Any) -> str:
+    # Строка JSON - корректный скаляр YAML, экранирование не нужно писать вручную
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _clash_proxy(proxy: Dict[str, Any]) -> List[str]:
+    params = proxy['params']
+    protocol = 'ss' if proxy['protocol'] == 'shadowsocks' else proxy['protocol']
+    lines = [
+        f"  - name: {_yaml(proxy['name'])}",
+        f"    type: {protocol}",
+        f"    server: {_yaml(proxy['server'])}",
+        f"    port: {proxy['port']}",
+        "    udp: true"
+    ]
+    if protocol == 'ss':
+        lines += [f"    cipher: {_yaml(proxy['method'])}", f"    password: {_yaml(proxy['password'])}"]
+        return lines
+    if protocol == 'trojan':
+        lines.append(f"    password: {_yaml(proxy['password'])}")
+    else:
+        lines.append(f"    uuid: {_yaml(proxy['uuid'])}")
+        if protocol == 'vmess':
+            lines += ["    alterId: 0", "    cipher: auto"]
+    if params.get('flow'):
+        lines.append(f"    flow: {_yaml(params['flow'])}")
+
+    lines.append(f"    network: {proxy['network']}")
+    if proxy['security'] in ('tls', 'reality'):
+        lines += ["    tls: true", f"    servername: {_yaml(proxy['sni'] or proxy['server'])}"]
+        if params.get('fp'):
+            lines.append(f"    client-fingerprint: {_yaml(params['fp'])}")
+        if proxy['security'] == 'reality':
+            lines += [
+                "    reality-opts:",
+                f"      public-key: {_yaml(params.get('pbk', ''))}",
+                f"      short-id: {_yaml(params.get('sid', ''))}"
+            ]
+    if proxy['network'] == 'ws':
+        lines += ["    ws-opts:", f"      path: {_yaml(proxy['path'] or '/')}"]
+        if proxy['host']:
+            lines += ["      headers:", f"        Host: {_yaml(proxy['host'])}"]
+    elif proxy['network'] == 'grpc':
+        lines += ["    grpc-opts:", f"      grpc-service-name: {_yaml(proxy['path'])}"]
+    return lines
+
+
+class ConfigRenderer:
+    """
+    Конфигурации устройств в нескольких клиентских форматах.
+
+    Файлы собираются в памяти: text (ссылки по протоколам устройства),
+    subscription (список ссылок построчно), singbox (профиль sing-box JSON),
+    clash (профиль Clash Meta YAML). Результат кэшируется по устройству и
+    формату вместе с хешем конфигурации: пока config_data, тип устройства и
+    сервер не изменились, повторная выдача не разбирает JSON заново.
+    """
+
+    def __init__(self, max_entries: int = CONFIG_RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[Tuple[int, str], RenderedConfig]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def config_hash(device: Device) -> str:
+        source = f"{device.device_type}\0{device.server_ip or ''}\0{device.config_data or ''}"
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()[:32]
+
+    def render(self, device: Device, fmt: str = 'text') -> Optional[RenderedConfig]:
+        """Файл конфигурации устройства. None - неизвестный формат или нет ссылок."""
+        if fmt not in FORMATS:
+            return None
+
+        config_hash = self.config_hash(device)
+        key = (device.id, fmt)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached.config_hash == config_hash:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        try:
+            content = self._render_content(device, fmt)
+        except Exception as e:
+            logger.error(f"Error rendering {fmt} config for device {device.id}: {e}")
+            return None
+        if content is None:
+            return None
+
+        extension, media_type = FORMATS[fmt]
+        rendered = RenderedConfig(
+            content=content.encode('utf-8'),
+            filename=f"{device.device_type}_{fmt}_{device.id}.{extension}",
+            media_type=media_type,
+            config_hash=config_hash
+        )
+        with self._lock:
+            self._cache[key] = rendered
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return rendered
+
+    def invalidate(self, device_id: int) -> None:
+        with self._lock:
+            for fmt in FORMATS:
+                self._cache.pop((device_id, fmt), None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+    def _links(self, device: Device) -> List[str]:
+        """Ссылки устройства, ссылки его сервера первыми."""
+        configs = json.loads(device.config_data)
+        links = list(configs.get('links') or [])
+        # Старые записи без links: ссылки в proxies[protocol]['uri']
+        for config in (configs.get('proxies') or {}).values():
+            if isinstance(config, dict) and config.get('uri') and config['uri'] not in links:
+                links.append(config['uri'])
+        if device.server_ip:
+            links.sort(key=lambda link: urlparse(link).hostname != device.server_ip)
+        return links
+
+    def _render_content(self, device: Device, fmt: str) -> Optional[str]:
+        links = self._links(device)
+        if fmt == 'text':
+            return render_text(links, device.device_type)
+        if not links:
+            return None
+        if fmt == 'subscription':
+            return "\n".join(links) + "\n"
+
+        proxies = [proxy for proxy in map(parse_link, links) if proxy]
+        if not proxies:
+            return None
+        # Имена прокси в профилях должны быть уникальны
+        seen: Dict[str, int] = {}
+        for proxy in proxies:
+            name = proxy['name']
+            seen[name] = seen.get(name, 0) + 1
+            if seen[name] > 1:
+                proxy['name'] = f"{name} {seen[name]}"
+        names = [proxy['name'] for proxy in proxies]
+
+        if fmt == 'singbox':
+            profile = {
+                'log': {'level': 'warn'},
+                'inbounds': [{'type': 'tun', 'tag': 'tun-in', 'inet4_address': '172.19.0.1/30',
+                              'auto_route': True, 'strict_route': True, 'sniff': True}],
+                'outbounds': [
+                    {'type': 'urltest', 'tag': 'auto', 'outbounds': names},
+                    {'type': 'selector', 'tag': 'proxy', 'outbounds': ['auto'] + names, 'default': 'auto'},
+                    *[_singbox_outbound(proxy) for proxy in proxies],
+                    {'type': 'direct', 'tag': 'direct'}
+                ],
+                'route': {'final': 'proxy', 'auto_detect_interface': True}
+            }
+            return json.dumps(profile, ensure_ascii=False, indent=2)
+
+        lines = ["mixed-port: 7890", "allow-lan: false", "mode: rule", "log-level: warning", "", "proxies:"]
+        for proxy in proxies:
+            lines += _clash_proxy(proxy)
+        lines += [
+            "",
+            "proxy-groups:",
+            "  - name: \"VPN\"",
+            "    type: url-test",
+            "    url: \"https://www.gstatic.com/generate_204\"",
+            "    interval: 300",
+            "    proxies:",
+            *[f"      - {_yaml(name)}" for name in names],
+            "",
+            "rules:",
+            "  - MATCH,VPN",
+            ""
+        ]
+        return "\n".join(lines)
+
+
+def render_text(links: List[str], device_type: str) -> str:
+    """Текстовая конфигурация: ссылки протоколов, доступных типу устройства."""
+    header = f"=== Конфигурация для {device_type} ===\n\n"
+    available_protocols = MARZBAN_PROTOCOLS.get(device_type, {})
+    formatted_text = header
+    for link in links:
+        protocol = _SCHEMES.get(link.split('://', 1)[0].lower())
+        if protocol and available_protocols.get(protocol, False):
+            formatted_text += f"--- {protocol.upper()} ---\n"
+            formatted_text += f"Ссылка для подключения:\n{link}\n\n"
+
+    if formatted_text == header:
+        return "Нет доступных конфигураций для данного типа устройства"
+    return formatted_text
@@ -1,26 +1,37 @@
-import os
 import json
-import qrcode
-from qrcode.constants import ERROR_CORRECT_L
 import io
 from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta
 from database.models import Device
 from database.db_manager import DatabaseManager
-from config.settings import (
-    DEFAULT_PLAN_PRICE,
-    MARZBAN_PROTOCOLS
-)
+from config.settings import DEFAULT_PLAN_PRICE
 from services.marzban_service import MarzbanService
+from services.user_pool import MarzbanUserPool
+from services.provisioning import ProvisioningPipeline
+from services.config_renderer import ConfigRenderer, RenderedConfig, render_text
+from services.subscription_service import SubscriptionService
+from services.qr_service import QRService
+from services.notification_dispatcher import NotificationDispatcher
+from services.notification_service import DEACTIVATION_NOTICE_KIND
 from telebot import TeleBot
 import logging
 logger = logging.getLogger('device_service')
 
 class DeviceService:
-    def __init__(self, db_manager: DatabaseManager, marzban_service: MarzbanService, bot: TeleBot):
+    def __init__(self, db_manager: DatabaseManager, marzban_service: MarzbanService, bot: TeleBot,
+                 qr_service: QRService, dispatcher: NotificationDispatcher,
+                 user_pool: MarzbanUserPool = None):
         self.db_manager = db_manager
         self.marzban = marzban_service
         self.bot = bot  # Добавьте эту строку
+        self.user_pool = user_pool
+        # Общие экземпляры бота: свои создавали бы отдельный пул процессов
+        # и удваивали глобальный лимит отправки в Telegram
+        self.qr_service = qr_service
+        self.dispatcher = dispatcher
+        self.provisioning = ProvisioningPipeline(db_manager, marzban_service, user_pool)
+        self.config_renderer = ConfigRenderer()
+        self.subscription = SubscriptionService(db_manager, self.config_renderer)
         self.logger = logging.getLogger('device_service')
 
     def format_device_info(self, device: Device) -> Tuple[str, Optional[io.BytesIO]]:
@@ -34,10 +45,7 @@ class DeviceService:
             links = marzban_config.get('links', [])
 
             # Находим нужную ссылку по server_ip устройства
-            optimal_link = next(
-                (link for link in links if device.server_ip in link),
-                links[0]
-            )
+            optimal_link = self.select_link(links, device.server_ip)
 
             info_text = f"""
     ℹ️ *Информация:*
@@ -52,73 +60,24 @@ class DeviceService:
     `{optimal_link}`
     """
 
-            # Генерируем QR-код для выбранной ссылки
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=ERROR_CORRECT_L,
-                box_size=10,
-                border=4
-            )
-            qr.add_data(optimal_link)
-            qr.make(fit=True)
-
-            qr_buffer = io.BytesIO()
-            qr.make_image(fill_color="black", back_color="white").save(qr_buffer, "PNG")
-            qr_buffer.seek(0)
-
-            return info_text, qr_buffer
+            # QR-код для выбранной ссылки (из кэша QRService)
+            return info_text, self.qr_service.get_qr_image(optimal_link)
 
         except Exception as e:
             self.logger.error(f"Error formatting device info: {e}")
             return "Ошибка форматирования информации об устройстве", None
 
+    def select_link(self, links: List[str], server_ip: Optional[str]) -> Optional[str]:
+        """Ссылка на сервере устройства (с переключением с недоступных нод)."""
+        node_manager = self.marzban.node_manager
+        if node_manager:
+            return node_manager.select_link(links, server_ip)
+        return next((link for link in links if server_ip and server_ip in link), links[0] if links else None)
+
     def add_device(self, telegram_id: int, device_type: str, days: int = 30) -> Optional[Device]:
+        """Создание оплачиваемого устройства (резерв средств, Marzban, запись в БД)."""
         try:
-            if not self.can_add_device(telegram_id):
-                return None
-
-            # Проверяем достаточно ли денег на балансе для создания конфига
-            total_cost = DEFAULT_PLAN_PRICE * days
-            user = self.db_manager.get_user(telegram_id)
-
-            if not user or user.balance < total_cost:
-                self.logger.info(
-                    f"Insufficient balance: required {total_cost}, available {user.balance if user else 0}")
-                return None
-
-            # Получаем оптимальный сервер для нового устройства
-            optimal_server = self.db_manager.get_optimal_server()
-
-            marzban_username = f"vless_{device_type.lower()}_{int(datetime.now().timestamp())}"
-            self.logger.info(f"Creating Marzban user: {marzban_username}")
-
-            # Убираем параметр node при вызове create_user
-            marzban_user = self.marzban.create_user(
-                username=marzban_username,
-                days=days
-            )
-
-            if not marzban_user:
-                return None
-
-            device = Device(
-                telegram_id=telegram_id,
-                device_type=device_type,
-                config_data=json.dumps(marzban_user),
-                created_at=datetime.now(),
-                expires_at=datetime.now() + timedelta(days=days),
-                marzban_username=marzban_username,
-                server_ip=optimal_server  # Используем полученный оптимальный сервер
-            )
-
-            device_id = self.db_manager.add_device(device)
-            if device_id:
-                self.db_manager.update_balance(telegram_id, -total_cost)
-                device.id = device_id
-                return device
-
-            return None
-
+            return self.provisioning.provision(telegram_id, device_type, days)
         except Exception as e:
             self.logger.error(f"Error adding device: {e}")
             return None
@@ -164,19 +123,9 @@ class DeviceService:
         """Get all active devices for user."""
         return self.db_manager.get_user_devices(telegram_id)
 
-    def save_config_file(self, config_data: str, device_type: str) -> str:
-        """Save config to temporary file."""
-        try:
-            configs = json.loads(config_data)
-            formatted_text = self.format_config_for_device(configs, device_type)
-
-            filename = f"{device_type}_config_{datetime.now().timestamp()}.txt"
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(formatted_text)
-            return filename
-        except Exception as e:
-            self.logger.error(f"Error saving config file: {e}")
-            return ""
+    def render_config(self, device: Device, fmt: str = 'text') -> Optional[RenderedConfig]:
+        """Файл конфигурации в памяти (text, subscription, singbox, clash)."""
+        return self.config_renderer.render(device, fmt)
 
     def can_add_device(self, telegram_id: int) -> bool:
         """Check if user can add new device."""
@@ -187,80 +136,112 @@ class DeviceService:
             self.logger.error(f"Error checking if user can add device: {e}")
             return False
 
-    def get_user_status(self, username: str) -> bool:
-        try:
-            user_config = self.marzban.get_user_config(username)
-            return user_config and user_config.get('status') == 'active'
-        except Exception as e:
-            logger.error(f"Error checking user status: {e}")
-            return False
-
-    def check_deactivated_configs(self):
-        try:
-            # Получаем все активные устройства для всех пользователей
-            active_devices = self.db_manager.get_all_active_devices()  # Этот метод нужно будет добавить
-            for device in active_devices:
-                if not self.get_user_status(device.marzban_username):
-                    self.permanently_delete_config(device.marzban_username)
-                    logger.info(f"Config {device.marzban_username} was deactivated by v2iplimit and removed")
-        except Exception as e:
-            logger.error(f"Error checking deactivated configs: {e}")
-
-
-
     def format_config_for_device(self, configs: dict, device_type: str) -> str:
         """Format Marzban config for specific device type."""
         try:
-            formatted_text = f"=== Конфигурация для {device_type} ===\n\n"
-            available_protocols = MARZBAN_PROTOCOLS.get(device_type, {})
-
-            for protocol, config in configs['proxies'].items():
-                if available_protocols.get(protocol, False) and 'uri' in config:
-                    formatted_text += f"--- {protocol.upper()} ---\n"
-                    formatted_text += f"Ссылка для подключения:\n{config['uri']}\n\n"
-
-            if formatted_text == f"=== Конфигурация для {device_type} ===\n\n":
-                return "Нет доступных конфигураций для данного типа устройства"
-
-            return formatted_text
-
+            links = list(configs.get('links') or [])
+            links += [config['uri'] for config in (configs.get('proxies') or {}).values()
+                      if isinstance(config, dict) and config.get('uri')]
+            return render_text(links, device_type)
         except Exception as e:
             self.logger.error(f"Error formatting config: {e}")
             return "Ошибка форматирования конфигурации"
 
-    def cleanup_config_file(self, filename: str) -> None:
-        """Remove temporary config file."""
+    def handle_marzban_events(self, events: List[Dict[str, Any]]) -> int:
+        """
+        Обработка событий вебхука Marzban.
+        Возвращает количество событий, которые привели к деактивации устройства.
+        """
+        processed = 0
+        for event in events:
+            try:
+                action = event.get('action')
+                username = event.get('username') or (event.get('user') or {}).get('username')
+                if not username:
+                    continue
+
+                if action == 'user_disabled':
+                    # Отключение панелью (v2iplimit) - удаляем конфиг навсегда
+                    processed += bool(self.permanently_delete_config(username))
+                elif action == 'user_expired':
+                    processed += bool(self.permanently_delete_config(username, reason='expired'))
+                elif action == 'user_deleted':
+                    processed += bool(self.deactivate_deleted_config(username))
+                elif action in ('user_limited', 'user_updated', 'subscription_revoked'):
+                    # Состояние могло измениться - сверяем устройство вне очереди
+                    self.db_manager.flag_device_for_check(username, datetime.now())
+            except Exception as e:
+                logger.error(f"Error handling Marzban event {event}: {e}")
+
+        return processed
+
+    def remove_device(self, device: Device) -> bool:
+        """
+        Снятие устройства: деактивация в БД, затем удаление пользователя в Marzban.
+
+        Порядок важен: вебхук user_deleted, которым панель отвечает на удаление,
+        должен застать устройство уже неактивным и не уведомлять повторно.
+        Если удалить в панели не удалось, устройство возвращается в активные.
+        """
+        if not self.db_manager.deactivate_device(device.id):
+            return False  # уже снято другим путем
+        if self.marzban.delete_user(device.marzban_username):
+            return True
+        self.db_manager.reactivate_devices([device.id])
+        return False
+
+    def _notify_deactivated(self, device: Device, message: str, **kwargs) -> None:
+        """Уведомление о деактивации, если о ней еще не сообщили другим путем."""
+        if self.db_manager.claim_notifications([device.id], DEACTIVATION_NOTICE_KIND, 0, datetime.now()):
+            self.dispatcher.send(device.telegram_id, message, **kwargs)
+
+    def deactivate_deleted_config(self, username: str) -> bool:
+        """Деактивация устройства, пользователь которого уже удален в Marzban."""
         try:
-            if filename and os.path.exists(filename):
-                os.remove(filename)
+            device = self.db_manager.get_device_by_marzban_username(username)
+            if not device or not self.db_manager.deactivate_device(device.id):
+                return False
+
+            self._notify_deactivated(
+                device,
+                f"❌ Ваша конфигурация {device.device_type} была деактивирована.\n"
+                "Пожалуйста, создайте новую."
+            )
+            logger.info(f"Config {username} was deleted in Marzban and deactivated")
+            return True
         except Exception as e:
-            self.logger.error(f"Error removing config file: {e}")
+            logger.error(f"Error deactivating deleted config: {e}")
+            return False
 
-    def permanently_delete_config(self, username: str):
+    def permanently_delete_config(self, username: str, reason: str = 'ip_limit') -> bool:
         try:
             device = self.db_manager.get_device_by_marzban_username(username)
             if not device:
                 logger.warning(f"Device not found: {username}")
-                return
-
-            # Удаляем из Marzban
-            if self.marzban.delete_user(username):
-                # Деактивируем в БД
-                self.db_manager.deactivate_device(device.id)
+                return False
 
+            if self.remove_device(device):
                 # Уведомляем пользователя
-                message = (
-                    "🚫 *Доступ заблокирован*\n\n"
-                    "Ваш VPN профиль был заблокирован из-за попытки использования "
-                    "с нескольких устройств одновременно.\n\n"
-                    "Для продолжения работы создайте новый профиль."
-                )
-
-                self.bot.send_message(
-                    device.telegram_id,
-                    message,
-                    parse_mode='Markdown'
-                )
+                if reason == 'expired':
+                    message = (
+                        "⚠️ *Внимание!*\n"
+                        f"Ваше устройство {device.device_type} деактивировано "
+                        f"в связи с истечением срока действия.\n"
+                        "Для продолжения работы необходимо создать новую конфигурацию."
+                    )
+                else:
+                    message = (
+                        "🚫 *Доступ заблокирован*\n\n"
+                        "Ваш VPN профиль был заблокирован из-за попытки использования "
+                        "с нескольких устройств одновременно.\n\n"
+                        "Для продолжения работы создайте новый профиль."
+                    )
+
+                self._notify_deactivated(device, message, parse_mode='Markdown')
+                return True
+
+            return False
 
         except Exception as e:
-            logger.error(f"Error permanently deleting config: {e}")
\ No newline at end of file
+            logger.error(f"Error permanently deleting config: {e}")
+            return False
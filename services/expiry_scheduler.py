@@ -0,0 +1,222 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.db_manager import DatabaseManager
+from services.notification_service import NotificationService, EXPIRY_WARNING_HOURS
+
+logger = logging.getLogger('expiry_scheduler')
+
+# Максимальный сон потока: страховка от перевода системных часов
+MAX_SLEEP_SECONDS = 300
+# Повтор деактивации, если Marzban не удалил пользователя
+RETRY_DELAY = timedelta(minutes=5)
+
+
+class ExpiryScheduler:
+    """
+    Деактивация устройств и предупреждения точно в срок.
+
+    Сроки активных устройств хранятся в памяти в min-куче событий
+    (время, порядок, устройство, тип, срок): для каждого устройства -
+    предупреждение за EXPIRY_WARNING_HOURS и деактивация в expires_at.
+    При старте сроки загружаются из БД, дальше куча обновляется через
+    подписку на изменения в DatabaseManager (создание, продление,
+    деактивация) за O(log n). Устаревшие события не удаляются из кучи,
+    а пропускаются при извлечении: актуальный срок устройства лежит в
+    отдельном словаре. Редкий reconcile() - страховка: перезагрузка кучи
+    из БД и перезапуск потока, если тот упал.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, notification_service: NotificationService,
+                 warning_hours: int = EXPIRY_WARNING_HOURS):
+        self.db_manager = db_manager
+        self.notification_service = notification_service
+        self.warning_before = timedelta(hours=warning_hours)
+
+        self._condition = threading.Condition()
+        self._heap: List[Tuple[datetime, int, int, str, datetime]] = []
+        self._expiries: Dict[int, datetime] = {}  # device_id -> актуальный срок
+        self._sequence = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._stop_flag = threading.Event()
+
+        self.fired = 0
+        self.skipped = 0
+        self.max_lag = 0.0  # наибольшее опоздание срабатывания, секунд
+
+        db_manager.add_expiry_listener(self.on_expiry_changed)
+
+    @staticmethod
+    def _as_datetime(value) -> datetime:
+        return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+    def load(self) -> int:
+        """Загрузка сроков всех активных устройств из БД."""
+        expiries = self.db_manager.get_active_expiries()
+        with self._condition:
+            self._heap.clear()
+            self._expiries.clear()
+            for device_id, expires_at in expiries:
+                self._schedule_locked(device_id, self._as_datetime(expires_at))
+            self._condition.notify()
+        logger.info(f"Expiry scheduler loaded {len(expiries)} devices")
+        return len(expiries)
+
+    def on_expiry_changed(self, device_id: int, expires_at) -> None:
+        """Срок устройства изменился; None - устройство деактивировано."""
+        with self._condition:
+            if expires_at is None:
+                self._expiries.pop(device_id, None)
+                self._compact_locked()
+                return
+            expires_at = self._as_datetime(expires_at)
+            if self._expiries.get(device_id) == expires_at:
+                return
+            self._schedule_locked(device_id, expires_at)
+            # Будим поток, только если событие стало ближайшим
+            if self._heap[0][2] == device_id:
+                self._condition.notify()
+
+    def _schedule_locked(self, device_id: int, expires_at: datetime) -> None:
+        self._expiries[device_id] = expires_at
+        heapq.heappush(self._heap, (expires_at - self.warning_before, next(self._sequence),
+                                    device_id, 'warning', expires_at))
+        heapq.heappush(self._heap, (expires_at, next(self._sequence), device_id, 'expire', expires_at))
+        self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        """Пересборка кучи, когда устаревших событий стало больше актуальных."""
+        if len(self._heap) <= 4 * len(self._expiries) + 1000:
+            return
+        self._heap = [entry for entry in self._heap if self._expiries.get(entry[2]) == entry[4]]
+        heapq.heapify(self._heap)
+
+    def _retry(self, device_id: int, expires_at: datetime, retry_at: datetime) -> None:
+        with self._condition:
+            if device_id in self._expiries:
+                return  # срок уже изменился
+            self._expiries[device_id] = expires_at
+            heapq.heappush(self._heap, (retry_at, next(self._sequence), device_id, 'expire', expires_at))
+            self._condition.notify()
+
+    def _pop_due(self) -> Optional[Dict[str, List[int]]]:
+        """Ожидание ближайшего события и извлечение всех наступивших."""
+        with self._condition:
+            while not self._stop_flag.is_set():
+                # Устаревшие события (продление, деактивация) отбрасываем
+                while self._heap and self._expiries.get(self._heap[0][2]) != self._heap[0][4]:
+                    heapq.heappop(self._heap)
+                    self.skipped += 1
+
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    due = {'warning': [], 'expire': []}
+                    while self._heap and self._heap[0][0] <= now:
+                        due_at, _, device_id, kind, expires_at = heapq.heappop(self._heap)
+                        if self._expiries.get(device_id) != expires_at:
+                            self.skipped += 1
+                            continue
+                        if kind == 'expire':
+                            self._expiries.pop(device_id, None)
+                        due[kind].append(device_id)
+                        self.max_lag = max(self.max_lag, (now - due_at).total_seconds())
+                    return due
+
+                wait = (self._heap[0][0] - now).total_seconds() if self._heap else MAX_SLEEP_SECONDS
+                self._condition.wait(timeout=min(max(wait, 0.01), MAX_SLEEP_SECONDS))
+            return None
+
+    def _fire(self, due: Dict[str, List[int]]) -> None:
+        """Обработка наступивших событий одним проходом."""
+        now = datetime.now()
+        expire_ids = set(due['expire'])
+        # Предупреждение, совпавшее с деактивацией, уже не нужно
+        warning_ids = {device_id for device_id in due['warning'] if device_id not in expire_ids}
+        devices = self.db_manager.get_active_devices_by_ids(list(expire_ids | warning_ids))
+
+        expired, expiring = [], []
+        for device in devices:
+            expires_at = self._as_datetime(device.expires_at) if device.expires_at else None
+            if expires_at is None:
+                continue
+            if expires_at <= now:
+                expired.append(device)
+            elif expires_at - now <= self.warning_before:
+                if device.id in warning_ids:
+                    expiring.append(device)
+                else:
+                    # Срок продлен в обход DatabaseManager - переносим событие
+                    self.on_expiry_changed(device.id, expires_at)
+            else:
+                self.on_expiry_changed(device.id, expires_at)
+
+        if expired or expiring:
+            self.fired += len(expired) + len(expiring)
+            purged = self.notification_service.process_expirations(
+                now, expired, expiring, sweep_name="expiry_scheduler"
+            )
+            purged_ids = {device.id for device in purged}
+            for device in expired:
+                if device.id not in purged_ids:
+                    self._retry(device.id, self._as_datetime(device.expires_at), now + RETRY_DELAY)
+
+    def _run(self):
+        while not self._stop_flag.is_set():
+            try:
+                due = self._pop_due()
+                if due is None:
+                    return
+                self._fire(due)
+            except Exception as e:
+                logger.error(f"Error processing expiries: {e}")
+                self._stop_flag.wait(1)
+
+    def reconcile(self) -> None:
+        """
+        Страховочная сверка: перезагрузка кучи из БД и перезапуск упавшего
+        потока. Подхватывает сроки, записанные в обход DatabaseManager;
+        события, пропущенные, пока поток не работал, уже в прошлом и
+        срабатывают сразу после перезагрузки.
+        """
+        if self._thread and not self._thread.is_alive() and not self._stop_flag.is_set():
+            logger.error("Expiry scheduler thread is dead, restarting")
+            self._thread = None
+        if self._thread is None:
+            self.start()
+        else:
+            self.load()
+
+    def start(self) -> None:
+        """Загрузка сроков и запуск потока (повторный вызов ничего не делает)."""
+        if self._thread and self._thread.is_alive():
+            return
+        self.load()
+        self._stop_flag.clear()
+        self._thread = threading.Thread(target=self._run, name="ExpiryScheduler", daemon=True)
+        self._thread.start()
+        logger.info("Expiry scheduler started")
+
+    def stop(self, timeout: float = 5) -> None:
+        self._stop_flag.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        logger.info("Expiry scheduler stopped")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Число устройств и событий в куче, ближайшее событие, сработавшие и опоздание."""
+        with self._condition:
+            next_due = self._heap[0][0] if self._heap else None
+            return {
+                'devices': len(self._expiries),
+                'heap_size': len(self._heap),
+                'next_due_in': (next_due - datetime.now()).total_seconds() if next_due else None,
+                'fired': self.fired,
+                'skipped': self.skipped,
+                'max_lag': self.max_lag
+            }
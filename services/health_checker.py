@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+from config.settings import (
+    HEALTH_CHECK_TIME_BUDGET,
+    HEALTH_CHECK_BATCH_SIZE,
+    HEALTH_CHECK_MIN_RECHECK,
+    HEALTH_CHECK_MAX_STALENESS,
+    HEALTH_CHECK_RISK_WINDOW
+)
+from database.db_manager import DatabaseManager
+from services.marzban_service import USER_NOT_FOUND
+
+logger = logging.getLogger('health_checker')
+
+
+class IncrementalHealthChecker:
+    """
+    Инкрементальная сверка активных устройств с Marzban.
+
+    За один запуск сверяется только срез устройств, укладывающийся в бюджет
+    времени; курсор - devices.last_checked_at. Первыми идут устройства, не
+    сверявшиеся дольше max_staleness (это и ограничивает период полного
+    обхода), затем отмеченные вебхуком, недавно созданные и скоро истекающие.
+    Устройство, сверенное меньше min_recheck назад, повторно не берется.
+
+    Конфиг снимается только по явному ответу панели: 404, статус disabled,
+    limited или expired. Если панель не ответила (таймаут, 5xx, очередь
+    запросов переполнена), устройство не отмечается сверенным и запуск
+    заканчивается - оно будет проверено в следующий раз.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, device_service, interval: int,
+                 time_budget: float = HEALTH_CHECK_TIME_BUDGET,
+                 batch_size: int = HEALTH_CHECK_BATCH_SIZE,
+                 min_recheck: int = HEALTH_CHECK_MIN_RECHECK,
+                 max_staleness: int = HEALTH_CHECK_MAX_STALENESS,
+                 risk_window: int = HEALTH_CHECK_RISK_WINDOW):
+        self.db_manager = db_manager
+        self.device_service = device_service
+        self.marzban = device_service.marzban
+        self.interval = interval  # минуты между запусками
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.min_recheck = timedelta(minutes=min_recheck)
+        self.max_staleness = timedelta(minutes=max_staleness)
+        self.risk_window = timedelta(hours=risk_window)
+        self._lock = threading.Lock()
+        self._throughput = None  # устройств в секунду, EWMA по запускам
+
+    def run_tick(self) -> Dict[str, Any]:
+        """Один запуск сверки в пределах бюджета времени."""
+        report = {'checked': 0, 'removed': 0, 'unanswered': 0, 'batches': 0, 'seconds': 0.0}
+        # Затянувшийся запуск не перекрывается следующим
+        if not self._lock.acquire(blocking=False):
+            logger.warning("Previous health check tick is still running, skipping")
+            return report
+
+        started = time.monotonic()
+        try:
+            batch_seconds = 0.0
+            with self.marzban.background():
+                while True:
+                    remaining = self.time_budget - (time.monotonic() - started)
+                    # Пакет, который не успеет завершиться в бюджете, переносим на следующий запуск
+                    if remaining <= 0 or (report['batches'] and batch_seconds > remaining):
+                        break
+
+                    batch_started = time.monotonic()
+                    now = datetime.now()
+                    devices = self.db_manager.get_devices_to_check(
+                        limit=self.batch_size,
+                        checked_before=now - self.min_recheck,
+                        overdue_before=now - self.max_staleness,
+                        recent_after=now - self.risk_window,
+                        expiring_before=now + self.risk_window
+                    )
+                    if not devices:
+                        break
+
+                    configs = self.marzban.get_user_configs([device.marzban_username for device in devices])
+                    answered = []
+                    for device in devices:
+                        config = configs.get(device.marzban_username)
+                        if config is None:
+                            report['unanswered'] += 1
+                            continue
+                        answered.append(device.id)
+                        if self._remove_if_inactive(device.marzban_username, config):
+                            report['removed'] += 1
+                    self.db_manager.mark_devices_checked(answered, now)
+
+                    report['checked'] += len(answered)
+                    report['batches'] += 1
+                    batch_seconds = time.monotonic() - batch_started
+                    if len(answered) < len(devices):
+                        # Панель не справляется - неотвеченные устройства повторим в следующий запуск
+                        logger.warning(f"Marzban did not answer for {len(devices) - len(answered)} devices, "
+                                       "ending health check tick early")
+                        break
+        except Exception as e:
+            logger.error(f"Error in health check tick: {e}")
+        finally:
+            report['seconds'] = time.monotonic() - started
+            self._lock.release()
+
+        if report['checked'] and report['seconds'] > 0:
+            rate = report['checked'] / report['seconds']
+            self._throughput = rate if self._throughput is None else 0.3 * rate + 0.7 * self._throughput
+
+        coverage = self.get_coverage()
+        report['coverage'] = coverage
+        if report['checked']:
+            logger.info(f"Health check: {report['checked']} devices in {report['seconds']:.1f}s, "
+                        f"{report['removed']} removed, coverage {coverage['covered']}/{coverage['active']}")
+        if coverage['cycle_seconds'] > self.max_staleness.total_seconds():
+            logger.warning(f"Full health check cycle ~{coverage['cycle_seconds'] / 60:.0f} min exceeds "
+                           f"{self.max_staleness.total_seconds() / 60:.0f} min, raise the time budget")
+        return report
+
+    def _remove_if_inactive(self, username: str, config: Dict[str, Any]) -> bool:
+        """Снятие конфига по ответу панели. True - устройство деактивировано."""
+        status = config.get('status')
+        if config is USER_NOT_FOUND:
+            removed = self.device_service.deactivate_deleted_config(username)
+        elif status in ('disabled', 'limited'):
+            removed = self.device_service.permanently_delete_config(username)
+        elif status == 'expired':
+            removed = self.device_service.permanently_delete_config(username, reason='expired')
+        else:
+            return False
+        if removed:
+            logger.info(f"Config {username} ({status}) was deactivated and removed")
+        return removed
+
+    def get_coverage(self) -> Dict[str, Any]:
+        """
+        Покрытие сверкой: сколько устройств сверено за max_staleness, сколько
+        не сверялось ни разу, возраст самой старой сверки и оценка периода
+        полного обхода при текущей пропускной способности.
+        """
+        now = datetime.now()
+        coverage = self.db_manager.get_check_coverage(now - self.max_staleness)
+        oldest = coverage.pop('oldest_checked_at')
+        if isinstance(oldest, str):
+            oldest = datetime.fromisoformat(oldest)
+        coverage['oldest_age_seconds'] = (now - oldest).total_seconds() if oldest else None
+
+        per_tick = (self._throughput or 0) * self.time_budget
+        if not coverage['active']:
+            coverage['cycle_seconds'] = 0.0
+        elif per_tick:
+            # Период обхода не короче min_recheck: раньше устройство повторно не берется
+            ticks = -(-coverage['active'] // max(int(per_tick), 1))
+            coverage['cycle_seconds'] = max(ticks * self.interval * 60, self.min_recheck.total_seconds())
+        else:
+            coverage['cycle_seconds'] = float('inf') if coverage['never_checked'] else 0.0
+        coverage['throughput'] = self._throughput or 0.0
+        return coverage
@@ -0,0 +1,181 @@
+import bisect
+from abc import ABC, abstractmethod
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from config.settings import NODE_BALANCING_STRATEGY, NODE_LOAD_CACHE_TTL
+
+logger = logging.getLogger('load_balancer')
+
+
+class BalancingStrategy(ABC):
+    """
+    Стратегия выбора ноды.
+
+    rebuild вызывается при обновлении снимка нагрузки, select - на каждое
+    новое устройство, assigned - после назначения, чтобы снимок оставался
+    актуальным между обновлениями.
+    """
+
+    name = ''
+
+    def rebuild(self, nodes: List[Dict], loads: Dict[str, float]) -> None:
+        self.nodes = nodes
+        self.loads = loads
+
+    @abstractmethod
+    def select(self) -> Optional[Dict]:
+        pass
+
+    def assigned(self, node: Dict) -> None:
+        pass
+
+    @staticmethod
+    def ratio(node: Dict, users: float) -> float:
+        """Загрузка относительно веса ноды."""
+        return users / max(node.get('weight', 1), 1e-9)
+
+
+class LeastLoadedStrategy(BalancingStrategy):
+    """Наименьшая загрузка относительно веса; куча дает O(log n) на выбор."""
+
+    name = 'least_loaded'
+
+    def rebuild(self, nodes: List[Dict], loads: Dict[str, float]) -> None:
+        super().rebuild(nodes, loads)
+        self._heap = [
+            (self.ratio(node, loads[node['address']]), index)
+            for index, node in enumerate(nodes)
+        ]
+        heapq.heapify(self._heap)
+
+    def select(self) -> Optional[Dict]:
+        return self.nodes[self._heap[0][1]] if self._heap else None
+
+    def assigned(self, node: Dict) -> None:
+        index = self._heap[0][1]
+        heapq.heapreplace(self._heap, (self.ratio(node, self.loads[node['address']]), index))
+
+
+class WeightedStrategy(BalancingStrategy):
+    """Случайный выбор пропорционально весу (бинарный поиск по префиксным суммам)."""
+
+    name = 'weighted'
+
+    def rebuild(self, nodes: List[Dict], loads: Dict[str, float]) -> None:
+        super().rebuild(nodes, loads)
+        self._cumulative = []
+        total = 0.0
+        for node in nodes:
+            total += max(node.get('weight', 1), 0)
+            self._cumulative.append(total)
+
+    def select(self) -> Optional[Dict]:
+        if not self.nodes or not self._cumulative[-1]:
+            return None
+        point = random.uniform(0, self._cumulative[-1])
+        index = min(bisect.bisect_left(self._cumulative, point), len(self.nodes) - 1)
+        return self.nodes[index]
+
+
+class PowerOfTwoStrategy(BalancingStrategy):
+    """Из двух случайных нод берется менее загруженная - O(1) на выбор."""
+
+    name = 'power_of_two'
+
+    def select(self) -> Optional[Dict]:
+        if len(self.nodes) < 2:
+            return self.nodes[0] if self.nodes else None
+        first, second = random.sample(self.nodes, 2)
+        if self.ratio(first, self.loads[first['address']]) <= self.ratio(second, self.loads[second['address']]):
+            return first
+        return second
+
+
+class CapacityCappedStrategy(BalancingStrategy):
+    """Обертка над другой стратегией, исключающая ноды с исчерпанным лимитом устройств."""
+
+    name = 'capacity_capped'
+
+    def __init__(self, inner: Optional[BalancingStrategy] = None):
+        self.inner = inner or LeastLoadedStrategy()
+
+    @staticmethod
+    def has_capacity(node: Dict, users: float) -> bool:
+        max_users = node.get('max_users') or 0
+        return max_users <= 0 or users < max_users
+
+    def rebuild(self, nodes: List[Dict], loads: Dict[str, float]) -> None:
+        super().rebuild(nodes, loads)
+        self.inner.rebuild([node for node in nodes if self.has_capacity(node, loads[node['address']])], loads)
+
+    def select(self) -> Optional[Dict]:
+        return self.inner.select()
+
+    def assigned(self, node: Dict) -> None:
+        if self.has_capacity(node, self.loads[node['address']]):
+            self.inner.assigned(node)
+        else:
+            # Нода заполнилась - убираем ее из кандидатов до следующего снимка
+            self.rebuild(self.nodes, self.loads)
+
+
+STRATEGIES = {
+    LeastLoadedStrategy.name: LeastLoadedStrategy,
+    WeightedStrategy.name: WeightedStrategy,
+    PowerOfTwoStrategy.name: PowerOfTwoStrategy,
+    CapacityCappedStrategy.name: CapacityCappedStrategy
+}
+
+
+class LoadBalancer:
+    """
+    Выбор ноды для нового устройства.
+
+    Нагрузка нод запрашивается у load_provider не чаще раза в cache_ttl
+    секунд; между обновлениями снимок поправляется на каждое назначение.
+    load_provider возвращает {address: пользователи} только для доступных нод.
+    """
+
+    def __init__(self, nodes: List[Dict], load_provider: Callable[[], Dict[str, float]],
+                 strategy: str = NODE_BALANCING_STRATEGY, cache_ttl: float = NODE_LOAD_CACHE_TTL):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.nodes = nodes
+        self.load_provider = load_provider
+        self.strategy = STRATEGIES[strategy]()
+        self.cache_ttl = cache_ttl
+        self._loads: Dict[str, float] = {}
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """Сброс снимка нагрузки (следующий выбор перечитает ее)."""
+        with self._lock:
+            self._refreshed_at = None
+
+    def _refresh(self) -> None:
+        loads = self.load_provider()
+        available = [node for node in self.nodes if node['address'] in loads]
+        self._loads = {node['address']: float(loads[node['address']]) for node in available}
+        self.strategy.rebuild(available, self._loads)
+        self._refreshed_at = time.monotonic()
+
+    def select(self) -> Optional[str]:
+        """IP выбранной ноды (None, если подходящих нод нет)."""
+        with self._lock:
+            if self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.cache_ttl:
+                self._refresh()
+
+            node = self.strategy.select()
+            if not node:
+                logger.warning(f"No node available ({self.strategy.name})")
+                return None
+
+            self._loads[node['address']] += 1
+            self.strategy.assigned(node)
+            return node['address']
@@ -0,0 +1,222 @@
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config.settings import (
+    MARZBAN_PANELS,
+    MARZBAN_DEFAULT_TEMPLATE,
+    MARZBAN_USERS_PAGE_SIZE,
+    MARZBAN_BULK_DELETE_CONCURRENCY
+)
+from database.db_manager import DatabaseManager
+from services.marzban_scheduler import MarzbanRequestScheduler
+from services.marzban_service import MarzbanService
+
+logger = logging.getLogger('marzban_cluster')
+
+
+class MarzbanCluster:
+    """
+    Несколько независимых панелей Marzban за интерфейсом MarzbanService.
+
+    У каждой панели свой MarzbanService (хост, токен, ограничитель запросов).
+    Операции с пользователем уходят на панель-владельца: она записана в
+    devices.panel / marzban_user_pool.panel, устройства без панели живут на
+    первой (основной) панели. Новые пользователи размещаются на панели с
+    наименьшей загрузкой относительно веса и с неисчерпанным max_users.
+    Телеметрия нод и информация о системе берутся с основной панели.
+    """
+
+    def __init__(self, node_manager, db_manager: DatabaseManager,
+                 panels: Optional[List[Dict[str, Any]]] = None,
+                 scheduler: MarzbanRequestScheduler = None):
+        panels = panels or MARZBAN_PANELS
+        self.node_manager = node_manager
+        self.db_manager = db_manager
+        self.panel_configs = {panel['name']: panel for panel in panels}
+        self.panels: Dict[str, MarzbanService] = {
+            panel['name']: MarzbanService(
+                host=panel['host'],
+                username=panel['username'],
+                password=panel['password'],
+                node_manager=node_manager,
+                scheduler=scheduler,
+                name=panel['name']
+            )
+            for panel in panels
+        }
+        self.default_panel = panels[0]['name']
+        self.host = self.panels[self.default_panel].host
+        self.logger = logging.getLogger('marzban_cluster')
+
+        self._traffic = threading.local()
+        self._owners_lock = threading.Lock()
+        # Пользователи пула удаляются из таблицы при выдаче, поэтому их панели запоминаем заранее
+        self._owners: Dict[str, str] = db_manager.get_pool_user_panels()
+
+    # --- классы запросов ---
+
+    @contextmanager
+    def traffic(self, traffic_class: str):
+        """Класс запросов внутри блока для всех панелей."""
+        previous = getattr(self._traffic, 'name', 'interactive')
+        self._traffic.name = traffic_class
+        try:
+            with ExitStack() as stack:
+                for panel in self.panels.values():
+                    stack.enter_context(panel.traffic(traffic_class))
+                yield self
+        finally:
+            self._traffic.name = previous
+
+    def background(self):
+        return self.traffic('background')
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, float]]:
+        """Статистика ожидания в ограничителях, суммированная по панелям."""
+        report: Dict[str, Dict[str, float]] = {}
+        for panel in self.panels.values():
+            for traffic_class, stats in panel.get_rate_limit_stats().items():
+                total = report.setdefault(traffic_class, {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+                total['requests'] += stats['requests']
+                total['wait_total'] += stats['wait_total']
+                total['wait_max'] = max(total['wait_max'], stats['wait_max'])
+        for stats in report.values():
+            stats['wait_avg'] = stats['wait_total'] / stats['requests'] if stats['requests'] else 0.0
+        return report
+
+    # --- маршрутизация ---
+
+    def get_panel_name(self, username: str) -> str:
+        """Панель-владелец пользователя."""
+        with self._owners_lock:
+            panel = self._owners.get(username)
+        if panel is None:
+            panel = self.db_manager.get_marzban_user_panel(username) or self.default_panel
+            with self._owners_lock:
+                self._owners[username] = panel
+        if panel not in self.panels:
+            self.logger.warning(f"Panel {panel} of {username} is not configured, using {self.default_panel}")
+            return self.default_panel
+        return panel
+
+    def panel_for(self, username: str) -> MarzbanService:
+        return self.panels[self.get_panel_name(username)]
+
+    def place(self) -> str:
+        """Панель для нового пользователя по загрузке и лимитам."""
+        loads = self.db_manager.get_panel_loads(self.default_panel)
+        candidates = []
+        for name, config in self.panel_configs.items():
+            load = loads.get(name, 0)
+            max_users = config.get('max_users') or 0
+            if max_users and load >= max_users:
+                continue
+            candidates.append((load / max(config.get('weight', 1), 1e-9), name))
+        if not candidates:
+            self.logger.warning("All Marzban panels are at capacity, using the default one")
+            return self.default_panel
+        return min(candidates)[1]
+
+    def _run_per_panel(self, func: Callable[[MarzbanService], Any],
+                       panels: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Параллельный вызов func для каждой панели с текущим классом запросов."""
+        traffic_class = getattr(self._traffic, 'name', 'interactive')
+        names = panels if panels is not None else list(self.panels)
+
+        def call(name: str) -> Any:
+            with self.panels[name].traffic(traffic_class):
+                return func(self.panels[name])
+
+        if len(names) <= 1:
+            return {name: call(name) for name in names}
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            return dict(zip(names, pool.map(call, names)))
+
+    def _group_by_panel(self, usernames: List[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for username in usernames:
+            groups.setdefault(self.get_panel_name(username), []).append(username)
+        return groups
+
+    # --- операции с пользователями ---
+
+    def create_user(self, username: str, days: Optional[int],
+                    template: str = MARZBAN_DEFAULT_TEMPLATE, status: str = "active") -> Optional[Dict]:
+        panel = self.place()
+        result = self.panels[panel].create_user(username, days, template=template, status=status)
+        if result:
+            with self._owners_lock:
+                self._owners[username] = panel
+        return result
+
+    def activate_user(self, username: str, days: int) -> Optional[Dict]:
+        return self.panel_for(username).activate_user(username, days)
+
+    def get_user_config(self, username: str) -> Optional[Dict]:
+        return self.panel_for(username).get_user_config(username)
+
+    def get_user_configs(self, usernames: List[str]) -> Dict[str, Optional[Dict]]:
+        """Конфигурации пользователей: панели опрашиваются параллельно."""
+        groups = self._group_by_panel(usernames)
+        results = self._run_per_panel(lambda panel: panel.get_user_configs(groups[panel.name]), list(groups))
+        return {username: config for configs in results.values() for username, config in configs.items()}
+
+    def update_user_config(self, username: str, days: int = None) -> Optional[Dict[str, Any]]:
+        return self.panel_for(username).update_user_config(username, days)
+
+    def delete_user(self, username: str) -> bool:
+        return self.panel_for(username).delete_user(username)
+
+    def delete_users(self, usernames: List[str],
+                     max_workers: int = MARZBAN_BULK_DELETE_CONCURRENCY) -> Dict[str, bool]:
+        groups = self._group_by_panel(usernames)
+        results = self._run_per_panel(
+            lambda panel: panel.delete_users(groups[panel.name], max_workers=max_workers), list(groups)
+        )
+        return {username: ok for deleted in results.values() for username, ok in deleted.items()}
+
+    def delete_expired_users(self, expired_before: datetime,
+                             expired_after: Optional[datetime] = None) -> Optional[List[str]]:
+        """Удаление истекших на всех панелях; None - ни одна панель не поддерживает метод."""
+        results = self._run_per_panel(lambda panel: panel.delete_expired_users(expired_before, expired_after))
+        supported = [removed for removed in results.values() if removed is not None]
+        if not supported:
+            return None
+        return [username for removed in supported for username in removed]
+
+    def get_user_usage(self, username: str) -> Optional[Dict[str, Any]]:
+        return self.panel_for(username).get_user_usage(username)
+
+    def reset_user_traffic(self, username: str) -> bool:
+        return self.panel_for(username).reset_user_traffic(username)
+
+    def iter_users(self, status: Optional[str] = None,
+                   page_size: int = MARZBAN_USERS_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        return itertools.chain.from_iterable(
+            panel.iter_users(status=status, page_size=page_size) for panel in self.panels.values()
+        )
+
+    def get_active_users_count(self) -> Optional[int]:
+        counts = self._run_per_panel(lambda panel: panel.get_active_users_count())
+        if any(count is None for count in counts.values()):
+            return None
+        return sum(counts.values())
+
+    # --- основная панель ---
+
+    def get_nodes_health(self) -> Dict[str, Any]:
+        return self.node_manager.get_nodes_status()
+
+    def get_server_info(self) -> Optional[Dict[str, Any]]:
+        return self.panels[self.default_panel].get_server_info()
+
+    def get_nodes(self) -> Optional[List[Dict[str, Any]]]:
+        return self.panels[self.default_panel].get_nodes()
+
+    def get_nodes_usage(self, start: datetime, end: datetime) -> Optional[List[Dict[str, Any]]]:
+        return self.panels[self.default_panel].get_nodes_usage(start, end)
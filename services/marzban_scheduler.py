@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from config.settings import (
+    MARZBAN_SCHEDULER_WORKERS,
+    MARZBAN_SCHEDULER_MAX_QUEUE,
+    MARZBAN_SCHEDULER_AGING
+)
+from utils.stats import percentile
+
+logger = logging.getLogger('marzban_scheduler')
+
+# Чем меньше число, тем выше приоритет
+DEFAULT_PRIORITIES = {
+    'interactive': 0,
+    'payment': 1,
+    'background': 2
+}
+
+
+class SchedulerQueueFull(Exception):
+    pass
+
+
+class MarzbanRequestScheduler:
+    """
+    Приоритетный планировщик запросов к Marzban.
+
+    Запросы ставятся в очереди по классам (interactive, payment, background)
+    и выполняются ограниченным пулом потоков. Приоритет заявки растет со
+    временем ожидания (aging), поэтому фоновые запросы не голодают бесконечно.
+    """
+
+    def __init__(self, workers: int = MARZBAN_SCHEDULER_WORKERS,
+                 max_queue: int = MARZBAN_SCHEDULER_MAX_QUEUE,
+                 aging_seconds: float = MARZBAN_SCHEDULER_AGING,
+                 priorities: Optional[Dict[str, int]] = None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.aging_seconds = aging_seconds
+        self.priorities = priorities or DEFAULT_PRIORITIES
+        self._queues: Dict[str, Deque[Tuple[float, Future, Callable, tuple, dict]]] = {
+            traffic_class: deque() for traffic_class in self.priorities
+        }
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._stop_flag = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._latencies: Dict[str, Dict[str, Deque[float]]] = {
+            traffic_class: {'wait': deque(maxlen=10000), 'total': deque(maxlen=10000)}
+            for traffic_class in self.priorities
+        }
+
+    def start(self) -> 'MarzbanRequestScheduler':
+        """Запуск пула рабочих потоков."""
+        if self._threads:
+            return self
+        self._stop_flag.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"MarzbanWorker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Marzban scheduler started with {self.workers} workers")
+        return self
+
+    def stop(self) -> None:
+        """Остановка рабочих потоков (оставшиеся заявки не выполняются)."""
+        self._stop_flag.set()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def submit(self, traffic_class: str, func: Callable, *args, **kwargs) -> Future:
+        """Постановка запроса в очередь своего класса."""
+        if traffic_class not in self._queues:
+            traffic_class = 'interactive'
+        future = Future()
+        with self._condition:
+            if self._pending >= self.max_queue:
+                raise SchedulerQueueFull(f"Marzban request queue is full ({self.max_queue})")
+            self._queues[traffic_class].append((time.monotonic(), future, func, args, kwargs))
+            self._pending += 1
+            self._condition.notify()
+        return future
+
+    def run(self, traffic_class: str, func: Callable, *args, **kwargs) -> Any:
+        """Выполнение запроса через очередь с ожиданием результата."""
+        # Вызов из рабочего потока выполняем сразу, иначе пул может заблокировать сам себя
+        if getattr(self._local, 'is_worker', False) or not self._threads:
+            return func(*args, **kwargs)
+        return self.submit(traffic_class, func, *args, **kwargs).result()
+
+    def _pick_next(self) -> Optional[Tuple[str, Tuple[float, Future, Callable, tuple, dict]]]:
+        """Выбор заявки с наилучшим приоритетом с учетом времени ожидания."""
+        now = time.monotonic()
+        best_class, best_score = None, None
+        for traffic_class, queue in self._queues.items():
+            if not queue:
+                continue
+            waited = now - queue[0][0]
+            score = self.priorities[traffic_class] - waited / self.aging_seconds
+            if best_score is None or score < best_score:
+                best_class, best_score = traffic_class, score
+        if best_class is None:
+            return None
+        self._pending -= 1
+        return best_class, self._queues[best_class].popleft()
+
+    def _worker_loop(self):
+        self._local.is_worker = True
+        while not self._stop_flag.is_set():
+            with self._condition:
+                item = self._pick_next()
+                while item is None and not self._stop_flag.is_set():
+                    self._condition.wait(timeout=1)
+                    item = self._pick_next()
+            if item is None:
+                return
+
+            traffic_class, (enqueued_at, future, func, args, kwargs) = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.monotonic()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            finished = time.monotonic()
+
+            with self._stats_lock:
+                self._latencies[traffic_class]['wait'].append(started - enqueued_at)
+                self._latencies[traffic_class]['total'].append(finished - enqueued_at)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Отчет по задержкам (мс) и глубине очередей по классам запросов."""
+        with self._condition:
+            depths = {traffic_class: len(queue) for traffic_class, queue in self._queues.items()}
+        report = {}
+        with self._stats_lock:
+            for traffic_class, series in self._latencies.items():
+                wait, total = list(series['wait']), list(series['total'])
+                report[traffic_class] = {
+                    'queue_depth': depths[traffic_class],
+                    'completed': len(total),
+                    'wait_p50_ms': percentile(wait, 50) * 1000,
+                    'wait_p95_ms': percentile(wait, 95) * 1000,
+                    'latency_p50_ms': percentile(total, 50) * 1000,
+                    'latency_p95_ms': percentile(total, 95) * 1000,
+                    'latency_p99_ms': percentile(total, 99) * 1000
+                }
+        return report
@@ -1,21 +1,94 @@
 import logging
 import requests
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Iterator, List
+from datetime import datetime, timedelta, timezone
 import json
+import itertools
+from config.settings import (
+    MARZBAN_USERS_PAGE_SIZE,
+    MARZBAN_USER_TEMPLATES,
+    MARZBAN_DEFAULT_TEMPLATE,
+    MARZBAN_INTERACTIVE_RPS,
+    MARZBAN_INTERACTIVE_BURST,
+    MARZBAN_BACKGROUND_RPS,
+    MARZBAN_BACKGROUND_BURST,
+    MARZBAN_BULK_DELETE_CONCURRENCY
+)
+from utils.json_stream import iter_json_array
+from utils.rate_limiter import TokenBucket
+from services.marzban_scheduler import MarzbanRequestScheduler
 
 logger = logging.getLogger('marzban_service')
 
+# Панель ответила 404: пользователя нет. В отличие от None (панель не ответила:
+# таймаут, 5xx, переполненная очередь) по такому ответу устройство можно снимать.
+USER_NOT_FOUND = {'status': 'not_found'}
+
 
 class MarzbanService:
-    def __init__(self, host: str, username: str, password: str, node_manager):
+    def __init__(self, host: str, username: str, password: str, node_manager,
+                 scheduler: MarzbanRequestScheduler = None, name: str = 'main'):
+        self.name = name
         self.host = host.rstrip('/')
         self.username = username
         self.password = password
         self.token = None
         self.node_manager = node_manager
+        self.scheduler = scheduler
         self.logger = logging.getLogger('marzban_service')
 
+        # Раздельные бюджеты запросов: фоновые проверки не съедают лимит пользователей
+        self.buckets = {
+            'interactive': TokenBucket(MARZBAN_INTERACTIVE_RPS, MARZBAN_INTERACTIVE_BURST),
+            'background': TokenBucket(MARZBAN_BACKGROUND_RPS, MARZBAN_BACKGROUND_BURST)
+        }
+        self._traffic = threading.local()
+        self._stats_lock = threading.Lock()
+        self._wait_stats = {
+            traffic_class: {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for traffic_class in ('interactive', 'payment', 'background')
+        }
+
+    @contextmanager
+    def traffic(self, traffic_class: str):
+        """Класс запросов внутри блока: interactive, payment или background."""
+        previous = getattr(self._traffic, 'name', 'interactive')
+        self._traffic.name = traffic_class
+        try:
+            yield self
+        finally:
+            self._traffic.name = previous
+
+    def background(self):
+        """Запросы внутри блока расходуют фоновый бюджет (проверки по расписанию)."""
+        return self.traffic('background')
+
+    def _throttle(self) -> str:
+        """Ожидание токена в бюджете текущего класса запросов."""
+        traffic_class = getattr(self._traffic, 'name', 'interactive')
+        # Платежные запросы делят бюджет с пользовательскими
+        waited = self.buckets.get(traffic_class, self.buckets['interactive']).acquire()
+        with self._stats_lock:
+            stats = self._wait_stats[traffic_class]
+            stats['requests'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+        return traffic_class
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, float]]:
+        """Статистика ожидания в очереди ограничителя по классам запросов."""
+        with self._stats_lock:
+            return {
+                traffic_class: {
+                    **stats,
+                    'wait_avg': stats['wait_total'] / stats['requests'] if stats['requests'] else 0.0
+                }
+                for traffic_class, stats in self._wait_stats.items()
+            }
+
     def _get_token(self) -> Optional[str]:
         """Получение токена для API Marzban."""
         try:
@@ -36,25 +109,46 @@ class MarzbanService:
             self.token = self._get_token()
         return {"Authorization": f"Bearer {self.token}"}
 
-    def create_user(self, username: str, days: int) -> Optional[Dict]:
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Запрос к API Marzban с авторизацией.
+        При истекшем токене (401) получаем новый и повторяем запрос один раз.
+        """
+        # Бюджет ждем в вызывающем потоке, чтобы не занимать рабочие потоки планировщика
+        traffic_class = self._throttle()
+        if self.scheduler:
+            return self.scheduler.run(traffic_class, self._send, method, path, **kwargs)
+        return self._send(method, path, **kwargs)
+
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = requests.request(method, f"{self.host}{path}", headers=self._get_headers(), **kwargs)
+        if response.status_code == 401:
+            self.logger.info("Marzban token expired, requesting a new one")
+            self.token = self._get_token()
+            response = requests.request(method, f"{self.host}{path}", headers=self._get_headers(), **kwargs)
+        return response
+
+    def create_user(self, username: str, days: Optional[int],
+                    template: str = MARZBAN_DEFAULT_TEMPLATE, status: str = "active") -> Optional[Dict]:
+        """
+        Создание пользователя по шаблону.
+        days=None и status="disabled" - заготовка для пула без срока действия.
+        """
         try:
-            response = requests.post(
-                f"{self.host}/api/user",
+            user_template = MARZBAN_USER_TEMPLATES[template]
+            response = self._request(
+                "POST",
+                "/api/user",
                 json={
                     "username": username,
-                    "expire": int((datetime.now() + timedelta(days=days)).timestamp()),
+                    "expire": int((datetime.now() + timedelta(days=days)).timestamp()) if days else 0,
                     "data_limit": 0,
-                    "proxies": {"vless": {"flow": ""}},
-                    "inbounds": {"vless": ["VLESS TCP REALITY"]},
+                    "proxies": user_template["proxies"],
+                    "inbounds": user_template["inbounds"],
                     "limit_ip": 1,
-                    "hosts": {
-                        "VLESS TCP REALITY": [
-                            {"remark": "Marz", "address": "150.241.108.35"},
-                            {"remark": "Marzban2", "address": "150.241.108.166"}
-                        ]
-                    }
+                    "status": status,
+                    "hosts": user_template["hosts"]
                 },
-                headers=self._get_headers(),
                 verify=False
             )
 
@@ -67,19 +161,57 @@ class MarzbanService:
             logger.error(f"Error creating user: {e}")
             return None
 
+    def activate_user(self, username: str, days: int) -> Optional[Dict]:
+        """Активация заготовленного пользователя: срок и статус одним запросом."""
+        try:
+            response = self._request(
+                "PUT",
+                f"/api/user/{username}",
+                json={
+                    "expire": int((datetime.now() + timedelta(days=days)).timestamp()),
+                    "status": "active"
+                },
+                verify=False
+            )
+
+            if response.status_code == 200:
+                return response.json()
+
+            self.logger.warning(f"Failed to activate pooled user {username}: HTTP {response.status_code}")
+            return None
+
+        except Exception as e:
+            self.logger.error(f"Error activating user: {e}")
+            return None
+
     def get_nodes_health(self) -> Dict[str, Any]:
         """Получение информации о здоровье всех нод"""
         return self.node_manager.get_nodes_status()
 
+    def get_panel_name(self, username: str) -> str:
+        """Панель, на которой живет пользователь (для одиночной панели - она сама)."""
+        return self.name
+
+    def get_user_configs(self, usernames: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        Конфигурации нескольких пользователей (для фоновых проверок).
+        USER_NOT_FOUND - панель ответила 404, None - ответа нет.
+        """
+        return {username: self._fetch_user_config(username) for username in usernames}
+
     def get_user_config(self, username: str) -> Optional[Dict]:
         """Получение конфигурации пользователя."""
+        config = self._fetch_user_config(username)
+        return None if config is USER_NOT_FOUND else config
+
+    def _fetch_user_config(self, username: str) -> Optional[Dict]:
         try:
             self.logger.info(f"Getting config for user {username}")
             self.logger.info(f"Making request to: {self.host}/api/user/{username}")
 
-            response = requests.get(
-                f"{self.host}/api/user/{username}",
-                headers=self._get_headers(),
+            response = self._request(
+                "GET",
+                f"/api/user/{username}",
                 verify=False
             )
 
@@ -88,6 +220,8 @@ class MarzbanService:
 
             if response.status_code == 200:
                 return response.json()
+            if response.status_code == 404:
+                return USER_NOT_FOUND
             return None
 
         except Exception as e:
@@ -97,21 +231,72 @@ class MarzbanService:
     def delete_user(self, username: str) -> bool:
         """Удаление пользователя."""
         try:
-            response = requests.delete(
-                f"{self.host}/api/user/{username}",
-                headers=self._get_headers()
+            response = self._request(
+                "DELETE",
+                f"/api/user/{username}"
             )
             return response.status_code == 200
         except Exception as e:
             self.logger.error(f"Error deleting user: {e}")
             return False
 
+    def delete_expired_users(self, expired_before: datetime,
+                             expired_after: Optional[datetime] = None) -> Optional[List[str]]:
+        """
+        Удаление всех истекших пользователей одним запросом.
+        Возвращает список удаленных usernames или None, если панель не поддерживает метод.
+        Наивные даты считаются локальным временем; панель сравнивает сроки в UTC,
+        поэтому границы передаются с явной зоной UTC.
+        """
+        try:
+            params = {'expired_before': expired_before.astimezone(timezone.utc).isoformat()}
+            if expired_after:
+                params['expired_after'] = expired_after.astimezone(timezone.utc).isoformat()
+
+            response = self._request(
+                "DELETE",
+                "/api/users/expired",
+                params=params
+            )
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code == 404 and 'No expired users' in response.text:
+                return []
+            self.logger.warning(f"Bulk expired users removal unavailable: HTTP {response.status_code}")
+            return None
+        except Exception as e:
+            self.logger.error(f"Error deleting expired users: {e}")
+            return None
+
+    def delete_users(self, usernames: List[str],
+                     max_workers: int = MARZBAN_BULK_DELETE_CONCURRENCY) -> Dict[str, bool]:
+        """
+        Пакетное параллельное удаление пользователей.
+        Уже отсутствующий в панели пользователь считается удаленным.
+        """
+        traffic_class = getattr(self._traffic, 'name', 'interactive')
+
+        def delete(username: str) -> bool:
+            # Класс запросов хранится в потоке, передаем его в рабочие потоки пула
+            with self.traffic(traffic_class):
+                try:
+                    response = self._request("DELETE", f"/api/user/{username}")
+                    return response.status_code in (200, 404)
+                except Exception as e:
+                    self.logger.error(f"Error deleting user {username}: {e}")
+                    return False
+
+        if not usernames:
+            return {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(usernames, pool.map(delete, usernames)))
+
     def get_user_usage(self, username: str) -> Optional[Dict[str, Any]]:
         """Получение статистики использования."""
         try:
-            response = requests.get(
-                f"{self.host}/api/user/{username}/usage",
-                headers=self._get_headers()
+            response = self._request(
+                "GET",
+                f"/api/user/{username}/usage"
             )
             if response.status_code == 200:
                 return response.json()
@@ -123,9 +308,9 @@ class MarzbanService:
     def reset_user_traffic(self, username: str) -> bool:
         """Сброс статистики трафика пользователя."""
         try:
-            response = requests.post(
-                f"{self.host}/api/user/{username}/reset",
-                headers=self._get_headers()
+            response = self._request(
+                "POST",
+                f"/api/user/{username}/reset"
             )
             return response.status_code == 200
         except Exception as e:
@@ -135,9 +320,9 @@ class MarzbanService:
     def get_server_info(self) -> Optional[Dict[str, Any]]:
         """Получение информации о сервере Marzban."""
         try:
-            response = requests.get(
-                f"{self.host}/api/system",
-                headers=self._get_headers()
+            response = self._request(
+                "GET",
+                "/api/system"
             )
             if response.status_code == 200:
                 return response.json()
@@ -146,17 +331,106 @@ class MarzbanService:
             self.logger.error(f"Error getting server info: {e}")
             return None
 
-    def get_active_users_count(self) -> Optional[int]:
-        """Получение количества активных пользователей."""
+    def iter_users(self, status: Optional[str] = None,
+                   page_size: int = MARZBAN_USERS_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """
+        Постраничный потоковый обход пользователей Marzban.
+
+        Фильтр по статусу передается панели; каждая страница разбирается
+        инкрементально, поэтому память не зависит от числа пользователей.
+        """
+        offset = 0
+        first_username = None
+        while True:
+            params = {'offset': offset, 'limit': page_size}
+            if status:
+                params['status'] = status
+
+            response = self._request("GET", "/api/users", params=params, stream=True)
+            try:
+                if response.status_code != 200:
+                    self.logger.error(f"Error listing users: HTTP {response.status_code}")
+                    return
+
+                count = 0
+                for user in iter_json_array(response.iter_content(chunk_size=64 * 1024), key='users'):
+                    count += 1
+                    if count == 1:
+                        # Панель без поддержки offset вернет ту же страницу повторно
+                        if offset and user.get('username') == first_username:
+                            return
+                        if not offset:
+                            first_username = user.get('username')
+                    # Старые версии панели игнорируют фильтр по статусу
+                    if status and user.get('status') != status:
+                        continue
+                    yield user
+            finally:
+                response.close()
+
+            # Неполная страница (или панель без пагинации) - это последняя страница
+            if count != page_size:
+                return
+            offset += page_size
+
+    def get_nodes(self) -> Optional[List[Dict[str, Any]]]:
+        """Список нод Marzban (без мастер-сервера)."""
         try:
-            response = requests.get(
-                f"{self.host}/api/users",
-                headers=self._get_headers()
+            response = self._request("GET", "/api/nodes")
+            if response.status_code == 200:
+                return response.json()
+            return None
+        except Exception as e:
+            self.logger.error(f"Error getting nodes: {e}")
+            return None
+
+    def get_nodes_usage(self, start: datetime, end: datetime) -> Optional[List[Dict[str, Any]]]:
+        """Трафик по нодам за период (node_id=None - мастер-сервер)."""
+        try:
+            response = self._request(
+                "GET",
+                "/api/nodes/usage",
+                params={'start': start.astimezone(timezone.utc).isoformat(),
+                        'end': end.astimezone(timezone.utc).isoformat()}
             )
             if response.status_code == 200:
-                users = response.json()
-                return len([u for u in users if u.get('status') == 'active'])
+                return response.json().get('usages', [])
+            return None
+        except Exception as e:
+            self.logger.error(f"Error getting nodes usage: {e}")
             return None
+
+    def get_active_users_count(self) -> Optional[int]:
+        """Получение количества активных пользователей."""
+        try:
+            # Быстрый путь: панель сама считает пользователей по фильтру
+            response = self._request(
+                "GET",
+                "/api/users",
+                params={'status': 'active', 'limit': 1},
+                stream=True
+            )
+            try:
+                if response.status_code != 200:
+                    return None
+
+                chunks = response.iter_content(chunk_size=64 * 1024)
+                head = next(chunks, b'')
+                if head.lstrip().startswith(b'['):
+                    # Панель без пагинации вернула весь список - считаем на лету
+                    return sum(
+                        1 for u in iter_json_array(itertools.chain([head], chunks))
+                        if u.get('status') == 'active'
+                    )
+
+                data = json.loads(head + b''.join(chunks))
+                if 'total' in data and all(u.get('status') == 'active' for u in data.get('users', [])):
+                    return data['total']
+            finally:
+                response.close()
+
+            # Панель не вернула total - считаем потоково, не держа список в памяти
+            return sum(1 for _ in self.iter_users(status='active'))
         except Exception as e:
             self.logger.error(f"Error getting active users count: {e}")
             return None
@@ -172,9 +446,9 @@ class MarzbanService:
             if days:
                 update_data["expire"] = (datetime.now() + timedelta(days=days)).isoformat()
 
-            response = requests.put(
-                f"{self.host}/api/user/{username}",
-                headers=self._get_headers(),
+            response = self._request(
+                "PUT",
+                f"/api/user/{username}",
                 json=update_data
             )
 
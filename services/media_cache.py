@@ -0,0 +1,129 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+from database.db_manager import DatabaseManager
+
+logger = logging.getLogger('media_cache')
+
+_SENDERS = {'photo': 'send_photo', 'animation': 'send_animation', 'document': 'send_document'}
+
+
+def _is_invalid_file_id(error: ApiTelegramException) -> bool:
+    """Ошибка относится к самому file_id (удален, от другого бота, неверный тип)."""
+    description = (error.description or '').lower()
+    return error.error_code == 400 and ('file' in description or 'identifier' in description)
+
+
+class MediaCache:
+    """
+    Повторная отправка медиа в Telegram по file_id.
+
+    После первой загрузки Telegram возвращает file_id, который можно отправлять
+    вместо содержимого. file_id хранятся в БД (media_files) по хешу содержимого
+    и типу сообщения, поэтому переживают перезапуск. Если Telegram отклоняет
+    сохраненный file_id, он удаляется и файл загружается заново.
+    """
+
+    def __init__(self, bot: TeleBot, db_manager: DatabaseManager):
+        self.bot = bot
+        self.db_manager = db_manager
+        self._file_ids: Dict[Tuple[str, str], str] = db_manager.get_media_file_ids()
+        self._lock = threading.Lock()
+        # Содержимое локальных файлов: путь -> (mtime, хеш, байты)
+        self._files: Dict[str, Tuple[float, str, bytes]] = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def send_photo(self, chat_id: int, content: bytes, **kwargs):
+        return self._send('photo', chat_id, content, 'qr.png', **kwargs)
+
+    def send_animation(self, chat_id: int, content: bytes, filename: str = 'animation.gif', **kwargs):
+        return self._send('animation', chat_id, content, filename, **kwargs)
+
+    def send_document(self, chat_id: int, content: bytes, filename: str, **kwargs):
+        return self._send('document', chat_id, content, filename, **kwargs)
+
+    def send_animation_file(self, chat_id: int, path: str, fallback_url: Optional[str] = None, **kwargs):
+        """Анимация из локального файла; без файла - по ссылке."""
+        loaded = self._load_file(path)
+        if loaded is None:
+            if fallback_url:
+                return self.bot.send_animation(chat_id, fallback_url, **kwargs)
+            raise FileNotFoundError(path)
+        content_hash, content = loaded
+        return self._send('animation', chat_id, content, os.path.basename(path),
+                          content_hash=content_hash, **kwargs)
+
+    def _load_file(self, path: str) -> Optional[Tuple[str, bytes]]:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            logger.warning(f"Media file {path} not found")
+            return None
+        cached = self._files.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        with open(path, 'rb') as f:
+            content = f.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        self._files[path] = (mtime, content_hash, content)
+        return content_hash, content
+
+    @staticmethod
+    def _hash(kind: str, content: bytes, filename: str) -> str:
+        digest = hashlib.sha256(content)
+        # У документа имя файла видно получателю, поэтому оно входит в ключ
+        if kind == 'document':
+            digest.update(filename.encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _extract_file_id(kind: str, message) -> Optional[str]:
+        if kind == 'photo':
+            return message.photo[-1].file_id if message.photo else None
+        media = getattr(message, kind, None) or message.document
+        return media.file_id if media else None
+
+    def _send(self, kind: str, chat_id: int, content: bytes, filename: str,
+              content_hash: Optional[str] = None, **kwargs):
+        content_hash = content_hash or self._hash(kind, content, filename)
+        key = (content_hash, kind)
+        sender = getattr(self.bot, _SENDERS[kind])
+
+        with self._lock:
+            file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                message = sender(chat_id, file_id, **kwargs)
+                self.reused += 1
+                return message
+            except ApiTelegramException as e:
+                if not _is_invalid_file_id(e):
+                    raise
+                logger.warning(f"Cached {kind} file_id rejected ({e.description}), uploading again")
+                with self._lock:
+                    self._file_ids.pop(key, None)
+                self.db_manager.delete_media_file_id(content_hash, kind)
+
+        upload = io.BytesIO(content)
+        upload.name = filename
+        message = sender(chat_id, upload, **kwargs)
+        self.uploads += 1
+
+        file_id = self._extract_file_id(kind, message)
+        if file_id:
+            with self._lock:
+                self._file_ids[key] = file_id
+            self.db_manager.save_media_file_id(content_hash, kind, file_id)
+        return message
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'file_ids': len(self._file_ids), 'uploads': self.uploads, 'reused': self.reused}
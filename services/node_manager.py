@@ -1,29 +1,90 @@
 import logging
 import requests
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, List, Set, Tuple
 from datetime import datetime
+from urllib.parse import urlparse
+
+from config.settings import (
+    VPN_NODES,
+    NODE_TELEMETRY_ALPHA,
+    NODE_TELEMETRY_STALE_AFTER,
+    NODE_BALANCING_STRATEGY,
+    NODE_PROBE_PORTS
+)
+from services.load_balancer import LoadBalancer
 
 logger = logging.getLogger('node_manager')
 
 
+class _Ewma:
+    """Экспоненциально взвешенное среднее с моментом последнего замера."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.value: Optional[float] = None
+        self.updated_at: Optional[float] = None
+
+    def update(self, sample: float, sampled_at: float) -> None:
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value = self.alpha * sample + (1 - self.alpha) * self.value
+        self.updated_at = sampled_at
+
+    def age(self, now: float) -> Optional[float]:
+        return None if self.updated_at is None else now - self.updated_at
+
+
 class NodeManager:
-    def __init__(self):
+    def __init__(self, nodes: Optional[List[Dict[str, Any]]] = None,
+                 strategy: str = NODE_BALANCING_STRATEGY, db_manager=None):
         """
         Инициализация NodeManager.
         Теперь работаем только с главным сервером Marzban, так как он сам управляет нодами.
+        Список нод берется из VPN_NODES; при переданном db_manager реестр нод
+        и счетчики устройств хранятся в БД.
         """
+        self.db_manager = db_manager
+        config = [self._parse_node(node) for node in (nodes or VPN_NODES)]
+        if db_manager:
+            db_manager.register_nodes(config)
+            config = db_manager.get_nodes()
+
         self.nodes = {
-            'Master': {
-                'host': 'http://150.241.108.35:7575',
-                'current_users': 0,
-                'max_users': 2
-            },
-            'Marzban2': {
-                'host': 'http://150.241.108.166:62051',
-                'current_users': 0,
-                'max_users': 2
+            node['name']: {
+                'host': node['host'],
+                'address': node['address'],
+                'port': node.get('port'),
+                'weight': node.get('weight', 1),
+                'current_users': node.get('current_users', 0),
+                'max_users': node.get('max_users', 0)
             }
+            for node in config
+        }
+        # Индексы для точного поиска ноды по IP и по паре (IP, порт)
+        self._by_address = {node['address']: node_name for node_name, node in self.nodes.items()}
+        self._by_endpoint = {
+            (node['address'], node['port']): node_name
+            for node_name, node in self.nodes.items() if node['port']
         }
+        # Телеметрия нод (заполняется NodeTelemetryCollector)
+        self.alpha = NODE_TELEMETRY_ALPHA
+        self.stale_after = NODE_TELEMETRY_STALE_AFTER
+        self.telemetry = {
+            node_name: {metric: _Ewma(self.alpha) for metric in ('users', 'bandwidth', 'cpu')}
+            for node_name in self.nodes
+        }
+        self.node_status: Dict[str, Dict[str, Any]] = {}
+        # Адреса для активной проверки (IP, порт) и их доступность (заполняет NodeLatencyProber)
+        self._node_endpoints: Dict[str, Set[Tuple[str, int]]] = {
+            node_name: {(node['address'], port) for port in NODE_PROBE_PORTS}
+            for node_name, node in self.nodes.items()
+        }
+        self.endpoint_health: Dict[Tuple[str, int], bool] = {}
+        self._lock = threading.Lock()
+        self.balancer = LoadBalancer(list(self.nodes.values()), self.get_balancer_loads, strategy=strategy)
         self.initialize_nodes()
 
     def initialize_nodes(self):
@@ -37,55 +98,202 @@ class NodeManager:
         except Exception as e:
             logger.error(f"Error initializing nodes: {e}")
 
-    def update_node_stats(self, node_name: str):
+    def update_node_stats(self, node_name: str, samples: Optional[Dict[str, float]] = None,
+                          status: Optional[str] = None, sampled_at: Optional[float] = None):
         """
-        Обновление статистики ноды
+        Обновление статистики ноды замерами телеметрии.
+
+        Args:
+            node_name: Имя ноды
+            samples: Замеры {'users', 'bandwidth' (байт/с), 'cpu' (%)}
+            status: Статус ноды в Marzban (connected, error, ...)
+            sampled_at: Время замера (time.time())
         """
         try:
-            node = self.nodes[node_name]
-            logger.info(f"Updating stats for node {node_name}")
-            # В будущем здесь можно добавить получение реальной статистики
-            # Пока используем локальный счетчик
+            if node_name not in self.nodes:
+                logger.warning(f"Telemetry for unknown node {node_name}")
+                return
+            sampled_at = sampled_at or time.time()
+            with self._lock:
+                for metric, value in (samples or {}).items():
+                    if value is not None and metric in self.telemetry[node_name]:
+                        self.telemetry[node_name][metric].update(float(value), sampled_at)
+                if status:
+                    self.node_status[node_name] = {'status': status, 'updated_at': sampled_at}
+            logger.debug(f"Updated stats for node {node_name}: {samples}, status={status}")
         except Exception as e:
             logger.error(f"Error updating node stats for {node_name}: {e}")
 
-    def get_node_users(self, host: str) -> int:
+    def _fresh_value(self, node_name: str, metric: str, now: float) -> Optional[float]:
+        """Сглаженное значение метрики, если замер не устарел."""
+        ewma = self.telemetry[node_name][metric]
+        age = ewma.age(now)
+        if age is None or age > self.stale_after:
+            return None
+        return ewma.value
+
+    def get_node_load(self, node_name: str) -> float:
         """
-        Получение количества пользователей на узле
+        Загрузка ноды в процентах.
+
+        Берется по свежей телеметрии (пользователи относительно лимита и CPU),
+        при устаревших замерах - по локальному счетчику. Нода, которую Marzban
+        считает отключенной или которая не отвечает на проверки, получает
+        бесконечную загрузку.
+        """
+        node = self.nodes[node_name]
+        now = time.time()
+        if not self.is_node_healthy(node_name):
+            return float('inf')
+        with self._lock:
+            status = self.node_status.get(node_name)
+            if status and now - status['updated_at'] <= self.stale_after and status['status'] != 'connected':
+                return float('inf')
+            users = self._fresh_value(node_name, 'users', now)
+            cpu = self._fresh_value(node_name, 'cpu', now)
+
+        if users is None:
+            users = node['current_users']
+        load = (users / node['max_users'] * 100) if node['max_users'] > 0 else 0
+        if cpu is not None:
+            load = max(load, cpu)
+        return load
+
+    def has_fresh_telemetry(self, node_name: str) -> bool:
+        now = time.time()
+        with self._lock:
+            return self._fresh_value(node_name, 'users', now) is not None
+
+    def get_endpoints(self) -> List[Tuple[str, int]]:
+        """Все известные адреса нод (IP, порт) для активной проверки."""
+        with self._lock:
+            return sorted(set().union(*self._node_endpoints.values()))
+
+    def register_links(self, links: List[str]) -> None:
+        """Запоминает адреса нод из выданных ссылок, чтобы проверять именно их."""
+        for link in links:
+            address, port = self._split_host(link)
+            node_name = self._by_address.get(address)
+            if node_name and port:
+                endpoint = (address, port)
+                if endpoint not in self._node_endpoints[node_name]:
+                    with self._lock:
+                        self._node_endpoints[node_name].add(endpoint)
+
+    def set_endpoint_health(self, address: str, port: int, healthy: bool) -> None:
+        with self._lock:
+            previous = self.endpoint_health.get((address, port))
+            self.endpoint_health[(address, port)] = healthy
+        if previous is not None and previous != healthy:
+            logger.warning(f"Endpoint {address}:{port} is now {'healthy' if healthy else 'unhealthy'}")
+
+    def is_endpoint_healthy(self, address: str, port: Optional[int]) -> bool:
+        """Доступность адреса; без результатов проверок адрес считается доступным."""
+        if port is None:
+            node_name = self._by_address.get(address)
+            return self.is_node_healthy(node_name) if node_name else True
+        return self.endpoint_health.get((address, port), True)
+
+    def is_node_healthy(self, node_name: str) -> bool:
+        """Нода недоступна, только если не прошли проверки все ее адреса."""
+        with self._lock:
+            return any(
+                self.endpoint_health.get(endpoint, True)
+                for endpoint in self._node_endpoints[node_name]
+            ) or not self._node_endpoints[node_name]
+
+    def select_link(self, links: List[str], server_ip: Optional[str] = None) -> Optional[str]:
         """
-        for node in self.nodes.values():
-            if host in node['host']:
-                return node['current_users']
-        return 0
+        Ссылка для устройства: на его сервере, если тот доступен,
+        иначе на наименее загруженной доступной ноде.
+        """
+        if not links:
+            return None
+        self.register_links(links)
+        healthy = [link for link in links if self.is_endpoint_healthy(*self._split_host(link))]
+        if server_ip:
+            for link in healthy:
+                if self._split_host(link)[0] == server_ip:
+                    return link
+        if not healthy:
+            logger.warning("All nodes in links are unhealthy, returning first link")
+            return links[0]
+        if not server_ip:
+            return healthy[0]
+        if any(self._split_host(link)[0] == server_ip for link in links):
+            logger.warning(f"Server {server_ip} is unhealthy, switching link to another node")
+        return self.select_optimal_config({'links': healthy}) or healthy[0]
+
+    def get_balancer_loads(self) -> Dict[str, float]:
+        """Пользователи по IP доступных нод (отключенные и не отвечающие пропускаются)."""
+        now = time.time()
+        healthy = {node_name for node_name in self.nodes if self.is_node_healthy(node_name)}
+        loads = {}
+        with self._lock:
+            for node_name, node in self.nodes.items():
+                if node_name not in healthy:
+                    continue
+                status = self.node_status.get(node_name)
+                if status and now - status['updated_at'] <= self.stale_after and status['status'] != 'connected':
+                    continue
+                users = self._fresh_value(node_name, 'users', now)
+                loads[node['address']] = node['current_users'] if users is None else users
+        return loads
 
-    def increment_node_users(self, host: str) -> bool:
+    def select_optimal_server(self) -> Optional[str]:
         """
-        Увеличение счетчика пользователей для узла
+        IP ноды для нового устройства по стратегии балансировки.
+
+        Returns:
+            str: IP адрес или None, если свежей телеметрии нет
         """
+        if not any(self.has_fresh_telemetry(node_name) for node_name in self.nodes):
+            return None
+        return self.balancer.select()
+
+    @staticmethod
+    def _parse_node(node: Dict[str, Any]) -> Dict[str, Any]:
+        parsed = urlparse(node['host'])
+        return {
+            **node,
+            'address': node.get('address') or parsed.hostname,
+            'port': node.get('port') or parsed.port
+        }
+
+    @staticmethod
+    def _split_host(host: str) -> Tuple[Optional[str], Optional[int]]:
+        """Разбор 'http://ip:port', 'vless://id@ip:port?...', 'ip:port' или 'ip'."""
+        parsed = urlparse(host if '://' in host else f"//{host}")
         try:
-            for node in self.nodes.values():
-                if host in node['host']:
-                    if node['current_users'] < node['max_users']:
-                        node['current_users'] += 1
-                        logger.info(f"Incremented users for node {host}: {node['current_users']}")
-                        return True
-            return False
-        except Exception as e:
-            logger.error(f"Error incrementing node users: {e}")
-            return False
+            return parsed.hostname, parsed.port
+        except ValueError:
+            return parsed.hostname, None
+
+    def find_node(self, host: str) -> Optional[str]:
+        """Имя ноды по адресу (точное совпадение IP, при указанном порте - пары IP и порта)."""
+        address, port = self._split_host(host)
+        if port is not None and (address, port) in self._by_endpoint:
+            return self._by_endpoint[(address, port)]
+        return self._by_address.get(address)
+
+    def reload_counters(self) -> None:
+        """Обновление счетчиков устройств из реестра в БД."""
+        if not self.db_manager:
+            return
+        counters = self.db_manager.get_node_counters()
+        for node_name, node in self.nodes.items():
+            node['current_users'] = counters.get(node['address'], node['current_users'])
 
-    def decrement_node_users(self, host: str):
+    def get_node_users(self, host: str) -> int:
         """
-        Уменьшение счетчика пользователей для узла
+        Получение количества пользователей на узле
         """
-        try:
-            for node in self.nodes.values():
-                if host in node['host']:
-                    if node['current_users'] > 0:
-                        node['current_users'] -= 1
-                        logger.info(f"Decremented users for node {host}: {node['current_users']}")
-        except Exception as e:
-            logger.error(f"Error decrementing node users: {e}")
+        node_name = self.find_node(host)
+        if not node_name:
+            return 0
+        with self._lock:
+            users = self._fresh_value(node_name, 'users', time.time())
+        return self.nodes[node_name]['current_users'] if users is None else round(users)
 
     def get_node_host(self, node_name: str) -> str:
         """
@@ -97,12 +305,26 @@ class NodeManager:
         """
         Получение статуса всех нод
         """
+        now = time.time()
         status = {}
         for node_name, node in self.nodes.items():
+            with self._lock:
+                telemetry = {}
+                for metric, ewma in self.telemetry[node_name].items():
+                    age = ewma.age(now)
+                    telemetry[metric] = {
+                        'value': ewma.value,
+                        'age_seconds': age,
+                        'stale': age is None or age > self.stale_after
+                    }
+                node_status = self.node_status.get(node_name, {}).get('status')
             status[node_name] = {
                 'host': node['host'],
                 'current_users': node['current_users'],
-                'max_users': node['max_users']
+                'max_users': node['max_users'],
+                'status': node_status,
+                'load': self.get_node_load(node_name),
+                'telemetry': telemetry
             }
         return status
 
@@ -127,21 +349,20 @@ class NodeManager:
             for link in links:
                 try:
                     # Извлекаем хост из ссылки
-                    host = link.split('@')[1].split(':')[0]
+                    host, port = self._split_host(link)
+                    if not self.is_endpoint_healthy(host, port):
+                        logger.info(f"Skipping unhealthy node {host}:{port}")
+                        continue
 
                     # Проверяем, что это известная нода
-                    node_info = None
-                    for node_name, node in self.nodes.items():
-                        if host in node['host']:
-                            node_info = node
-                            break
-
-                    if node_info:
-                        current_users = node_info['current_users']
-                        max_users = node_info['max_users']
-
-                        # Вычисляем процент загрузки
-                        load_percentage = (current_users / max_users * 100) if max_users > 0 else 100
+                    node_name = self._by_address.get(host)
+
+                    if node_name:
+                        max_users = self.nodes[node_name]['max_users']
+                        current_users = self.get_node_users(host)
+
+                        # Процент загрузки по телеметрии (или по счетчику, если она устарела)
+                        load_percentage = self.get_node_load(node_name)
 
                         node_stats[link] = {
                             'load': load_percentage,
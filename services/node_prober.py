@@ -0,0 +1,120 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Tuple
+
+from config.settings import (
+    NODE_PROBE_INTERVAL,
+    NODE_PROBE_TIMEOUT,
+    NODE_PROBE_CONCURRENCY,
+    NODE_PROBE_WINDOW,
+    NODE_PROBE_FAILURE_THRESHOLD
+)
+from services.node_manager import NodeManager
+from utils.network import measure_tcp_latency
+from utils.stats import percentile
+
+logger = logging.getLogger('node_prober')
+
+
+class NodeLatencyProber:
+    """
+    Фоновая проверка задержки TCP-подключения к нодам.
+
+    Каждый цикл параллельно проверяет все известные адреса нод (IP и порты из
+    выданных ссылок), поэтому частота проверок зависит только от числа адресов,
+    а не от числа пользователей. Адрес помечается недоступным после нескольких
+    неудачных проверок подряд и снова доступным после первой успешной.
+    """
+
+    def __init__(self, node_manager: NodeManager,
+                 interval: int = NODE_PROBE_INTERVAL,
+                 timeout: float = NODE_PROBE_TIMEOUT,
+                 concurrency: int = NODE_PROBE_CONCURRENCY,
+                 window: int = NODE_PROBE_WINDOW,
+                 failure_threshold: int = NODE_PROBE_FAILURE_THRESHOLD):
+        self.node_manager = node_manager
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.window = window
+        self.failure_threshold = failure_threshold
+        # Последние замеры по адресу: задержка в секундах или None при неудаче
+        self._samples: Dict[Tuple[str, int], Deque[Optional[float]]] = {}
+        self._failures: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+        self._stop_flag = threading.Event()
+        self._thread = None
+
+    def probe_all(self) -> Dict[Tuple[str, int], Optional[float]]:
+        """Один цикл проверки всех адресов. Возвращает замеры по адресам."""
+        endpoints = self.node_manager.get_endpoints()
+        if not endpoints:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(endpoints))) as executor:
+            latencies = list(executor.map(
+                lambda endpoint: measure_tcp_latency(endpoint[0], endpoint[1], self.timeout),
+                endpoints
+            ))
+
+        results = dict(zip(endpoints, latencies))
+        for (address, port), latency in results.items():
+            self._record(address, port, latency)
+        return results
+
+    def _record(self, address: str, port: int, latency: Optional[float]) -> None:
+        endpoint = (address, port)
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self.window)).append(latency)
+            failures = 0 if latency is not None else self._failures.get(endpoint, 0) + 1
+            self._failures[endpoint] = failures
+
+        if latency is None:
+            logger.debug(f"Probe to {address}:{port} failed ({failures} in a row)")
+        self.node_manager.set_endpoint_health(address, port, failures < self.failure_threshold)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Перцентили задержки (мс) и доля неудачных проверок по адресам."""
+        report = {}
+        with self._lock:
+            for (address, port), samples in self._samples.items():
+                succeeded = [latency for latency in samples if latency is not None]
+                report[f"{address}:{port}"] = {
+                    'probes': len(samples),
+                    'loss': 1 - len(succeeded) / len(samples),
+                    'p50_ms': percentile(succeeded, 50) * 1000,
+                    'p95_ms': percentile(succeeded, 95) * 1000,
+                    'p99_ms': percentile(succeeded, 99) * 1000,
+                    'consecutive_failures': self._failures.get((address, port), 0),
+                    'healthy': self._failures.get((address, port), 0) < self.failure_threshold
+                }
+        return report
+
+    def _probe_loop(self):
+        while not self._stop_flag.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f"Error probing nodes: {e}")
+            self._stop_flag.wait(timeout=self.interval)
+
+    def start(self) -> None:
+        """Запуск фоновой проверки нод."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_flag.clear()
+            self._thread = threading.Thread(
+                target=self._probe_loop,
+                name="NodeProber",
+                daemon=True
+            )
+            self._thread.start()
+            logger.info("Node latency prober started")
+
+    def stop(self) -> None:
+        """Остановка фоновой проверки."""
+        if self._thread and self._thread.is_alive():
+            self._stop_flag.set()
+            self._thread.join(timeout=5)
+            logger.info("Node latency prober stopped")
@@ -0,0 +1,110 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from config.settings import NODE_TELEMETRY_INTERVAL
+from database.db_manager import DatabaseManager
+from services.marzban_service import MarzbanService
+from services.node_manager import NodeManager
+
+logger = logging.getLogger('node_telemetry')
+
+
+class NodeTelemetryCollector:
+    """
+    Фоновый сбор телеметрии нод для NodeManager.
+
+    Опрашивает /api/nodes (статус нод), /api/nodes/usage (трафик за интервал)
+    и /api/system (CPU мастер-сервера). Marzban не отдает число подключений по
+    нодам, поэтому пользователи ноды - это активные устройства, закрепленные за
+    ее IP (счетчики реестра нод в БД). Замеры сглаживаются EWMA внутри NodeManager.
+    """
+
+    def __init__(self, node_manager: NodeManager, marzban_service: MarzbanService,
+                 db_manager: DatabaseManager, interval: int = NODE_TELEMETRY_INTERVAL):
+        self.node_manager = node_manager
+        self.marzban = marzban_service
+        self.db_manager = db_manager
+        self.interval = interval
+        self.master_address = urlparse(marzban_service.host).hostname
+        self._last_window_end: Optional[datetime] = None
+        self._stop_flag = threading.Event()
+        self._thread = None
+
+    def collect(self) -> int:
+        """Один цикл сбора. Возвращает число обновленных нод."""
+        now = datetime.now()
+        window_start = self._last_window_end or now - timedelta(seconds=self.interval)
+
+        with self.marzban.background():
+            system = self.marzban.get_server_info()
+            nodes = self.marzban.get_nodes()
+            usages = self.marzban.get_nodes_usage(window_start, now)
+
+        statuses = {node['address']: node.get('status') for node in nodes or []}
+        addresses = {node['id']: node['address'] for node in nodes or []}
+        if system:
+            statuses[self.master_address] = 'connected'
+
+        bandwidth: Dict[str, float] = {}
+        if usages is not None:
+            elapsed = max((now - window_start).total_seconds(), 1.0)
+            for usage in usages:
+                node_id = usage.get('node_id')
+                address = self.master_address if node_id is None else addresses.get(node_id)
+                if address:
+                    traffic = (usage.get('uplink') or 0) + (usage.get('downlink') or 0)
+                    bandwidth[address] = bandwidth.get(address, 0) + traffic / elapsed
+            # Окно сдвигаем только после успешного ответа, чтобы не терять трафик
+            self._last_window_end = now
+
+        # Счетчики устройств из реестра нод (без реестра - подсчет по таблице devices)
+        if self.node_manager.db_manager:
+            self.node_manager.reload_counters()
+            server_loads = {node['address']: node['current_users'] for node in self.node_manager.nodes.values()}
+        else:
+            server_loads = self.db_manager.get_server_loads()
+
+        updated = 0
+        for node_name, node in self.node_manager.nodes.items():
+            address = node['address']
+            samples = {
+                'users': server_loads.get(address, 0),
+                'bandwidth': bandwidth.get(address)
+            }
+            if address == self.master_address and system:
+                samples['cpu'] = system.get('cpu_usage')
+            self.node_manager.update_node_stats(node_name, samples, status=statuses.get(address))
+            updated += 1
+
+        logger.debug(f"Node telemetry collected for {updated} nodes")
+        return updated
+
+    def _collect_loop(self):
+        while not self._stop_flag.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error(f"Error collecting node telemetry: {e}")
+            self._stop_flag.wait(timeout=self.interval)
+
+    def start(self) -> None:
+        """Запуск фонового сбора телеметрии."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_flag.clear()
+            self._thread = threading.Thread(
+                target=self._collect_loop,
+                name="NodeTelemetry",
+                daemon=True
+            )
+            self._thread.start()
+            logger.info("Node telemetry collector started")
+
+    def stop(self) -> None:
+        """Остановка фонового сбора."""
+        if self._thread and self._thread.is_alive():
+            self._stop_flag.set()
+            self._thread.join(timeout=5)
+            logger.info("Node telemetry collector stopped")
@@ -0,0 +1,266 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+from config.settings import (
+    NOTIFY_GLOBAL_RATE,
+    NOTIFY_PER_CHAT_RATE,
+    NOTIFY_WORKERS,
+    NOTIFY_MAX_RETRIES
+)
+from database.db_manager import DatabaseManager
+from utils.rate_limiter import TokenBucket
+
+logger = logging.getLogger('notification_dispatcher')
+
+
+@dataclass
+class Notification:
+    chat_id: int
+    text: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 0
+
+
+def _retry_after(error: ApiTelegramException) -> Optional[float]:
+    if error.error_code != 429:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return float(parameters.get('retry_after', 1))
+
+
+def _is_undeliverable(error: ApiTelegramException) -> bool:
+    """Пользователь заблокировал бота, удален или чат не существует - повтор не поможет."""
+    description = (error.description or '').lower()
+    return error.error_code == 403 or (error.error_code == 400 and 'chat not found' in description)
+
+
+class NotificationDispatcher:
+    """
+    Очередь исходящих уведомлений с учетом лимитов Telegram.
+
+    Сообщения ставятся в очередь и отправляются пулом потоков: общий token
+    bucket держит глобальный темп (около 30 сообщений в секунду), а каждый чат
+    получает не чаще per_chat_rate сообщений в секунду - чаты ждут своей
+    очереди в куче по времени готовности, не занимая потоки. На 429 отправка
+    приостанавливается на retry_after. Недоставляемые сообщения (бот
+    заблокирован, чат не найден) и исчерпавшие повторы пишутся в
+    notification_dead_letters.
+    """
+
+    def __init__(self, bot: TeleBot, db_manager: DatabaseManager,
+                 global_rate: float = NOTIFY_GLOBAL_RATE,
+                 per_chat_rate: float = NOTIFY_PER_CHAT_RATE,
+                 workers: int = NOTIFY_WORKERS,
+                 max_retries: int = NOTIFY_MAX_RETRIES):
+        self.bot = bot
+        self.db_manager = db_manager
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.chat_interval = 1 / per_chat_rate if per_chat_rate > 0 else 0.0
+        self.workers = workers
+        self.max_retries = max_retries
+
+        self._condition = threading.Condition()
+        self._chats: Dict[int, Deque[Notification]] = {}
+        self._ready: List[Tuple[float, int, int]] = []  # (время готовности, порядок, chat_id)
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._threads: List[threading.Thread] = []
+        self._stop_flag = threading.Event()
+
+        self._sent_times: Deque[float] = deque()
+        self.sent = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.rate_limited = 0
+
+    # --- постановка в очередь ---
+
+    def send(self, chat_id: int, text: str, **kwargs) -> None:
+        """Постановка сообщения в очередь (аргументы как у bot.send_message)."""
+        self.start()
+        with self._condition:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                self._chats[chat_id] = deque([Notification(chat_id, text, kwargs)])
+                heapq.heappush(self._ready, (time.monotonic(), next(self._sequence), chat_id))
+                self._condition.notify()
+            else:
+                # Чат уже ждет в куче или обрабатывается - сообщение уйдет следом
+                queue.append(Notification(chat_id, text, kwargs))
+
+    def _schedule(self, chat_id: int, ready_at: float) -> None:
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+        self._condition.notify()
+
+    # --- отправка ---
+
+    def _next_chat(self) -> Optional[int]:
+        with self._condition:
+            while not self._stop_flag.is_set():
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now and self._paused_until <= now:
+                    self._in_flight += 1
+                    return heapq.heappop(self._ready)[2]
+                if self._ready:
+                    wait = max(self._ready[0][0], self._paused_until) - now
+                    self._condition.wait(timeout=max(wait, 0.001))
+                else:
+                    self._condition.wait(timeout=1)
+            return None
+
+    def _worker_loop(self):
+        while True:
+            chat_id = self._next_chat()
+            if chat_id is None:
+                return
+            try:
+                self._deliver(chat_id)
+            except Exception as e:
+                logger.error(f"Error delivering notification to {chat_id}: {e}")
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _deliver(self, chat_id: int) -> None:
+        """Отправка первого сообщения чата и планирование следующего."""
+        with self._condition:
+            notification = self._chats[chat_id][0]
+
+        self.bucket.acquire()
+        try:
+            self.bot.send_message(chat_id, notification.text, **notification.kwargs)
+        except ApiTelegramException as e:
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                # 429 относится ко всему боту: приостанавливаем все потоки
+                self.rate_limited += 1
+                with self._condition:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"Telegram rate limit hit, pausing for {retry_after}s")
+                self._retry_later(chat_id, notification, retry_after, str(e))
+            elif _is_undeliverable(e):
+                self._dead_letter_chat(chat_id, e.description or str(e))
+            else:
+                self._retry_later(chat_id, notification, min(2 ** (notification.attempts + 1), 60), str(e))
+            return
+        except Exception as e:
+            # Сетевые ошибки - повтор с экспоненциальной паузой
+            self._retry_later(chat_id, notification, min(2 ** (notification.attempts + 1), 60), str(e))
+            return
+
+        self._record_sent()
+        with self._condition:
+            self._chats[chat_id].popleft()
+            self._reschedule_locked(chat_id, time.monotonic() + self.chat_interval)
+
+    def _retry_later(self, chat_id: int, notification: Notification, delay: float, error: str) -> None:
+        """Повтор сообщения через delay; после max_retries попыток - dead-letter."""
+        notification.attempts += 1
+        exhausted = notification.attempts > self.max_retries
+        with self._condition:
+            if exhausted:
+                self._chats[chat_id].popleft()
+                delay = self.chat_interval
+            else:
+                self.retried += 1
+            self._reschedule_locked(chat_id, time.monotonic() + delay)
+        if exhausted:
+            self._dead_letter([notification], error)
+
+    def _reschedule_locked(self, chat_id: int, ready_at: float) -> None:
+        if self._chats[chat_id]:
+            self._schedule(chat_id, ready_at)
+        else:
+            del self._chats[chat_id]
+            self._condition.notify_all()
+
+    def _dead_letter_chat(self, chat_id: int, error: str) -> None:
+        """Все сообщения недоступного чата - в dead-letter."""
+        with self._condition:
+            notifications = list(self._chats.pop(chat_id, []))
+            self._condition.notify_all()
+        logger.warning(f"Chat {chat_id} is unreachable ({error}), {len(notifications)} notifications dead-lettered")
+        self._dead_letter(notifications, error)
+
+    def _dead_letter(self, notifications: List[Notification], error: str) -> None:
+        self.dead_lettered += len(notifications)
+        try:
+            self.db_manager.add_dead_letters(
+                [(notification.chat_id, notification.text, error) for notification in notifications]
+            )
+        except Exception as e:
+            logger.error(f"Error saving dead letters: {e}")
+
+    def _record_sent(self) -> None:
+        now = time.monotonic()
+        with self._condition:
+            self.sent += 1
+            self._sent_times.append(now)
+            while self._sent_times and self._sent_times[0] < now - 60:
+                self._sent_times.popleft()
+
+    # --- управление и метрики ---
+
+    def start(self) -> None:
+        """Запуск потоков отправки (повторный вызов ничего не делает)."""
+        with self._condition:
+            if any(thread.is_alive() for thread in self._threads):
+                return
+            self._stop_flag.clear()
+            self._threads = [
+                threading.Thread(target=self._worker_loop, name=f"Notifier-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Notification dispatcher started with {self.workers} workers")
+
+    def flush(self, timeout: float = None) -> bool:
+        """Ожидание отправки всей очереди. False - не успели за timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._chats or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(timeout=remaining)
+        return True
+
+    def stop(self, timeout: float = 5) -> None:
+        """Остановка после отправки очереди (не дольше timeout)."""
+        self.flush(timeout)
+        self._stop_flag.set()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        logger.info("Notification dispatcher stopped")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Глубина очереди, отправлено/повторено/в dead-letter и темп за последнюю минуту."""
+        now = time.monotonic()
+        with self._condition:
+            while self._sent_times and self._sent_times[0] < now - 60:
+                self._sent_times.popleft()
+            return {
+                'queue_depth': sum(len(queue) for queue in self._chats.values()),
+                'chats_pending': len(self._chats),
+                'in_flight': self._in_flight,
+                'sent': self.sent,
+                'retried': self.retried,
+                'rate_limited': self.rate_limited,
+                'dead_lettered': self.dead_lettered,
+                'throughput_per_sec': len(self._sent_times) / 60,
+                'paused_for': max(self._paused_until - now, 0.0)
+            }
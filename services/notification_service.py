@@ -1,7 +1,12 @@
 from telebot import TeleBot
 from database.db_manager import DatabaseManager
+from database.models import Device
+from services.marzban_service import MarzbanService, USER_NOT_FOUND
+from services.notification_dispatcher import NotificationDispatcher
 from config.settings import DEFAULT_PLAN_PRICE
 import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import threading
 import time
@@ -9,16 +14,30 @@ import schedule
 
 logger = logging.getLogger('notifications')  # Добавляем этот логгер в начало файла
 
+# Предупреждение об окончании срока: за сколько часов и ключ в notifications_sent
+EXPIRY_WARNING_KIND = 'expiry_warning'
+EXPIRY_WARNING_HOURS = 24
+# Уведомление о деактивации: одно на устройство, какой бы путь его ни снял
+# (истечение срока, вебхук Marzban, сверка)
+DEACTIVATION_NOTICE_KIND = 'deactivated'
+
 class NotificationService:
-    def __init__(self, bot: TeleBot, db_manager: DatabaseManager):
+    def __init__(self, bot: TeleBot, db_manager: DatabaseManager, marzban_service: MarzbanService,
+                 dispatcher: NotificationDispatcher):
         self.bot = bot
+        # Общий диспетчер бота: свой экземпляр удвоил бы глобальный лимит Telegram
+        self.dispatcher = dispatcher
         self.db_manager = db_manager
+        self.marzban = marzban_service
         self._scheduler_thread = None
         self._stop_flag = threading.Event()
         self.notification_thresholds = {
             1: "⚠️ ВНИМАНИЕ! Через 24 часа ваши конфигурации будут удалены!"
         }
         self.logger = logger  # Используем созданный логгер
+        # Объединение уведомлений: событий по устройствам и отправленных сообщений
+        self._coalesce_lock = threading.Lock()
+        self._coalesce_stats = {'notifications': 0, 'messages': 0}
 
     # notification_service.py
     def check_user_devices_expiration(self, user_id: int) -> None:
@@ -29,7 +48,7 @@ class NotificationService:
             for device in devices:
                 if device.expires_at and current_time > device.expires_at:
                     try:
-                        self.marzban_service.delete_user(device.marzban_username)
+                        self.marzban.delete_user(device.marzban_username)
                         self.db_manager.deactivate_device(device.id)
                     except Exception as e:
                         logger.error(f"Error deactivating expired device: {e}")
@@ -97,98 +116,212 @@ class NotificationService:
             self._scheduler_thread.join(timeout=5)
             logger.info("Balance check scheduler stopped")
 
+    def _log_throttle_stats(self, sweep_name: str) -> None:
+        """Логирование времени ожидания фоновых запросов в ограничителе Marzban."""
+        stats = self.marzban.get_rate_limit_stats()['background']
+        self.logger.info(
+            f"{sweep_name}: background Marzban requests={stats['requests']}, "
+            f"queue wait total={stats['wait_total']:.1f}s, max={stats['wait_max']:.2f}s"
+        )
+
     def check_marzban_configs(self):
         """Проверка состояния конфигураций в Marzban."""
         try:
             devices = self.db_manager.get_all_active_devices()
-            for device in devices:
-                config = self.marzban.get_user_config(device.marzban_username)
-                if not config or config.get('status') == 'disabled':
-                    self.db_manager.deactivate_device(device.id)
-                    self.bot.send_message(
-                        device.telegram_id,
-                        f"❌ Ваша конфигурация {device.device_type} была деактивирована.\n"
-                        "Пожалуйста, создайте новую."
-                    )
+            deactivated = defaultdict(list)
+            with self.marzban.background():
+                configs = self.marzban.get_user_configs([device.marzban_username for device in devices])
+                for device in devices:
+                    config = configs.get(device.marzban_username)
+                    # None - панель не ответила, по нему устройство не снимаем
+                    if config is USER_NOT_FOUND or (config and config.get('status') == 'disabled'):
+                        if self.db_manager.deactivate_device(device.id):
+                            deactivated[device.telegram_id].append(device)
+
+            # Одно сообщение на пользователя за запуск, без уже уведомленных устройств
+            claimed = self.db_manager.claim_notifications(
+                [device.id for devices in deactivated.values() for device in devices],
+                DEACTIVATION_NOTICE_KIND, 0, datetime.now()
+            )
+            deactivated = {
+                telegram_id: [device.device_type for device in devices if device.id in claimed]
+                for telegram_id, devices in deactivated.items()
+            }
+            deactivated = {telegram_id: types for telegram_id, types in deactivated.items() if types}
+            for telegram_id, device_types in deactivated.items():
+                if len(device_types) == 1:
+                    message = (f"❌ Ваша конфигурация {device_types[0]} была деактивирована.\n"
+                               "Пожалуйста, создайте новую.")
+                else:
+                    message = (f"❌ Ваши конфигурации {', '.join(device_types)} были деактивированы.\n"
+                               "Пожалуйста, создайте новые.")
+                self.dispatcher.send(telegram_id, message)
+            self._record_coalescing("check_marzban_configs", deactivated)
+            self._log_throttle_stats("check_marzban_configs")
         except Exception as e:
             self.logger.error(f"Error checking Marzban configs: {e}")
 
+    @staticmethod
+    def _format_expiration_digest(expired: List[str], expiring: List[Tuple[str, int]]) -> str:
+        """Сводка по истекшим и скоро истекающим устройствам пользователя."""
+        parts = ["⚠️ *Внимание!*"]
+        if len(expired) == 1:
+            parts.append(f"Ваше устройство {expired[0]} деактивировано в связи с истечением срока действия.")
+        elif expired:
+            parts.append(f"Ваши устройства {', '.join(expired)} деактивированы "
+                         "в связи с истечением срока действия.")
+        if len(expiring) == 1:
+            device_type, hours = expiring[0]
+            parts.append(f"Ваше устройство {device_type} будет деактивировано через {hours} часов.")
+        elif expiring:
+            parts.append("Скоро будут деактивированы:\n" + "\n".join(
+                f"• {device_type} - через {hours} ч." for device_type, hours in expiring
+            ))
+        if expired:
+            parts.append("Для продолжения работы необходимо создать новую конфигурацию.")
+        if expiring:
+            parts.append("Рекомендуем продлить подписку заранее.")
+        return "\n".join(parts)
+
+    def _record_coalescing(self, sweep_name: str, events: Dict[int, list]) -> None:
+        """Учет объединения: событий по устройствам против отправленных сообщений."""
+        notifications = sum(len(items) for items in events.values())
+        if not notifications:
+            return
+        with self._coalesce_lock:
+            self._coalesce_stats['notifications'] += notifications
+            self._coalesce_stats['messages'] += len(events)
+        self.logger.info(f"{sweep_name}: {notifications} notifications coalesced into {len(events)} messages")
+
+    def get_coalescing_stats(self) -> Dict[str, float]:
+        """Сколько сообщений сэкономлено объединением уведомлений по пользователям."""
+        with self._coalesce_lock:
+            notifications = self._coalesce_stats['notifications']
+            messages = self._coalesce_stats['messages']
+        return {
+            'notifications': notifications,
+            'messages': messages,
+            'saved': notifications - messages,
+            'per_message': notifications / messages if messages else 0.0
+        }
+
+    @staticmethod
+    def _as_datetime(value) -> datetime:
+        """Дата из БД приходит строкой - приводим к datetime."""
+        return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+    def purge_expired_devices(self, current_time: datetime,
+                              expired: Optional[List[Device]] = None) -> Dict[str, Any]:
+        """
+        Пакетное удаление истекших конфигов.
+
+        Устройства деактивируются в БД одним запросом до удаления в панели,
+        чтобы вебхук user_deleted, пришедший в ответ, застал их уже неактивными.
+        Затем панель удаляет истекших пользователей одним запросом, оставшиеся
+        удаляются параллельными пакетами; устройства, чьих пользователей удалить
+        не удалось, возвращаются в активные. Без списка expired истекшие
+        устройства выбираются из БД.
+        """
+        started = time.monotonic()
+        # Список передает ExpiryScheduler - повтор неудавшихся удалений он планирует сам
+        scheduled = expired is not None
+        if expired is None:
+            expired = self.db_manager.get_expired_active_devices(current_time)
+        if not expired:
+            return {'expired': 0, 'purged': 0, 'bulk': 0, 'seconds': 0.0, 'devices': []}
+
+        by_username = {device.marzban_username: device for device in expired}
+        earliest = min(self._as_datetime(device.expires_at) for device in expired)
+        self.db_manager.deactivate_devices([device.id for device in expired])
+
+        with self.marzban.background():
+            removed = self.marzban.delete_expired_users(
+                expired_before=current_time,
+                expired_after=earliest - timedelta(hours=1)
+            ) or []
+            purged = set(removed) & set(by_username)
+            bulk_purged = len(purged)
+
+            unexpected = set(removed) - set(by_username)
+            if unexpected:
+                self.logger.info(f"Panel also removed {len(unexpected)} expired users without active devices")
+
+            remaining = [username for username in by_username if username not in purged]
+            results = self.marzban.delete_users(remaining)
+            purged.update(username for username, ok in results.items() if ok)
+
+        purged_devices = [by_username[username] for username in purged]
+        failed = [device.id for username, device in by_username.items() if username not in purged]
+        if failed:
+            self.db_manager.reactivate_devices(failed, notify=not scheduled)
+        deactivated = len(purged_devices)
+        elapsed = time.monotonic() - started
+
+        self.logger.info(
+            f"Expired purge: {deactivated}/{len(expired)} devices purged "
+            f"({bulk_purged} via bulk endpoint) in {elapsed:.2f}s"
+        )
+        return {
+            'expired': len(expired),
+            'purged': deactivated,
+            'bulk': bulk_purged,
+            'seconds': elapsed,
+            'devices': purged_devices
+        }
+
     def check_device_expiration(self):
-        """Проверка истечения срока устройств."""
+        """Проверка истечения срока устройств полным просмотром БД."""
+        self.process_expirations(datetime.now())
+
+    def process_expirations(self, current_time: datetime, expired: Optional[List[Device]] = None,
+                            expiring: Optional[List[Device]] = None,
+                            sweep_name: str = "check_device_expiration") -> List[Device]:
+        """
+        Деактивация истекших устройств и предупреждения об окончании срока.
+        Списки передает планировщик сроков; без них устройства выбираются из БД.
+        Возвращает деактивированные устройства.
+        """
+        report = {'devices': []}
         try:
-            current_time = datetime.now()
-            devices = self.db_manager.get_all_active_devices()
+            report = self.purge_expired_devices(current_time, expired)
+            # Об устройствах, уже снятых вебхуком или сверкой, повторно не сообщаем
+            claimed = self.db_manager.claim_notifications(
+                [device.id for device in report['devices']], DEACTIVATION_NOTICE_KIND, 0, current_time
+            )
+            # События по устройствам копятся по пользователям и уходят одним сообщением
+            expired = defaultdict(list)
+            for device in report['devices']:
+                if device.id in claimed:
+                    expired[device.telegram_id].append(device.device_type)
 
-            for device in devices:
-                if device.expires_at and current_time > device.expires_at:
-                    # Деактивируем в Marzban
-                    self.marzban.delete_user(device.marzban_username)
-
-                    # Деактивируем в БД
-                    self.db_manager.deactivate_device(device.id)
-
-                    # Уведомляем пользователя
-                    message = (
-                        "⚠️ *Внимание!*\n"
-                        f"Ваше устройство {device.device_type} деактивировано "
-                        f"в связи с истечением срока действия.\n"
-                        "Для продолжения работы необходимо создать новую конфигурацию."
-                    )
-
-                    self.bot.send_message(
-                        device.telegram_id,
-                        message,
-                        parse_mode='Markdown'
-                    )
-
-                elif device.expires_at:
-                    # Проверяем, осталось ли меньше 24 часов
-                    time_left = device.expires_at - current_time
-                    if timedelta(0) <= time_left <= timedelta(days=1):
-                        message = (
-                            "⚠️ *Внимание!*\n"
-                            f"Ваше устройство {device.device_type} будет деактивировано через "
-                            f"{int(time_left.total_seconds() / 3600)} часов.\n"
-                            "Рекомендуем продлить подписку заранее."
-                        )
-
-                        self.bot.send_message(
-                            device.telegram_id,
-                            message,
-                            parse_mode='Markdown'
-                        )
+            # Проверяем, осталось ли меньше 24 часов; уже предупрежденных пропускаем
+            if expiring is None:
+                expiring = self.db_manager.get_devices_expiring_between(
+                    current_time, current_time + timedelta(hours=EXPIRY_WARNING_HOURS)
+                )
+            notified = self.db_manager.get_notified_device_ids(
+                [device.id for device in expiring], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS
+            )
+            expiring = [device for device in expiring if device.id not in notified]
+            warnings = defaultdict(list)
+            for device in expiring:
+                time_left = self._as_datetime(device.expires_at) - current_time
+                warnings[device.telegram_id].append((device.device_type, int(time_left.total_seconds() / 3600)))
+
+            events = {}
+            for telegram_id in set(expired) | set(warnings):
+                message = self._format_expiration_digest(expired.get(telegram_id, []), warnings.get(telegram_id, []))
+                self.dispatcher.send(telegram_id, message, parse_mode='Markdown')
+                events[telegram_id] = expired.get(telegram_id, []) + warnings.get(telegram_id, [])
+            # Отмечаем сразу после постановки в очередь: повторный запуск не продублирует
+            self.db_manager.mark_devices_notified(
+                [device.id for device in expiring], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS, current_time
+            )
+            if notified:
+                self.logger.info(f"Skipped {len(notified)} already sent expiry warnings")
+            self._record_coalescing(sweep_name, events)
 
+            self._log_throttle_stats(sweep_name)
         except Exception as e:
             self.logger.error(f"Error checking device expiration: {e}")
-
-        def check_marzban_configs(self):
-            """Проверка актуальности конфигов в Marzban."""
-            try:
-                devices = self.db_manager.get_all_active_devices()
-                for device in devices:
-                    # Проверяем существование конфига в Marzban
-                    marzban_config = self.marzban.get_user_config(device.marzban_username)
-
-                    # Если конфиг не найден в Marzban
-                    if not marzban_config:
-                        # Деактивируем устройство в БД
-                        self.db_manager.deactivate_device(device.id)
-
-                        # Уведомляем пользователя
-                        message = (
-                            "❌ *Внимание!*\n"
-                            f"Конфигурация `{device.marzban_username}` была удалена.\n"
-                            "Для продолжения работы необходимо создать новую конфигурацию."
-                        )
-
-                        try:
-                            self.bot.send_message(
-                                device.telegram_id,
-                                message,
-                                parse_mode='Markdown'
-                            )
-                        except Exception as e:
-                            self.logger.error(f"Error sending notification: {e}")
-
-            except Exception as e:
-                self.logger.error(f"Error checking Marzban configs: {e}")
\ No newline at end of file
+        return report['devices']
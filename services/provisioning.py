@@ -0,0 +1,212 @@
+import json
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Optional
+
+from config.settings import (
+    DEFAULT_PLAN_PRICE,
+    MARZBAN_DEFAULT_TEMPLATE,
+    PROVISIONING_RESERVATION_TIMEOUT
+)
+from database.db_manager import DatabaseManager
+from database.models import Device
+from services.marzban_service import MarzbanService, USER_NOT_FOUND
+from services.user_pool import MarzbanUserPool
+from utils.stats import percentile
+
+logger = logging.getLogger('provisioning')
+
+STAGES = ('reserve', 'select_server', 'remote_create', 'commit', 'compensate')
+
+
+class ProvisioningPipeline:
+    """
+    Создание оплачиваемого устройства в три шага.
+
+    1. reserve - средства списываются атомарно вместе с записью резерва;
+    2. remote_create - пользователь Marzban создается (или берется из пула),
+       его имя сразу привязывается к резерву;
+    3. commit - устройство добавляется и резерв закрывается одной транзакцией.
+
+    При ошибке после резерва пользователь Marzban удаляется, а средства
+    возвращаются; если удалить пользователя не удалось, он попадает в
+    marzban_orphans. Резервы, зависшие после падения процесса, и
+    накопившихся orphans разбирает release_stale_reservations. Все шаги в
+    БД - условные обновления, поэтому конвейер можно запускать параллельно
+    для многих пользователей.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, marzban_service: MarzbanService,
+                 user_pool: MarzbanUserPool = None,
+                 reservation_timeout: int = PROVISIONING_RESERVATION_TIMEOUT):
+        self.db_manager = db_manager
+        self.marzban = marzban_service
+        self.user_pool = user_pool
+        self.reservation_timeout = reservation_timeout
+        self._stats_lock = threading.Lock()
+        self._timings: Dict[str, Deque[float]] = {stage: deque(maxlen=10000) for stage in STAGES}
+        self._outcomes = {'committed': 0, 'insufficient_funds': 0, 'failed': 0}
+
+    @contextmanager
+    def _stage(self, name: str, timings: Dict[str, float]):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            timings[name] = elapsed
+            with self._stats_lock:
+                self._timings[name].append(elapsed)
+
+    def _count(self, outcome: str) -> None:
+        with self._stats_lock:
+            self._outcomes[outcome] += 1
+
+    def _select_server(self) -> str:
+        # Оптимальный сервер по телеметрии нод, без нее - по числу устройств в БД
+        node_manager = self.marzban.node_manager
+        return (node_manager.select_optimal_server() if node_manager else None) \
+            or self.db_manager.get_optimal_server()
+
+    def _create_remote_user(self, reservation_id: int, device_type: str, days: int):
+        """Пользователь Marzban под резерв: из пула или новый."""
+        # Создание оплачиваемого конфига идет в приоритетном платежном классе запросов
+        with self.marzban.traffic('payment'):
+            marzban_username = self.user_pool.claim(MARZBAN_DEFAULT_TEMPLATE) if self.user_pool else None
+            if marzban_username:
+                self.db_manager.set_reservation_user(reservation_id, marzban_username)
+                marzban_user = self.marzban.activate_user(marzban_username, days)
+                if marzban_user:
+                    return marzban_username, marzban_user
+                # Не активированная заготовка не должна остаться в панели
+                self._delete_remote_user(marzban_username, 'pool_activation_failed')
+
+            # Суффикс исключает совпадение имен при параллельном создании
+            marzban_username = f"vless_{device_type.lower()}_{int(datetime.now().timestamp())}{secrets.token_hex(2)}"
+            self.db_manager.set_reservation_user(reservation_id, marzban_username)
+            logger.info(f"Creating Marzban user: {marzban_username}")
+            return marzban_username, self.marzban.create_user(username=marzban_username, days=days)
+
+    def provision(self, telegram_id: int, device_type: str, days: int) -> Optional[Device]:
+        """Создание устройства с оплатой. None - недостаточно средств или ошибка (средства возвращены)."""
+        timings: Dict[str, float] = {}
+        total_cost = DEFAULT_PLAN_PRICE * days
+
+        with self._stage('reserve', timings):
+            reservation_id = self.db_manager.reserve_funds(telegram_id, total_cost)
+        if reservation_id is None:
+            logger.info(f"Insufficient balance for {telegram_id}: required {total_cost}")
+            self._count('insufficient_funds')
+            return None
+
+        marzban_username = None
+        try:
+            with self._stage('select_server', timings):
+                server_ip = self._select_server()
+
+            with self._stage('remote_create', timings):
+                marzban_username, marzban_user = self._create_remote_user(reservation_id, device_type, days)
+            if not marzban_user:
+                raise RuntimeError(f"Marzban user {marzban_username} was not created")
+
+            now = datetime.now()
+            device = Device(
+                telegram_id=telegram_id,
+                device_type=device_type,
+                config_data=json.dumps(marzban_user),
+                created_at=now,
+                expires_at=now + timedelta(days=days),
+                marzban_username=marzban_username,
+                server_ip=server_ip,
+                panel=self.marzban.get_panel_name(marzban_username)
+            )
+            with self._stage('commit', timings):
+                device.id = self.db_manager.commit_reservation(reservation_id, device)
+            if not device.id:
+                raise RuntimeError(f"Reservation {reservation_id} was released before commit")
+
+            self._count('committed')
+            logger.info(f"Provisioned device {device.id} for {telegram_id}: " +
+                        ", ".join(f"{stage}={elapsed * 1000:.0f}ms" for stage, elapsed in timings.items()))
+            return device
+
+        except Exception as e:
+            logger.error(f"Provisioning failed for {telegram_id}, compensating: {e}")
+            with self._stage('compensate', timings):
+                self._compensate(reservation_id, marzban_username)
+            self._count('failed')
+            return None
+
+    def _delete_remote_user(self, marzban_username: str, reason: str) -> bool:
+        """Удаление пользователя Marzban; при неудаче - в очередь marzban_orphans."""
+        if self.marzban.delete_user(marzban_username):
+            return True
+        logger.warning(f"Could not delete Marzban user {marzban_username} ({reason}), queued for cleanup")
+        self.db_manager.add_marzban_orphan(marzban_username, reason)
+        return False
+
+    def _compensate(self, reservation_id: int, marzban_username: Optional[str]) -> None:
+        """Откат: удаление пользователя Marzban и возврат средств."""
+        if marzban_username:
+            with self.marzban.traffic('payment'):
+                self._delete_remote_user(marzban_username, 'compensate')
+        if self.db_manager.release_reservation(reservation_id):
+            logger.info(f"Reservation {reservation_id} released, funds returned")
+
+    def release_stale_reservations(self) -> int:
+        """
+        Возврат средств по резервам, зависшим после падения процесса,
+        и повторное удаление пользователей из marzban_orphans.
+        """
+        released = 0
+        try:
+            created_before = datetime.now() - timedelta(seconds=self.reservation_timeout)
+            with self.marzban.background():
+                for reservation in self.db_manager.get_stale_reservations(created_before):
+                    if reservation['marzban_username']:
+                        self._delete_remote_user(reservation['marzban_username'], 'stale_reservation')
+                    if self.db_manager.release_reservation(reservation['id']):
+                        released += 1
+                self.reap_orphans()
+            if released:
+                logger.warning(f"Released {released} stale device reservations")
+        except Exception as e:
+            logger.error(f"Error releasing stale reservations: {e}")
+        return released
+
+    def reap_orphans(self) -> int:
+        """Повторное удаление пользователей Marzban, оставшихся после неудачных откатов."""
+        usernames = self.db_manager.get_marzban_orphans()
+        if not usernames:
+            return 0
+        results = self.marzban.delete_users(usernames)
+        failed = [username for username in usernames if not results.get(username)]
+        # delete_user не отличает 404 от сбоя: уже отсутствующих в панели тоже считаем удаленными
+        if failed:
+            configs = self.marzban.get_user_configs(failed)
+            failed = [username for username in failed if configs.get(username) is not USER_NOT_FOUND]
+        removed = [username for username in usernames if username not in failed]
+        self.db_manager.resolve_marzban_orphans(removed, failed)
+        if removed:
+            logger.info(f"Removed {len(removed)} orphaned Marzban users, {len(failed)} left")
+        return len(removed)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Задержки шагов (мс) и итоги создания устройств."""
+        with self._stats_lock:
+            report = {
+                stage: {
+                    'count': len(values),
+                    'p50_ms': percentile(list(values), 50) * 1000,
+                    'p95_ms': percentile(list(values), 95) * 1000,
+                    'p99_ms': percentile(list(values), 99) * 1000
+                }
+                for stage, values in self._timings.items()
+            }
+            report['outcomes'] = dict(self._outcomes)
+        return report
@@ -1,18 +1,247 @@
 import qrcode
+import qrcode.image.svg
+import qrcode.util
+from qrcode.constants import ERROR_CORRECT_L, ERROR_CORRECT_M, ERROR_CORRECT_Q, ERROR_CORRECT_H
 from io import BytesIO
 import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 import hashlib
 import base64
 
+from config.settings import (
+    QR_CACHE_MAX_BYTES,
+    QR_CACHE_TTL,
+    QR_RENDER_BACKEND,
+    QR_RENDER_WORKERS,
+    QR_RENDER_MAX_PENDING,
+    QR_RENDER_TIMEOUT,
+    QR_RENDER_MODE,
+    QR_TARGET_SIZE,
+    QR_MAX_VERSION
+)
+
 logger = logging.getLogger('qr_service')
 
 
+# Режимы отрисовки: classic - прежний PNG (box_size=10), compact - 1-битный PNG
+# под размер показа в Telegram, svg - векторный SVG
+QR_MODES = ('classic', 'compact', 'svg')
+
+
+def choose_error_correction(data: str, max_version: int = QR_MAX_VERSION) -> int:
+    """
+    Самый сильный уровень коррекции, при котором символ не больше max_version.
+    Длинным данным, которым и уровень L не помогает, достается L. Емкость
+    считается для байтового режима по таблице qrcode без построения символа,
+    поэтому оценка не больше реальной.
+    """
+    bits = 4 + qrcode.util.length_in_bits(qrcode.util.MODE_8BIT_BYTE, max_version) + 8 * len(data.encode())
+    for level in (ERROR_CORRECT_H, ERROR_CORRECT_Q, ERROR_CORRECT_M):
+        if bits <= qrcode.util.BIT_LIMIT_TABLE[level][max_version]:
+            return level
+    return ERROR_CORRECT_L
+
+
+def render_qr_png(data: str, error_correction: Optional[int] = ERROR_CORRECT_L,
+                  box_size: Optional[int] = 10, border: int = 4, mode: str = 'classic') -> bytes:
+    """
+    Отрисовка QR-кода (функция модуля - выполняется и в процессах пула).
+
+    Для compact и svg error_correction=None выбирается по длине данных, для
+    compact box_size=None подбирается под QR_TARGET_SIZE пикселей.
+    """
+    if error_correction is None:
+        error_correction = choose_error_correction(data)
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=error_correction,
+        box_size=box_size or 10,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = BytesIO()
+
+    if mode == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        return buffer.getvalue()
+
+    if mode == 'compact':
+        if box_size is None:
+            qr.box_size = max(QR_TARGET_SIZE // (qr.modules_count + 2 * border), 2)
+        image = qr.make_image(fill_color="black", back_color="white").get_image()
+        # 1 бит на пиксель независимо от версии qrcode/Pillow
+        image.convert('1').save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue()
+
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class QRRenderPool:
+    """
+    Отрисовка QR-кодов в отдельных процессах.
+
+    Построение матрицы и кодирование PNG нагружают CPU и держат GIL, поэтому
+    внутри процесса бота они тормозят остальные обработчики. Пул ограничивает
+    очередь: при max_pending ожидающих задачах новая ждет места не дольше
+    timeout, а сама отрисовка - тоже не дольше timeout. Процессы запускаются
+    через spawn (fork в многопоточном процессе может унаследовать захваченные
+    блокировки) в start() или при первом обращении.
+    """
+
+    def __init__(self, workers: int = QR_RENDER_WORKERS, max_pending: int = QR_RENDER_MAX_PENDING,
+                 timeout: float = QR_RENDER_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def start(self) -> None:
+        """Запуск процессов заранее: первый запуск с импортом модулей дольше таймаута."""
+        executor = self._get_executor()
+        for future in [executor.submit(render_qr_png, 'warmup') for _ in range(self.workers)]:
+            future.result()
+        logger.info(f"QR render pool started with {self.workers} workers")
+
+    def render(self, *args) -> bytes:
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise TimeoutError("QR render queue is full")
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(render_qr_png, *args)
+            except BrokenProcessPool:
+                # Упавший процесс ломает весь пул - пересоздаем его
+                self._reset(executor)
+                future = self._get_executor().submit(render_qr_png, *args)
+            try:
+                return future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                future.cancel()
+                self.timed_out += 1
+                raise TimeoutError("QR render timed out")
+        finally:
+            self._slots.release()
+
+    def _reset(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
 class QRService:
-    def __init__(self):
-        self.qr_cache = {}  # Кэш для хранения QR кодов
-        self.cache_ttl = timedelta(hours=1)  # Время жизни кэша
+    def __init__(self, max_bytes: int = QR_CACHE_MAX_BYTES, ttl: int = QR_CACHE_TTL,
+                 backend: str = QR_RENDER_BACKEND, render_pool: QRRenderPool = None,
+                 mode: str = QR_RENDER_MODE):
+        # LRU готовых PNG: ключ - хеш данных и параметры отрисовки, значение - (PNG, время создания)
+        self.qr_cache: 'OrderedDict[Tuple, Tuple[bytes, float]]' = OrderedDict()
+        self.cache_ttl = timedelta(seconds=ttl)  # Время жизни кэша
+        self.max_bytes = max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.mode = mode if mode in QR_MODES else 'compact'
+        self._lock = threading.Lock()
+        # Промахи кэша отрисовываются в пуле процессов или в потоке обработчика
+        self.render_pool = render_pool or (QRRenderPool() if backend == 'process' else None)
+
+    def render_png(self, data: str, error_correction: Optional[int] = None,
+                   box_size: Optional[int] = None, border: int = 4) -> bytes:
+        """PNG с QR-кодом для данных (ссылки) в режиме сервиса. Повторные запросы берутся из кэша."""
+        mode = 'compact' if self.mode == 'svg' else self.mode
+        if mode == 'classic':
+            error_correction = ERROR_CORRECT_L if error_correction is None else error_correction
+            box_size = box_size or 10
+        return self.render(data, mode, error_correction, box_size, border)
+
+    def render_svg(self, data: str, error_correction: Optional[int] = None, border: int = 4) -> bytes:
+        """SVG с QR-кодом (для печати и масштабирования без потерь)."""
+        return self.render(data, 'svg', error_correction, None, border)
+
+    def render(self, data: str, mode: str, error_correction: Optional[int],
+               box_size: Optional[int], border: int) -> bytes:
+        key = (hashlib.sha256(data.encode()).hexdigest(), mode, error_correction, box_size, border)
+        now = time.monotonic()
+        with self._lock:
+            cached = self.qr_cache.get(key)
+            if cached and now - cached[1] < self.cache_ttl.total_seconds():
+                self.qr_cache.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            if cached:
+                self._evict(key)
+            self.misses += 1
+
+        if self.render_pool:
+            png = self.render_pool.render(data, error_correction, box_size, border, mode)
+        else:
+            png = render_qr_png(data, error_correction, box_size, border, mode)
+
+        # Изображение больше всего бюджета не кэшируем
+        if len(png) <= self.max_bytes:
+            with self._lock:
+                if key in self.qr_cache:
+                    self._evict(key)
+                self.qr_cache[key] = (png, now)
+                self.cache_bytes += len(png)
+                while self.cache_bytes > self.max_bytes:
+                    self._evict(next(iter(self.qr_cache)))
+        return png
+
+    def get_qr_image(self, data: str, **params) -> BytesIO:
+        """QR-код в отдельном буфере для отправки в Telegram."""
+        return BytesIO(self.render_png(data, **params))
+
+    def start(self) -> None:
+        if self.render_pool:
+            self.render_pool.start()
+
+    def shutdown(self) -> None:
+        if self.render_pool:
+            self.render_pool.shutdown()
+
+    def _evict(self, key) -> None:
+        png, _ = self.qr_cache.pop(key)
+        self.cache_bytes -= len(png)
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self.qr_cache),
+                'bytes': self.cache_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
 
     def generate_qr(self, config_data: str, device_type: str) -> Tuple[BytesIO, str]:
         """Генерация QR кода с цифровой подписью."""
@@ -23,31 +252,10 @@ class QRService:
             # Добавляем метаданные к конфигурации
             config_with_meta = self._add_metadata(config_data, config_hash)
 
-            # Генерируем QR код
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_H,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(config_with_meta)
-            qr.make(fit=True)
-
-            # Создаем изображение
-            img = qr.make_image(fill_color="black", back_color="white")
-
-            # Сохраняем в буфер
-            buffer = BytesIO()
-            img.save(buffer, format='PNG')
-            buffer.seek(0)
-
-            # Кэшируем QR код
-            cache_key = f"{device_type}_{config_hash}"
-            self.qr_cache[cache_key] = {
-                'timestamp': datetime.now(),
-                'signature': config_hash
-            }
+            # Уровень коррекции по длине данных: с метаданными уровень H раздувал версию символа
+            buffer = BytesIO(render_qr_png(config_with_meta, None, None, 4, 'compact'))
 
+            # Данные содержат метку времени, поэтому такие QR-коды не кэшируются
             return buffer, config_hash
 
         except Exception as e:
@@ -120,10 +328,8 @@ class QRService:
 
     def cleanup_cache(self) -> None:
         """Очистка устаревших QR кодов из кэша."""
-        current_time = datetime.now()
-        expired_keys = [
-            key for key, data in self.qr_cache.items()
-            if current_time - data['timestamp'] > self.cache_ttl
-        ]
-        for key in expired_keys:
-            del self.qr_cache[key]
\ No newline at end of file
+        expired_before = time.monotonic() - self.cache_ttl.total_seconds()
+        with self._lock:
+            expired_keys = [key for key, (_, created) in self.qr_cache.items() if created <= expired_before]
+            for key in expired_keys:
+                self._evict(key)
\ No newline at end of file
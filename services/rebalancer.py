@@ -0,0 +1,140 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from config.settings import (
+    REBALANCE_TOLERANCE,
+    REBALANCE_BATCH_SIZE,
+    REBALANCE_COOLDOWN_HOURS
+)
+from database.db_manager import DatabaseManager
+from services.marzban_service import MarzbanService
+from services.node_manager import NodeManager
+from services.notification_dispatcher import NotificationDispatcher
+
+logger = logging.getLogger('rebalancer')
+
+
+class NodeRebalancer:
+    """
+    Перенос устройств с перегруженных нод.
+
+    Нода перегружена, если ее счетчик устройств превышает справедливую долю
+    (пропорционально весу) больше чем на tolerance или превышает max_users.
+    Один шаг переносит не больше batch_size устройств и отправляет не больше
+    batch_size уведомлений. Переносы и неотправленные уведомления хранятся в
+    device_moves, поэтому прерванный шаг продолжается со следующего запуска.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, node_manager: NodeManager,
+                 marzban_service: MarzbanService, dispatcher: NotificationDispatcher,
+                 tolerance: float = REBALANCE_TOLERANCE,
+                 batch_size: int = REBALANCE_BATCH_SIZE,
+                 cooldown_hours: int = REBALANCE_COOLDOWN_HOURS):
+        self.db_manager = db_manager
+        self.node_manager = node_manager
+        self.marzban = marzban_service
+        self.dispatcher = dispatcher
+        self.tolerance = tolerance
+        self.batch_size = batch_size
+        self.cooldown = timedelta(hours=cooldown_hours)
+
+    def plan_moves(self, limit: int) -> List[Tuple[int, str, str]]:
+        """Список переносов (device_id, from_server, to_server) не длиннее limit."""
+        counters = self.db_manager.get_node_counters()
+        # Устройства недоступных нод не трогаем: это не перегрузка
+        nodes = {
+            node['address']: node for node_name, node in self.node_manager.nodes.items()
+            if self.node_manager.is_node_healthy(node_name)
+        }
+        if len(nodes) < 2:
+            return []
+
+        loads = {address: counters.get(address, 0) for address in nodes}
+        total_weight = sum(node.get('weight', 1) for node in nodes.values())
+        total = sum(loads.values())
+        fair = {address: total * node.get('weight', 1) / total_weight for address, node in nodes.items()}
+
+        def limit_for(address: str) -> float:
+            max_users = nodes[address].get('max_users') or math.inf
+            return min(fair[address] * (1 + self.tolerance), max_users)
+
+        def can_receive(address: str) -> bool:
+            max_users = nodes[address].get('max_users') or math.inf
+            return loads[address] + 1 <= min(fair[address], max_users)
+
+        overloaded = sorted(
+            (address for address in nodes if loads[address] > limit_for(address)),
+            key=lambda address: loads[address] / limit_for(address) if limit_for(address) else math.inf,
+            reverse=True
+        )
+
+        moves = []
+        moved_before = datetime.now() - self.cooldown
+        for source in overloaded:
+            if len(moves) >= limit:
+                break
+            # Разгружаем до справедливой доли, а не до порога, чтобы нода не колебалась у границы
+            excess = math.ceil(loads[source] - min(fair[source], limit_for(source)))
+            devices = self.db_manager.get_devices_to_move(source, min(excess, limit - len(moves)), moved_before)
+            for device in devices:
+                receivers = [address for address in nodes if address != source and can_receive(address)]
+                if not receivers:
+                    break
+                target = min(receivers, key=lambda address: loads[address] / nodes[address].get('weight', 1))
+                moves.append((device.id, source, target))
+                loads[source] -= 1
+                loads[target] += 1
+
+        return moves
+
+    def notify_moved(self, limit: int) -> int:
+        """Отправка новых ссылок пользователям перенесенных устройств."""
+        pending = self.db_manager.get_pending_move_notifications(limit)
+        done = []
+        with self.marzban.background():
+            for move in pending:
+                if not move['is_active']:
+                    done.append(move['id'])
+                    continue
+                try:
+                    config = self.marzban.get_user_config(move['marzban_username'])
+                    link = self.node_manager.select_link(config.get('links', []), move['to_server']) if config else None
+                    if not link:
+                        logger.warning(f"No link for moved device {move['id']}, will retry")
+                        continue
+
+                    # Лимиты Telegram, повторы и dead-letter - на стороне диспетчера
+                    self.dispatcher.send(
+                        move['telegram_id'],
+                        "🔄 *Сервер изменен*\n"
+                        f"Ваше устройство {move['device_type']} перенесено на менее загруженный сервер.\n"
+                        "Для стабильной работы обновите конфигурацию:\n\n"
+                        f"`{link}`",
+                        parse_mode='Markdown'
+                    )
+                    done.append(move['id'])
+                except Exception as e:
+                    logger.error(f"Error notifying about moved device {move['id']}: {e}")
+
+        self.db_manager.mark_moves_notified(done)
+        return len(done)
+
+    def run_step(self) -> Dict[str, Any]:
+        """Один ограниченный шаг перераспределения."""
+        report = {'planned': 0, 'moved': 0, 'notified': 0}
+        try:
+            moves = self.plan_moves(self.batch_size)
+            report['planned'] = len(moves)
+            if moves:
+                report['moved'] = len(self.db_manager.move_devices(moves))
+                self.node_manager.balancer.invalidate()
+            report['notified'] = self.notify_moved(self.batch_size)
+
+            if any(report.values()):
+                logger.info(f"Rebalance step: {report['moved']}/{report['planned']} devices moved, "
+                            f"{report['notified']} users notified")
+        except Exception as e:
+            logger.error(f"Error rebalancing nodes: {e}")
+        return report
@@ -0,0 +1,115 @@
+import hashlib
+import hmac
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from config.settings import (
+    TOKEN,
+    SUBSCRIPTION_SECRET,
+    SUBSCRIPTION_BASE_URL,
+    SUBSCRIPTION_CACHE_MAX_AGE,
+    SUBSCRIPTION_UPDATE_INTERVAL
+)
+from database.db_manager import DatabaseManager
+from database.models import Device
+from services.config_renderer import ConfigRenderer, FORMATS
+
+logger = logging.getLogger('subscription')
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+class SubscriptionService:
+    """
+    Подписка устройства по ссылке вида {base_url}/sub/{id}.{подпись}[/{формат}].
+
+    Подпись - HMAC от id устройства, поэтому поддельные ссылки отбрасываются
+    без обращения к БД. Ответ строится из сохраненной конфигурации устройства
+    (ConfigRenderer с кэшем), без запросов к Marzban и Telegram. ETag - хеш
+    конфигурации: клиент с актуальной версией получает 304 без тела.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, config_renderer: ConfigRenderer,
+                 secret: str = SUBSCRIPTION_SECRET, base_url: str = SUBSCRIPTION_BASE_URL,
+                 max_age: int = SUBSCRIPTION_CACHE_MAX_AGE,
+                 update_interval: int = SUBSCRIPTION_UPDATE_INTERVAL):
+        self.db_manager = db_manager
+        self.config_renderer = config_renderer
+        # Без отдельного секрета ключ выводится из токена бота
+        self._key = (secret or hashlib.sha256(f"subscription:{TOKEN}".encode()).hexdigest()).encode()
+        self.base_url = base_url.rstrip('/')
+        self.max_age = max_age
+        self.update_interval = update_interval
+
+    def _signature(self, device_id: int) -> str:
+        return hmac.new(self._key, str(device_id).encode(), hashlib.sha256).hexdigest()[:24]
+
+    def make_token(self, device_id: int) -> str:
+        return f"{device_id}.{self._signature(device_id)}"
+
+    def verify_token(self, token: str) -> Optional[int]:
+        """id устройства по токену или None для неверной подписи."""
+        device_id, _, signature = token.partition('.')
+        if not device_id.isdigit() or not hmac.compare_digest(signature, self._signature(int(device_id))):
+            return None
+        return int(device_id)
+
+    def get_url(self, device: Device, fmt: str = 'subscription') -> Optional[str]:
+        """Ссылка подписки; None, если публичный адрес сервера не задан."""
+        if not self.base_url or device.id is None:
+            return None
+        url = f"{self.base_url}/sub/{self.make_token(device.id)}"
+        return url if fmt == 'subscription' else f"{url}/{fmt}"
+
+    @staticmethod
+    def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # Слабые валидаторы сравниваются без префикса W/
+        candidates = (tag.strip() for tag in if_none_match.split(','))
+        return any(tag[2:] == etag if tag.startswith('W/') else tag == etag for tag in candidates)
+
+    def serve(self, token: str, fmt: str = 'subscription',
+              if_none_match: Optional[str] = None) -> Tuple[int, bytes, Dict[str, str]]:
+        """Ответ на запрос подписки: (код, тело, заголовки)."""
+        if fmt not in FORMATS:
+            return 404, b'Unknown format', {}
+
+        device_id = self.verify_token(token)
+        if device_id is None:
+            return 404, b'Not found', {}
+
+        device = self.db_manager.get_device_by_id(device_id)
+        expires_at = _as_datetime(device.expires_at) if device else None
+        if not device or (expires_at and expires_at <= datetime.now()):
+            return 410, b'Subscription expired', {'Cache-Control': 'no-store'}
+
+        rendered = self.config_renderer.render(device, fmt)
+        if not rendered:
+            return 404, b'No configs', {'Cache-Control': 'no-store'}
+
+        etag = f'"{rendered.config_hash}-{fmt}"'
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'private, max-age={self.max_age}',
+            'Profile-Update-Interval': str(self.update_interval),
+            'Subscription-Userinfo': f"upload=0; download=0; total=0; expire={int(expires_at.timestamp()) if expires_at else 0}"
+        }
+        if self._etag_matches(if_none_match, etag):
+            return 304, b'', headers
+
+        headers.update({
+            'Content-Type': rendered.media_type,
+            'Content-Disposition': f'inline; filename="{rendered.filename}"'
+        })
+        return 200, rendered.content, headers
@@ -0,0 +1,109 @@
+import logging
+import secrets
+import threading
+import time
+from typing import List, Optional
+
+from config.settings import (
+    MARZBAN_USER_TEMPLATES,
+    MARZBAN_POOL_TARGET_SIZE,
+    MARZBAN_POOL_REFILL_INTERVAL
+)
+from database.db_manager import DatabaseManager
+from services.marzban_service import MarzbanService
+
+logger = logging.getLogger('user_pool')
+
+
+class MarzbanUserPool:
+    """
+    Пул заранее созданных отключенных пользователей Marzban.
+
+    add_device забирает готового пользователя и активирует его одним запросом,
+    а пополнение пула до целевого размера идет в фоновом потоке.
+    Пул хранится в БД, поэтому заготовки не теряются при перезапуске.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, marzban_service: MarzbanService,
+                 templates: Optional[List[str]] = None,
+                 target_size: int = MARZBAN_POOL_TARGET_SIZE,
+                 refill_interval: int = MARZBAN_POOL_REFILL_INTERVAL):
+        self.db_manager = db_manager
+        self.marzban = marzban_service
+        self.templates = templates or list(MARZBAN_USER_TEMPLATES)
+        self.target_size = target_size
+        self.refill_interval = refill_interval
+        self._refill_event = threading.Event()
+        self._stop_flag = threading.Event()
+        self._thread = None
+
+    def claim(self, template: str) -> Optional[str]:
+        """Забрать пользователя из пула (None, если пул пуст)."""
+        try:
+            username = self.db_manager.claim_pool_user(template)
+            if username:
+                logger.info(f"Claimed pooled user {username} ({template})")
+            else:
+                logger.warning(f"User pool for {template} is empty")
+            return username
+        except Exception as e:
+            logger.error(f"Error claiming pooled user: {e}")
+            return None
+        finally:
+            # Пополняем пул асинхронно, не задерживая пользователя
+            self._refill_event.set()
+
+    def refill(self) -> int:
+        """Дозаполнение пула до целевого размера. Возвращает число созданных пользователей."""
+        created = 0
+        for template in self.templates:
+            try:
+                missing = self.target_size - self.db_manager.get_pool_size(template)
+                for _ in range(max(missing, 0)):
+                    username = self._generate_username(template)
+                    if not self.marzban.create_user(username, days=None, template=template, status="disabled"):
+                        logger.warning(f"Failed to pre-create pooled user for {template}")
+                        break
+                    self.db_manager.add_pool_user(username, template, self.marzban.get_panel_name(username))
+                    created += 1
+            except Exception as e:
+                logger.error(f"Error refilling user pool for {template}: {e}")
+
+        if created:
+            logger.info(f"User pool refilled with {created} users")
+        return created
+
+    @staticmethod
+    def _generate_username(template: str) -> str:
+        prefix = template.split('_')[0]
+        return f"{prefix}_{int(time.time())}{secrets.token_hex(2)}"
+
+    def _refill_loop(self):
+        """Фоновое пополнение: по сигналу после claim или по таймеру."""
+        while not self._stop_flag.is_set():
+            with self.marzban.background():
+                self.refill()
+            self._refill_event.wait(timeout=self.refill_interval)
+            self._refill_event.clear()
+
+    def start(self) -> None:
+        """Запуск фонового пополнения пула."""
+        if self.target_size <= 0:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_flag.clear()
+            self._thread = threading.Thread(
+                target=self._refill_loop,
+                name="UserPoolRefill",
+                daemon=True
+            )
+            self._thread.start()
+            logger.info("User pool refill started")
+
+    def stop(self) -> None:
+        """Остановка фонового пополнения."""
+        if self._thread and self._thread.is_alive():
+            self._stop_flag.set()
+            self._refill_event.set()
+            self._thread.join(timeout=5)
+            logger.info("User pool refill stopped")
@@ -0,0 +1,101 @@
+import contextlib
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from database.db_manager import DatabaseManager  # noqa: E402
+from database.models import User  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Чистая БД с одним пользователем (telegram_id=1)."""
+    db_manager = DatabaseManager(str(tmp_path / 'test.db'))
+    db_manager.update_user(User(1, 'user', 'First', 'Last'))
+    return db_manager
+
+
+class FakeMarzban:
+    """Marzban без сети: удаления успешны, пока available, кроме имен из failing."""
+
+    node_manager = None
+
+    def __init__(self):
+        self.available = True
+        self.failing = set()
+        self.deleted = []
+
+    def traffic(self, traffic_class):
+        return contextlib.nullcontext()
+
+    def background(self):
+        return contextlib.nullcontext()
+
+    def delete_user(self, username):
+        if not self.available or username in self.failing:
+            return False
+        self.deleted.append(username)
+        return True
+
+    def delete_users(self, usernames, max_workers=None):
+        return {username: self.delete_user(username) for username in usernames}
+
+    def delete_expired_users(self, expired_before, expired_after=None):
+        return []
+
+    def get_rate_limit_stats(self):
+        return {'background': {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0}}
+
+    def get_panel_name(self, username):
+        return 'main'
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def marzban():
+    return FakeMarzban()
+
+
+@pytest.fixture
+def dispatcher():
+    return FakeDispatcher()
+
+
+class FakeClock:
+    """
+    Управляемое время для модулей, импортирующих time: sleep сдвигает часы без ожидания.
+    Интервалы в тестах - двоичные дроби, чтобы сложение было точным.
+    """
+
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
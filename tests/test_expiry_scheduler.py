@@ -0,0 +1,135 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database.models import Device
+from services.expiry_scheduler import ExpiryScheduler, RETRY_DELAY
+
+
+class FakeNotificationService:
+    """Записывает вызовы; purge_ok=False - удаление в Marzban не удается."""
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.calls = []
+        self.purge_ok = True
+
+    def process_expirations(self, current_time, expired, expiring, sweep_name=None):
+        self.calls.append(([device.id for device in expired], [device.id for device in expiring]))
+        if not self.purge_ok:
+            return []
+        self.db_manager.deactivate_devices([device.id for device in expired])
+        return expired
+
+
+def _add_device(db, expires_at, name='dev'):
+    return db.add_device(Device(
+        telegram_id=1, device_type=name, config_data='{}', created_at=datetime.now(),
+        expires_at=expires_at, marzban_username=name
+    ))
+
+
+def _scheduler(db):
+    service = FakeNotificationService(db)
+    scheduler = ExpiryScheduler(db, service)
+    scheduler.load()
+    return scheduler, service
+
+
+def _due_entries(scheduler, kind):
+    return [entry for entry in scheduler._heap if entry[3] == kind and scheduler._expiries.get(entry[2]) == entry[4]]
+
+
+def test_loads_active_expiries_and_fires_due_ones(db):
+    now = datetime.now()
+    expired_id = _add_device(db, now - timedelta(minutes=1), 'expired')
+    warned_id = _add_device(db, now + timedelta(hours=2), 'warned')
+    _add_device(db, now + timedelta(days=10), 'later')
+    scheduler, service = _scheduler(db)
+
+    scheduler._fire(scheduler._pop_due())
+
+    assert service.calls == [([expired_id], [warned_id])]
+    assert scheduler.get_stats()['devices'] == 2  # истекшее снято, у остальных события в куче
+
+
+def test_extension_makes_old_entries_stale(db):
+    now = datetime.now()
+    extended_id = _add_device(db, now - timedelta(seconds=1), 'extended')
+    other_id = _add_device(db, now - timedelta(seconds=1), 'other')
+    scheduler, service = _scheduler(db)
+
+    # Продление через DatabaseManager заменяет актуальный срок, старые события устаревают
+    db.update_device_expiry(extended_id, now + timedelta(days=30))
+    due = scheduler._pop_due()
+
+    assert due == {'warning': [other_id], 'expire': [other_id]}
+    assert scheduler.skipped == 2
+    assert scheduler._expiries[extended_id] == now + timedelta(days=30)
+
+
+def test_deactivated_device_entries_are_skipped(db):
+    now = datetime.now()
+    device_id = _add_device(db, now - timedelta(seconds=1))
+    other_id = _add_device(db, now - timedelta(seconds=1), 'other')
+    scheduler, service = _scheduler(db)
+
+    db.deactivate_device(device_id)
+    scheduler._fire(scheduler._pop_due())
+
+    assert service.calls == [([other_id], [])]
+    assert scheduler.skipped >= 2  # предупреждение и деактивация снятого устройства
+
+
+def test_failed_purge_is_retried_later(db):
+    now = datetime.now()
+    device_id = _add_device(db, now - timedelta(seconds=1))
+    scheduler, service = _scheduler(db)
+    service.purge_ok = False
+
+    scheduler._fire(scheduler._pop_due())
+
+    retries = _due_entries(scheduler, 'expire')
+    assert [entry[2] for entry in retries] == [device_id]
+    assert retries[0][0] - now >= RETRY_DELAY - timedelta(seconds=5)
+
+
+def test_devices_created_after_load_are_scheduled(db):
+    scheduler, service = _scheduler(db)
+    device_id = _add_device(db, datetime.now() - timedelta(seconds=1))
+
+    scheduler._fire(scheduler._pop_due())
+
+    assert service.calls == [([device_id], [])]
+
+
+def test_reconcile_reloads_expiries_written_outside_db_manager(db):
+    device_id = _add_device(db, datetime.now() + timedelta(days=10))
+    scheduler, service = _scheduler(db)
+    with db.get_connection() as conn:
+        conn.execute("UPDATE devices SET expires_at = ? WHERE id = ?",
+                     (datetime.now() - timedelta(seconds=1), device_id))
+
+    scheduler.reconcile()  # поток не запущен - reconcile запускает его
+    try:
+        for _ in range(50):
+            if service.calls:
+                break
+            time.sleep(0.1)
+    finally:
+        scheduler.stop()
+
+    assert service.calls == [([device_id], [])]
+
+
+def test_reconcile_restarts_dead_thread(db):
+    scheduler, service = _scheduler(db)
+    scheduler._thread = threading.Thread(target=lambda: None)
+    scheduler._thread.start()
+    scheduler._thread.join()
+
+    scheduler.reconcile()
+    try:
+        assert scheduler._thread.is_alive()
+    finally:
+        scheduler.stop()
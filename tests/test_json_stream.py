@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from utils.json_stream import iter_json_array, JSONStreamError
+
+
+def _chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+USERS = [
+    {'username': 'пользователь_1', 'used_traffic': 123456789, 'note': 'a,]b'},
+    {'username': 'user_2', 'used_traffic': 0.5, 'links': ['vless://x,]y']},
+    12345,
+    'строка ✓'
+]
+
+
+def test_one_byte_chunks():
+    data = json.dumps({'total': 4, 'users': USERS}, ensure_ascii=False).encode('utf-8')
+
+    assert list(iter_json_array(_chunks(data, 1), key='users')) == USERS
+
+
+def test_multibyte_characters_split_across_chunks():
+    data = json.dumps(['Привет', '✓✓'], ensure_ascii=False).encode('utf-8')
+    # Границы чанков попадают внутрь многобайтовых символов
+    chunks = [data[:4], data[4:9], data[9:]]
+
+    assert list(iter_json_array(chunks)) == ['Привет', '✓✓']
+
+
+def test_number_at_chunk_boundary_is_not_truncated():
+    assert list(iter_json_array([b'[12', b'345, 6', b'7]'])) == [12345, 67]
+
+
+def test_strings_containing_array_delimiters():
+    data = json.dumps({'users': [{'name': '],[,'}, ',]'], 'other': []}).encode()
+
+    assert list(iter_json_array(_chunks(data, 3), key='users')) == [{'name': '],[,'}, ',]']
+
+
+def test_key_inside_string_value_is_not_confused():
+    data = json.dumps({'note': '"users": [0]', 'users': [1]}).encode()
+
+    assert list(iter_json_array([data], key='users')) == [1]
+
+
+def test_empty_array():
+    assert list(iter_json_array([b' [ ] '])) == []
+    assert list(iter_json_array([b'{"users": []}'], key='users')) == []
+
+
+def test_truncated_stream_raises():
+    data = json.dumps({'users': USERS}).encode()
+
+    with pytest.raises(JSONStreamError):
+        list(iter_json_array(_chunks(data[:-10], 7), key='users'))
+
+
+def test_non_array_body_raises():
+    with pytest.raises(JSONStreamError):
+        list(iter_json_array([b'"error"']))
+    with pytest.raises(JSONStreamError):
+        list(iter_json_array([b'{"detail": "Not Found"}'], key='users'))
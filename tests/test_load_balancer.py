@@ -0,0 +1,103 @@
+import random
+from collections import Counter
+
+import pytest
+
+from services.load_balancer import (
+    BalancingStrategy,
+    CapacityCappedStrategy,
+    LeastLoadedStrategy,
+    LoadBalancer,
+    PowerOfTwoStrategy,
+    STRATEGIES
+)
+
+
+def _nodes(*specs):
+    return [{'address': address, 'weight': weight, 'max_users': max_users}
+            for address, weight, max_users in specs]
+
+
+def _balancer(nodes, loads, strategy):
+    return LoadBalancer(nodes, lambda: dict(loads), strategy=strategy, cache_ttl=3600)
+
+
+def test_strategy_base_is_abstract():
+    with pytest.raises(TypeError):
+        BalancingStrategy()
+    assert all(issubclass(strategy, BalancingStrategy) for strategy in STRATEGIES.values())
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        _balancer([], {}, 'round_robin')
+
+
+def test_least_loaded_fills_lowest_ratio_first():
+    nodes = _nodes(('a', 1, 0), ('b', 2, 0), ('c', 1, 0))
+    balancer = _balancer(nodes, {'a': 5, 'b': 6, 'c': 1}, 'least_loaded')
+
+    picks = [balancer.select() for _ in range(8)]
+
+    # c догоняет b до ratio 3, дальше b с весом 2 получает вдвое больше устройств
+    assert picks == ['c', 'c', 'b', 'c', 'b', 'b', 'c', 'b']
+    assert balancer._loads == {'a': 5, 'b': 10, 'c': 5}
+
+
+def test_unavailable_nodes_are_not_selected():
+    nodes = _nodes(('a', 1, 0), ('down', 1, 0))
+    balancer = _balancer(nodes, {'a': 100}, 'least_loaded')
+
+    assert {balancer.select() for _ in range(5)} == {'a'}
+
+
+def test_capacity_cap_exhausts_nodes():
+    nodes = _nodes(('a', 1, 2), ('b', 1, 3), ('unlimited', 1, 0))
+    balancer = _balancer(nodes, {'a': 1, 'b': 1, 'unlimited': 50}, 'capacity_capped')
+
+    picks = [balancer.select() for _ in range(3)]
+
+    assert Counter(picks) == Counter({'a': 1, 'b': 2})
+    # Ограниченные ноды заполнены, дальше остается только нода без лимита
+    assert balancer.select() == 'unlimited'
+
+
+def test_capacity_cap_returns_none_when_all_full():
+    nodes = _nodes(('a', 1, 1), ('b', 1, 2))
+    balancer = _balancer(nodes, {'a': 0, 'b': 1}, 'capacity_capped')
+
+    assert sorted([balancer.select(), balancer.select()]) == ['a', 'b']
+    assert balancer.select() is None
+
+
+def test_capacity_cap_wraps_other_strategy():
+    strategy = CapacityCappedStrategy(PowerOfTwoStrategy())
+    nodes = _nodes(('a', 1, 1), ('b', 1, 0))
+    strategy.rebuild(nodes, {'a': 1, 'b': 0})
+
+    assert strategy.inner.nodes == [nodes[1]]
+    assert isinstance(CapacityCappedStrategy().inner, LeastLoadedStrategy)
+
+
+def test_weighted_distribution_follows_weights():
+    random.seed(1)
+    nodes = _nodes(('a', 1, 0), ('b', 3, 0), ('c', 6, 0), ('off', 0, 0))
+    balancer = _balancer(nodes, {'a': 0, 'b': 0, 'c': 0, 'off': 0}, 'weighted')
+
+    counts = Counter(balancer.select() for _ in range(20000))
+
+    assert counts['off'] == 0
+    for address, share in (('a', 0.1), ('b', 0.3), ('c', 0.6)):
+        assert abs(counts[address] / 20000 - share) < 0.02
+
+
+def test_power_of_two_prefers_less_loaded():
+    random.seed(2)
+    nodes = _nodes(('busy', 1, 0), ('idle', 1, 0), ('mid', 1, 0))
+    balancer = _balancer(nodes, {'busy': 1000, 'idle': 0, 'mid': 500}, 'power_of_two')
+
+    counts = Counter(balancer.select() for _ in range(300))
+
+    # Самая загруженная нода проигрывает любую пару
+    assert counts['busy'] == 0
+    assert counts['idle'] > counts['mid']
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+import services.marzban_scheduler
+from services.marzban_scheduler import MarzbanRequestScheduler, SchedulerQueueFull
+
+
+@pytest.fixture
+def scheduler_clock(clock, monkeypatch):
+    monkeypatch.setattr(services.marzban_scheduler, 'time', clock)
+    return clock
+
+
+def _drain(scheduler):
+    order = []
+    while True:
+        item = scheduler._pick_next()
+        if item is None:
+            return order
+        order.append(item[1][3][0])
+
+
+def _submit(scheduler, traffic_class, label):
+    return scheduler.submit(traffic_class, lambda value: value, label)
+
+
+def test_classes_are_served_by_priority(scheduler_clock):
+    scheduler = MarzbanRequestScheduler(workers=1, aging_seconds=10)
+    _submit(scheduler, 'background', 'bg1')
+    _submit(scheduler, 'payment', 'pay1')
+    _submit(scheduler, 'interactive', 'ui1')
+    _submit(scheduler, 'background', 'bg2')
+    _submit(scheduler, 'interactive', 'ui2')
+
+    assert _drain(scheduler) == ['ui1', 'ui2', 'pay1', 'bg1', 'bg2']
+    assert scheduler._pending == 0
+
+
+def test_unknown_class_is_treated_as_interactive(scheduler_clock):
+    scheduler = MarzbanRequestScheduler(workers=1, aging_seconds=10)
+    _submit(scheduler, 'background', 'bg')
+    _submit(scheduler, 'bulk', 'unknown')
+
+    assert _drain(scheduler) == ['unknown', 'bg']
+
+
+def test_aging_prevents_background_starvation(scheduler_clock):
+    scheduler = MarzbanRequestScheduler(workers=1, aging_seconds=4)
+    _submit(scheduler, 'background', 'bg')
+
+    # Каждую секунду приходит новый интерактивный запрос и обслуживается один
+    served = []
+    for i in range(20):
+        _submit(scheduler, 'interactive', f'ui{i}')
+        scheduler_clock.advance(1)
+        served.append(scheduler._pick_next()[1][3][0])
+
+    # Разница приоритетов 2 при aging 4 с: фоновый запрос обгоняет интерактивный,
+    # ждущий 1 с, когда сам ждет дольше 9 с
+    assert served.index('bg') == 9
+    assert served.count('bg') == 1
+
+
+def test_queue_limit_rejects_new_requests(scheduler_clock):
+    scheduler = MarzbanRequestScheduler(workers=1, max_queue=2)
+    _submit(scheduler, 'background', 'a')
+    _submit(scheduler, 'background', 'b')
+
+    with pytest.raises(SchedulerQueueFull):
+        _submit(scheduler, 'interactive', 'c')
+
+
+def test_run_executes_inline_without_workers():
+    scheduler = MarzbanRequestScheduler(workers=1)
+
+    assert scheduler.run('background', lambda x: x * 2, 21) == 42
+    assert scheduler._pending == 0
+
+
+def test_workers_complete_futures_and_record_stats():
+    scheduler = MarzbanRequestScheduler(workers=2).start()
+    try:
+        assert scheduler.run('payment', lambda: 'paid') == 'paid'
+        failed = scheduler.submit('background', lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            failed.result(timeout=5)
+        # Вложенный вызов из рабочего потока выполняется сразу, без постановки в очередь
+        nested = scheduler.submit('background', lambda: scheduler.run('interactive', threading.current_thread))
+        assert nested.result(timeout=5).name.startswith('MarzbanWorker')
+    finally:
+        scheduler.stop()
+
+    stats = scheduler.get_stats()
+    assert stats['payment']['completed'] == 1
+    assert stats['background']['completed'] == 2
+    assert stats['interactive']['completed'] == 0
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database.models import Device
+from services.device_service import DeviceService
+from services.qr_service import QRService
+
+
+def _add_device(db, username):
+    return db.add_device(Device(
+        telegram_id=1, device_type='android', config_data='{}', created_at=datetime.now(),
+        expires_at=datetime.now() + timedelta(days=10), marzban_username=username
+    ))
+
+
+def _is_active(db, device_id):
+    return bool(db.get_active_devices_by_ids([device_id]))
+
+
+@pytest.fixture
+def device_service(db, marzban, dispatcher):
+    return DeviceService(db, marzban, None, qr_service=QRService(backend='inline'), dispatcher=dispatcher)
+
+
+def test_user_disabled_deletes_remotely_and_notifies(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_disabled')
+
+    assert device_service.handle_marzban_events([{'action': 'user_disabled', 'username': 'user_disabled'}]) == 1
+
+    assert not _is_active(db, device_id)
+    assert marzban.deleted == ['user_disabled']
+    assert len(dispatcher.sent) == 1 and 'заблокирован' in dispatcher.sent[0][1]
+
+
+def test_user_expired_uses_expiry_notice(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_expired')
+
+    assert device_service.handle_marzban_events([{'action': 'user_expired', 'user': {'username': 'user_expired'}}]) == 1
+
+    assert not _is_active(db, device_id)
+    assert marzban.deleted == ['user_expired']
+    assert 'истечением срока' in dispatcher.sent[0][1]
+
+
+def test_user_deleted_only_deactivates(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_deleted')
+
+    assert device_service.handle_marzban_events([{'action': 'user_deleted', 'username': 'user_deleted'}]) == 1
+
+    assert not _is_active(db, device_id)
+    assert marzban.deleted == []
+    assert len(dispatcher.sent) == 1
+
+
+def test_failed_remote_delete_keeps_device_active(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_stuck')
+    marzban.failing.add('user_stuck')
+
+    assert device_service.handle_marzban_events([{'action': 'user_disabled', 'username': 'user_stuck'}]) == 0
+
+    assert _is_active(db, device_id)
+    assert dispatcher.sent == []
+
+
+def test_unknown_and_incomplete_events_are_ignored(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_ok')
+    events = [
+        {'action': 'user_disabled'},
+        {'action': 'user_disabled', 'username': 'missing'},
+        {'action': 'user_created', 'username': 'user_ok'},
+        {'action': 'user_limited', 'username': 'user_ok'}
+    ]
+
+    assert device_service.handle_marzban_events(events) == 0
+
+    assert _is_active(db, device_id)
+    assert db.get_device_by_marzban_username('user_ok').health_flagged_at is not None
+    assert dispatcher.sent == []
+
+
+def test_webhook_echo_of_own_delete_sends_one_notice(db, marzban, dispatcher, device_service):
+    device_id = _add_device(db, 'user_echo')
+    delete_user = marzban.delete_user
+
+    def delete_with_echo(username):
+        # Панель присылает user_deleted еще до того, как delete_user вернул ответ
+        result = delete_user(username)
+        device_service.handle_marzban_events([{'action': 'user_deleted', 'username': username}])
+        return result
+
+    marzban.delete_user = delete_with_echo
+
+    assert device_service.handle_marzban_events([{'action': 'user_disabled', 'username': 'user_echo'}]) == 1
+
+    assert not _is_active(db, device_id)
+    assert len(dispatcher.sent) == 1 and 'заблокирован' in dispatcher.sent[0][1]
+
+
+class _DeviceService:
+    def __init__(self):
+        self.events = []
+
+    def handle_marzban_events(self, events):
+        self.events.extend(events)
+        return len(events)
+
+
+@pytest.fixture
+def webhook_client(monkeypatch):
+    pytest.importorskip('yookassa')
+    import bot
+
+    service = _DeviceService()
+    monkeypatch.setattr(bot, 'MARZBAN_WEBHOOK_SECRET', 'webhook-secret')
+    monkeypatch.setattr(bot, 'device_service', service)
+    return bot.app.test_client(), service
+
+
+def test_webhook_rejects_wrong_secret(webhook_client):
+    client, service = webhook_client
+
+    assert client.post('/marzban-webhook', json=[{'action': 'user_disabled', 'username': 'u'}]).status_code == 403
+    response = client.post('/marzban-webhook', json=[{'action': 'user_disabled', 'username': 'u'}],
+                           headers={'x-webhook-secret': 'wrong'})
+    assert response.status_code == 403
+    assert service.events == []
+
+
+def test_webhook_accepts_single_event_and_lists(webhook_client):
+    client, service = webhook_client
+    headers = {'x-webhook-secret': 'webhook-secret'}
+
+    single = client.post('/marzban-webhook', json={'action': 'user_expired', 'username': 'a'}, headers=headers)
+    batch = client.post('/marzban-webhook', json=[{'action': 'user_deleted', 'username': 'b'}] * 2, headers=headers)
+    invalid = client.post('/marzban-webhook', data='not json', headers=headers)
+
+    assert single.get_json() == {'success': True, 'processed': 1}
+    assert batch.get_json() == {'success': True, 'processed': 2}
+    assert invalid.status_code == 400
+    assert len(service.events) == 3
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from database.models import Device
+
+
+def _node(name, address, **extra):
+    return {'name': name, 'host': f'{name}.example.com', 'address': address, **extra}
+
+
+def test_register_nodes_syncs_registry_and_counters(db):
+    db.add_device(Device(
+        telegram_id=1, device_type='android', config_data='{}', created_at=datetime.now(),
+        expires_at=datetime.now() + timedelta(days=1), marzban_username='user_1', server_ip='10.0.0.2'
+    ))
+    db.register_nodes([_node('de', '10.0.0.1'), _node('nl', '10.0.0.2')])
+
+    db.register_nodes([_node('nl', '10.0.0.2', weight=3, max_users=50)])
+
+    nodes = db.get_nodes()
+    assert [(node['name'], node['weight'], node['max_users']) for node in nodes] == [('nl', 3, 50)]
+    assert db.get_node_counters() == {'10.0.0.2': 1}
+
+
+def test_register_empty_node_list_clears_registry(db):
+    db.register_nodes([_node('de', '10.0.0.1')])
+
+    db.register_nodes([])
+
+    assert db.get_nodes() == []
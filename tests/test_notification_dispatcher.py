@@ -0,0 +1,118 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from services.notification_dispatcher import NotificationDispatcher
+
+
+class _Response:
+    def __init__(self, status_code, reason):
+        self.status_code = status_code
+        self.reason = reason
+
+
+def _api_error(code, description, parameters=None):
+    result = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        result['parameters'] = parameters
+    return ApiTelegramException('sendMessage', _Response(code, description), result)
+
+
+class FakeBot:
+    """Записывает время отправок; errors - очередь исключений по chat_id."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            queue = self.errors.get(chat_id)
+            if queue:
+                raise queue.pop(0)
+            self.sent.append((time.monotonic(), chat_id, text))
+
+
+def _times(bot, chat_id):
+    return [sent_at for sent_at, chat, _ in bot.sent if chat == chat_id]
+
+
+def test_per_chat_limit_spaces_messages(db):
+    bot = FakeBot()
+    dispatcher = NotificationDispatcher(bot, db, global_rate=100, per_chat_rate=5, workers=4)
+    for i in range(4):
+        dispatcher.send(1, f"message {i}")
+    dispatcher.send(2, "other chat")
+
+    assert dispatcher.flush(timeout=5)
+    dispatcher.stop()
+
+    times = _times(bot, 1)
+    assert [text for _, chat, text in bot.sent if chat == 1] == [f"message {i}" for i in range(4)]
+    assert all(later - earlier >= 0.19 for earlier, later in zip(times, times[1:]))
+    # Другой чат не ждет очереди первого
+    assert _times(bot, 2)[0] - times[0] < 0.15
+
+
+def test_global_rate_limits_all_chats(db):
+    bot = FakeBot()
+    dispatcher = NotificationDispatcher(bot, db, global_rate=10, per_chat_rate=100, workers=4)
+    started = time.monotonic()
+    for chat_id in range(30):
+        dispatcher.send(chat_id, "hello")
+
+    assert dispatcher.flush(timeout=10)
+    dispatcher.stop()
+
+    # Ведро емкостью 10 отдает первые 10 сразу, остальные 20 - со скоростью 10/с
+    assert len(bot.sent) == 30
+    assert time.monotonic() - started >= 1.8
+    assert dispatcher.get_stats()['sent'] == 30
+
+
+def test_rate_limit_pauses_all_workers(db):
+    bot = FakeBot({1: [_api_error(429, 'Too Many Requests', {'retry_after': 1})]})
+    dispatcher = NotificationDispatcher(bot, db, global_rate=100, per_chat_rate=100, workers=2)
+    started = time.monotonic()
+    dispatcher.send(1, "limited")
+    time.sleep(0.1)
+    dispatcher.send(2, "waits for the pause")
+
+    assert dispatcher.flush(timeout=5)
+    dispatcher.stop()
+
+    stats = dispatcher.get_stats()
+    assert stats['rate_limited'] == 1 and stats['retried'] == 1
+    assert {chat for _, chat, _ in bot.sent} == {1, 2}
+    assert min(sent_at for sent_at, _, _ in bot.sent) - started >= 0.95
+
+
+def test_blocked_chat_goes_to_dead_letters(db):
+    bot = FakeBot({403: [_api_error(403, 'Forbidden: bot was blocked by the user')]})
+    dispatcher = NotificationDispatcher(bot, db, global_rate=100, per_chat_rate=100, workers=2)
+    dispatcher.send(403, "first")
+    dispatcher.send(403, "second")
+    dispatcher.send(1, "delivered")
+
+    assert dispatcher.flush(timeout=5)
+    dispatcher.stop()
+
+    assert [chat for _, chat, _ in bot.sent] == [1]
+    assert dispatcher.get_stats()['dead_lettered'] == 2
+    with db.get_connection() as conn:
+        rows = conn.execute("SELECT telegram_id, text FROM notification_dead_letters ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [(403, "first"), (403, "second")]
+
+
+def test_exhausted_retries_are_dead_lettered(db):
+    bot = FakeBot({1: [_api_error(500, 'Internal Server Error') for _ in range(2)]})
+    dispatcher = NotificationDispatcher(bot, db, global_rate=100, per_chat_rate=100, workers=1, max_retries=1)
+    dispatcher.send(1, "lost")
+
+    assert dispatcher.flush(timeout=10)
+    dispatcher.stop()
+
+    assert bot.sent == []
+    assert dispatcher.get_stats()['dead_lettered'] == 1
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from database.models import Device
+from services.notification_service import (
+    NotificationService,
+    EXPIRY_WARNING_KIND,
+    EXPIRY_WARNING_HOURS,
+    DEACTIVATION_NOTICE_KIND
+)
+
+
+def _add_device(db, expires_at, name='dev', telegram_id=1):
+    return db.add_device(Device(
+        telegram_id=telegram_id, device_type=name, config_data='{}', created_at=datetime.now(),
+        expires_at=expires_at, marzban_username=name
+    ))
+
+
+def test_notified_devices_are_filtered_in_bulk(db):
+    now = datetime.now()
+    first = _add_device(db, now + timedelta(hours=5), 'first')
+    second = _add_device(db, now + timedelta(hours=6), 'second')
+
+    db.mark_devices_notified([first], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS, now)
+
+    assert db.get_notified_device_ids([first, second], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS) == {first}
+    # Другой порог или тип уведомления - отдельная запись
+    assert db.get_notified_device_ids([first], EXPIRY_WARNING_KIND, 1) == set()
+
+
+def test_extension_resets_warning(db):
+    now = datetime.now()
+    device_id = _add_device(db, now + timedelta(hours=5))
+    db.mark_devices_notified([device_id], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS, now)
+
+    db.update_device_expiry(device_id, now + timedelta(hours=20))
+
+    assert db.get_notified_device_ids([device_id], EXPIRY_WARNING_KIND, EXPIRY_WARNING_HOURS) == set()
+
+
+def test_claim_succeeds_once(db):
+    device_id = _add_device(db, datetime.now())
+
+    assert db.claim_notifications([device_id], DEACTIVATION_NOTICE_KIND, 0, datetime.now()) == {device_id}
+    assert db.claim_notifications([device_id], DEACTIVATION_NOTICE_KIND, 0, datetime.now()) == set()
+
+
+def test_expiry_warning_sent_once_across_restarts(db, marzban, dispatcher):
+    now = datetime.now()
+    _add_device(db, now + timedelta(hours=5), 'soon')
+    _add_device(db, now + timedelta(hours=48), 'later')
+
+    NotificationService(None, db, marzban, dispatcher).check_device_expiration()
+    NotificationService(None, db, marzban, dispatcher).check_device_expiration()
+
+    assert len(dispatcher.sent) == 1
+    assert 'soon' in dispatcher.sent[0][1]
+
+
+def test_expired_device_notified_once_when_webhook_got_there_first(db, marzban, dispatcher):
+    device_id = _add_device(db, datetime.now() - timedelta(minutes=1), 'expired')
+    # Вебхук уже сообщил о деактивации этого устройства
+    db.claim_notifications([device_id], DEACTIVATION_NOTICE_KIND, 0, datetime.now())
+
+    NotificationService(None, db, marzban, dispatcher).check_device_expiration()
+
+    assert dispatcher.sent == []
+    assert db.get_active_devices_by_ids([device_id]) == []
@@ -0,0 +1,126 @@
+from config.settings import DEFAULT_PLAN_PRICE
+from services.marzban_service import USER_NOT_FOUND
+from services.provisioning import ProvisioningPipeline
+
+
+class ProvisioningMarzban:
+    """Marzban для конвейера: create_ok/activate_ok управляют ответами панели."""
+
+    node_manager = None
+
+    def __init__(self, marzban):
+        self.base = marzban
+        self.create_ok = True
+        self.activate_ok = True
+        self.created = []
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def create_user(self, username, days):
+        if not self.create_ok:
+            return None
+        self.created.append(username)
+        return {'username': username, 'links': ['vless://example']}
+
+    def activate_user(self, username, days):
+        return {'username': username, 'links': ['vless://pool']} if self.activate_ok else None
+
+    def get_user_configs(self, usernames):
+        return {username: USER_NOT_FOUND for username in usernames}
+
+
+class FakePool:
+    def __init__(self, usernames):
+        self.usernames = list(usernames)
+
+    def claim(self, template):
+        return self.usernames.pop(0) if self.usernames else None
+
+
+def _balance(db):
+    return db.get_user(1).balance
+
+
+def _reservations(db):
+    with db.get_connection() as conn:
+        return [dict(row) for row in conn.execute("SELECT * FROM device_reservations ORDER BY id")]
+
+
+def _orphans(db):
+    with db.get_connection() as conn:
+        return [row['username'] for row in conn.execute("SELECT username FROM marzban_orphans ORDER BY username")]
+
+
+def test_commit_charges_and_creates_device(db, marzban):
+    db.update_balance(1, 100)
+    start = _balance(db)
+    pipeline = ProvisioningPipeline(db, ProvisioningMarzban(marzban))
+
+    device = pipeline.provision(1, 'android', 3)
+
+    assert device and device.id
+    assert _balance(db) == start - DEFAULT_PLAN_PRICE * 3
+    reservation, = _reservations(db)
+    assert reservation['status'] == 'committed'
+    assert reservation['device_id'] == device.id
+    assert reservation['marzban_username'] == device.marzban_username
+    assert pipeline.get_stats()['outcomes']['committed'] == 1
+
+
+def test_insufficient_funds_reserves_nothing(db, marzban):
+    pipeline = ProvisioningPipeline(db, ProvisioningMarzban(marzban))
+    start = _balance(db)
+
+    assert pipeline.provision(1, 'android', int(start // DEFAULT_PLAN_PRICE) + 1) is None
+    assert _balance(db) == start
+    assert _reservations(db) == []
+
+
+def test_failed_create_refunds(db, marzban):
+    db.update_balance(1, 100)
+    start = _balance(db)
+    remote = ProvisioningMarzban(marzban)
+    remote.create_ok = False
+    pipeline = ProvisioningPipeline(db, remote)
+
+    assert pipeline.provision(1, 'android', 1) is None
+    assert _balance(db) == start
+    reservation, = _reservations(db)
+    assert reservation['status'] == 'released'
+    # Пользователь, имя которого привязано к резерву, удаляется при откате
+    assert reservation['marzban_username'] in marzban.deleted
+
+
+def test_failed_pool_activation_falls_back_and_deletes_claimed_user(db, marzban):
+    db.update_balance(1, 100)
+    remote = ProvisioningMarzban(marzban)
+    remote.activate_ok = False
+    pipeline = ProvisioningPipeline(db, remote, user_pool=FakePool(['pool_user']))
+
+    device = pipeline.provision(1, 'android', 1)
+
+    assert device and device.marzban_username in remote.created
+    assert 'pool_user' in marzban.deleted
+    assert _orphans(db) == []
+
+
+def test_undeletable_users_are_queued_and_reaped(db, marzban):
+    db.update_balance(1, 100)
+    start = _balance(db)
+    remote = ProvisioningMarzban(marzban)
+    remote.activate_ok = False
+    remote.create_ok = False
+    marzban.available = False
+    pipeline = ProvisioningPipeline(db, remote, user_pool=FakePool(['pool_user']))
+
+    assert pipeline.provision(1, 'android', 1) is None
+    assert _balance(db) == start
+    reservation, = _reservations(db)
+    assert reservation['status'] == 'released'
+    assert _orphans(db) == sorted(['pool_user', reservation['marzban_username']])
+
+    # Панель снова доступна: orphans удаляются при очередной уборке
+    marzban.available = True
+    assert pipeline.reap_orphans() == 2
+    assert _orphans(db) == []
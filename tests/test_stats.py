@@ -0,0 +1,14 @@
+from utils.stats import percentile
+
+
+def test_nearest_rank_percentile():
+    values = [5, 1, 4, 2, 3, 6, 7, 8, 9, 10]
+
+    assert percentile(values, 50) == 5
+    assert percentile(values, 95) == 10
+    assert percentile(values, 0) == 1
+    assert percentile([0.25], 99) == 0.25
+
+
+def test_empty_sample():
+    assert percentile([], 95) == 0.0
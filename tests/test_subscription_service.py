@@ -0,0 +1,77 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from database.models import Device
+from services.config_renderer import ConfigRenderer
+from services.subscription_service import SubscriptionService
+
+LINK = 'vless://00000000-0000-0000-0000-000000000000@vpn.example.com:443?type=tcp&security=tls#main'
+
+
+def _add_device(db, expires_at):
+    return db.add_device(Device(
+        telegram_id=1, device_type='android', config_data=json.dumps({'links': [LINK]}),
+        created_at=datetime.now(), expires_at=expires_at, marzban_username='user_android'
+    ))
+
+
+@pytest.fixture
+def subscription(db):
+    return SubscriptionService(db, ConfigRenderer(), secret='test-secret', base_url='https://sub.example.com')
+
+
+def test_serves_signed_subscription(db, subscription):
+    token = subscription.make_token(_add_device(db, datetime.now() + timedelta(days=1)))
+
+    status, body, headers = subscription.serve(token)
+
+    assert status == 200
+    assert body == f"{LINK}\n".encode()
+    assert headers['ETag'].startswith('"') and headers['Content-Type'].startswith('text/plain')
+
+
+@pytest.mark.parametrize('token', ['1.deadbeef', '1', 'abc.def', '-1.x', ''])
+def test_forged_or_malformed_token_is_rejected(db, subscription, token):
+    _add_device(db, datetime.now() + timedelta(days=1))
+
+    assert subscription.verify_token(token) is None
+    assert subscription.serve(token)[0] == 404
+
+
+def test_token_from_other_secret_is_rejected(db, subscription):
+    device_id = _add_device(db, datetime.now() + timedelta(days=1))
+    forged = SubscriptionService(db, ConfigRenderer(), secret='other-secret').make_token(device_id)
+
+    assert subscription.verify_token(forged) is None
+    assert subscription.verify_token(subscription.make_token(device_id)) == device_id
+
+
+def test_expired_device_returns_gone(db, subscription):
+    token = subscription.make_token(_add_device(db, datetime.now() - timedelta(minutes=1)))
+
+    status, body, headers = subscription.serve(token)
+
+    assert status == 410
+    assert headers['Cache-Control'] == 'no-store'
+
+
+def test_unknown_format_returns_not_found(db, subscription):
+    token = subscription.make_token(_add_device(db, datetime.now() + timedelta(days=1)))
+
+    assert subscription.serve(token, fmt='exe') == (404, b'Unknown format', {})
+
+
+def test_matching_weak_etag_returns_not_modified(db, subscription):
+    token = subscription.make_token(_add_device(db, datetime.now() + timedelta(days=1)))
+    etag = subscription.serve(token)[2]['ETag']
+
+    status, body, headers = subscription.serve(token, if_none_match=f'"stale", W/{etag}')
+
+    assert status == 304 and body == b''
+    assert headers['ETag'] == etag
+    assert subscription.serve(token, if_none_match='*')[0] == 304
+    assert subscription.serve(token, if_none_match='"stale"')[0] == 200
+    # ETag зависит от формата
+    assert subscription.serve(token, fmt='singbox', if_none_match=etag)[0] == 200
@@ -0,0 +1,56 @@
+import pytest
+
+import utils.rate_limiter
+from utils.rate_limiter import TokenBucket
+
+
+@pytest.fixture
+def bucket_clock(clock, monkeypatch):
+    monkeypatch.setattr(utils.rate_limiter, 'time', clock)
+    return clock
+
+
+def test_burst_is_served_without_waiting(bucket_clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+
+    assert [bucket.acquire() for _ in range(5)] == [0.0] * 5
+    assert bucket_clock.slept == []
+
+
+def test_wait_time_matches_rate(bucket_clock):
+    bucket = TokenBucket(rate=8, capacity=2)
+    bucket.acquire(2)
+
+    waited = bucket.acquire()
+
+    assert waited == 0.125
+    assert bucket_clock.slept == [0.125]
+
+
+def test_refill_is_capped_by_capacity(bucket_clock):
+    bucket = TokenBucket(rate=8, capacity=3)
+    bucket.acquire(3)
+
+    bucket_clock.advance(0.1875)
+    assert bucket.acquire() == 0.0
+    assert bucket.tokens == 0.5
+
+    # Долгий простой не накапливает больше capacity
+    bucket_clock.advance(60)
+    assert [bucket.acquire() for _ in range(3)] == [0.0] * 3
+    assert bucket.acquire() == 0.125
+
+
+def test_multi_token_request_waits_for_deficit(bucket_clock):
+    bucket = TokenBucket(rate=4, capacity=4)
+    bucket.acquire(3)
+
+    assert bucket.acquire(3) == 0.5
+    assert bucket.tokens == 0
+
+
+def test_zero_rate_disables_limit(bucket_clock):
+    bucket = TokenBucket(rate=0, capacity=0)
+
+    assert all(bucket.acquire() == 0.0 for _ in range(100))
+    assert bucket_clock.slept == []
@@ -0,0 +1,84 @@
+import codecs
+import json
+import re
+from typing import Any, Iterable, Iterator, Optional
+
+_WHITESPACE = ' \t\n\r'
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+def iter_json_array(chunks: Iterable[bytes], key: Optional[str] = None) -> Iterator[Any]:
+    """
+    Инкрементальный разбор JSON-массива из потока байтов.
+
+    Элементы отдаются по одному по мере поступления данных, поэтому в памяти
+    держится только текущий фрагмент ответа, а не весь документ.
+
+    Args:
+        chunks: Поток байтов (например, response.iter_content())
+        key: Ключ массива в объекте верхнего уровня ({"users": [...]}).
+             Если ответ сам является массивом, ключ игнорируется.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    key_pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key)) if key else None
+
+    chunks = iter(chunks)
+    buffer = ''
+    eof = False
+
+    def read_more() -> bool:
+        nonlocal buffer, eof
+        for chunk in chunks:
+            if chunk:
+                buffer += text_decoder.decode(chunk)
+                return True
+        buffer += text_decoder.decode(b'', final=True)
+        eof = True
+        return False
+
+    # Ищем начало массива
+    while True:
+        stripped = buffer.lstrip(_WHITESPACE)
+        if stripped.startswith('['):
+            buffer = stripped[1:]
+            break
+        match = key_pattern.search(buffer) if key_pattern and stripped.startswith('{') else None
+        if match:
+            buffer = buffer[match.end():]
+            break
+        if stripped and not stripped.startswith('{'):
+            raise JSONStreamError("Response is neither a JSON array nor an object")
+        if not read_more():
+            raise JSONStreamError(f"Array {key or ''} not found in response")
+
+    # Отдаем элементы массива по одному
+    pos = 0
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE + ',':
+            pos += 1
+        if pos >= len(buffer):
+            buffer, pos = '', 0
+            if not read_more():
+                raise JSONStreamError("Unexpected end of JSON array")
+            continue
+        if buffer[pos] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            item, end = None, None
+
+        # Число в конце буфера может быть обрезано - дочитываем
+        if end is None or (end >= len(buffer) and not eof):
+            buffer, pos = buffer[pos:], 0
+            if not read_more() and end is None:
+                raise JSONStreamError("Malformed JSON array element")
+            continue
+
+        yield item
+        buffer, pos = buffer[end:], 0
@@ -2,8 +2,8 @@ import socket
 import requests
 from functools import wraps
 import logging
-from time import sleep
-from typing import Callable, Any
+from time import sleep, perf_counter
+from typing import Callable, Any, Optional
 
 logger = logging.getLogger('network')
 
@@ -73,6 +73,16 @@ def test_telegram_api() -> bool:
         return False
 
 
+def measure_tcp_latency(host: str, port: int, timeout: float = 5) -> Optional[float]:
+    """Время установки TCP-соединения в секундах (None, если сервер недоступен)."""
+    started = perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return perf_counter() - started
+    except (socket.error, ValueError):
+        return None
+
+
 def validate_config_connection(config: str, timeout: int = 5) -> bool:
     """Проверка доступности конфигурации VPN."""
     try:
@@ -81,9 +91,10 @@ def validate_config_connection(config: str, timeout: int = 5) -> bool:
         port = int(config.split('port = ')[1].split('\n')[0].strip())
 
         # Пробуем подключиться
-        socket.create_connection((server, port), timeout=timeout)
+        if measure_tcp_latency(server, port, timeout) is None:
+            raise NetworkError(f"{server}:{port} is unreachable")
         logger.info(f"Successfully validated connection to {server}:{port}")
         return True
     except Exception as e:
         logger.error(f"Error validating config connection: {e}")
-        return False
\ No newline at end of file
+        return False
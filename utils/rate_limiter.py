@@ -1,4 +1,5 @@
 from collections import defaultdict
+import threading
 import time
 from functools import wraps
 from typing import Callable, Dict, List, Tuple
@@ -81,4 +82,38 @@ class RateLimiter:
 
             return func(self, call, *args, **kwargs)
 
-        return wrapper
\ No newline at end of file
+        return wrapper
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket для исходящих запросов.
+    rate - токенов в секунду, capacity - максимальный всплеск.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Ожидание токена. Возвращает время ожидания в секундах."""
+        if self.rate <= 0:
+            return 0.0
+
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return now - started
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,11 @@
+import math
+from typing import Sequence
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """Перцентиль методом ближайшего ранга (p в диапазоне 0..100); 0.0 для пустой выборки."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]